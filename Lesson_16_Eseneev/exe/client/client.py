@@ -98,7 +98,6 @@ if __name__ == "__main__":
         message.critical(start_dialog, "Ошибка сервера", error.text)
         sys.exit(1)
     transport.setDaemon(True)
-    transport.start()
 
     # Удалим объект диалога за ненадобностью
     del start_dialog
@@ -106,6 +105,9 @@ if __name__ == "__main__":
     # Создаём GUI
     main_window = ClientMainWindow(database, transport, keys)
     main_window.make_connection(transport)
+    # Запускаем обработку сообщений сервера после подключения сигналов,
+    # иначе отложенные сообщения, присланные сразу после входа, потеряются.
+    transport.start()
     main_window.setWindowTitle(f"Чат Программа alpha release - {client_name}")
     client_app.exec_()
 
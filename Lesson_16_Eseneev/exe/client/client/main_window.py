@@ -11,11 +11,19 @@ from PyQt5.QtGui import QBrush, QColor, QStandardItem, QStandardItemModel
 from PyQt5.QtWidgets import QApplication, QListView, QMainWindow, QMessageBox, qApp
 
 from client.add_contact import AddContactDialog
+from client.database import MESSAGE_FAILED, MESSAGE_PENDING, MESSAGE_SENT
 from client.del_contact import DelContactDialog
 from client.main_window_conv import Ui_MainClientWindow
 
 logger = logging.getLogger("client")
 
+# Отметки состояния исходящих сообщений в истории
+MESSAGE_STATES = {
+    MESSAGE_SENT: "",
+    MESSAGE_PENDING: " (отправляется)",
+    MESSAGE_FAILED: " (не доставлено)",
+}
+
 
 class ClientMainWindow(QMainWindow):
     """
@@ -123,7 +131,8 @@ class ClientMainWindow(QMainWindow):
                 self.history_model.appendRow(mess)
             else:
                 mess = QStandardItem(
-                    f"Исходящее от {item[3].replace(microsecond=0)}:\n {item[2]}"
+                    f"Исходящее от {item[3].replace(microsecond=0)}"
+                    f"{MESSAGE_STATES[item[4]]}:\n {item[2]}"
                 )
                 mess.setEditable(False)
                 mess.setTextAlignment(Qt.AlignRight)
@@ -205,12 +214,13 @@ class ClientMainWindow(QMainWindow):
         except ServerError as err:
             self.messages.critical(self, "Ошибка сервера", err.text)
         except OSError as err:
+            # Соединение восстанавливается транспортом, окно не закрываем.
             if err.errno:
                 self.messages.critical(
-                    self, "Ошибка", "Потеряно соединение с сервером!"
+                    self, "Ошибка", "Нет соединения с сервером, идёт переподключение."
                 )
-                self.close()
-            self.messages.critical(self, "Ошибка", "Таймаут соединения!")
+            else:
+                self.messages.critical(self, "Ошибка", "Таймаут соединения!")
         else:
             self.database.add_contact(new_contact)
             new_contact = QStandardItem(new_contact)
@@ -237,12 +247,13 @@ class ClientMainWindow(QMainWindow):
         except ServerError as err:
             self.messages.critical(self, "Ошибка сервера", err.text)
         except OSError as err:
+            # Соединение восстанавливается транспортом, окно не закрываем.
             if err.errno:
                 self.messages.critical(
-                    self, "Ошибка", "Потеряно соединение с сервером!"
+                    self, "Ошибка", "Нет соединения с сервером, идёт переподключение."
                 )
-                self.close()
-            self.messages.critical(self, "Ошибка", "Таймаут соединения!")
+            else:
+                self.messages.critical(self, "Ошибка", "Таймаут соединения!")
         else:
             self.database.del_contact(selected)
             self.clients_list_update()
@@ -257,7 +268,10 @@ class ClientMainWindow(QMainWindow):
     def send_message(self):
         """
         Функция отправки сообщения текущему собеседнику.
-        Реализует шифрование сообщения и его отправку.
+        Реализует шифрование сообщения и его постановку в очередь
+        исходящих, откуда его отправляет поток транспорта, поэтому
+        окно не ждёт сервер, а при разрыве соединения сообщение не
+        теряется.
         """
         # Текст в поле, проверяем что поле не пустое затем забирается сообщение
         # и поле очищается
@@ -268,29 +282,16 @@ class ClientMainWindow(QMainWindow):
         # Шифруем сообщение ключом получателя и упаковываем в base64.
         message_text_encrypted = self.encryptor.encrypt(message_text.encode("utf8"))
         message_text_encrypted_base64 = base64.b64encode(message_text_encrypted)
-        try:
-            self.transport.send_message(
-                self.current_chat, message_text_encrypted_base64.decode("ascii")
-            )
-            pass
-        except ServerError as err:
-            self.messages.critical(self, "Ошибка", err.text)
-        except OSError as err:
-            if err.errno:
-                self.messages.critical(
-                    self, "Ошибка", "Потеряно соединение с сервером!"
-                )
-                self.close()
-            self.messages.critical(self, "Ошибка", "Таймаут соединения!")
-        except (ConnectionResetError, ConnectionAbortedError):
-            self.messages.critical(self, "Ошибка", "Потеряно соединение с сервером!")
-            self.close()
-        else:
-            self.database.save_message(self.current_chat, "out", message_text)
-            logger.debug(
-                f"Отправлено сообщение для {self.current_chat}: {message_text}"
-            )
-            self.history_list_update()
+        self.database.queue_message(
+            self.current_chat,
+            message_text,
+            message_text_encrypted_base64.decode("ascii"),
+        )
+        self.transport.flush_outbox()
+        logger.debug(
+            f"Сообщение для {self.current_chat} поставлено в очередь: {message_text}"
+        )
+        self.history_list_update()
 
     @pyqtSlot(dict)
     def message(self, message):
@@ -367,6 +368,28 @@ class ClientMainWindow(QMainWindow):
         )
         self.close()
 
+    @pyqtSlot()
+    def outbox_updated(self):
+        """Слот обработчик подтверждения отправки сообщений из очереди."""
+        if self.current_chat:
+            self.history_list_update()
+
+    @pyqtSlot()
+    def reconnecting(self):
+        """Слот обработчик разрыва соединения, пока транспорт переподключается."""
+        self.ui.statusBar.showMessage(
+            "Потеряно соединение с сервером, идёт переподключение..."
+        )
+
+    @pyqtSlot()
+    def reconnected(self):
+        """
+        Слот обработчик восстановления соединения.
+        Обновляет список контактов, синхронизированный после входа.
+        """
+        self.ui.statusBar.showMessage("Соединение с сервером восстановлено.", 5000)
+        self.sig_205()
+
     @pyqtSlot()
     def sig_205(self):
         """
@@ -384,4 +407,7 @@ class ClientMainWindow(QMainWindow):
         """Метод обеспечивающий соединение сигналов и слотов."""
         trans_obj.new_message.connect(self.message)
         trans_obj.connection_lost.connect(self.connection_lost)
+        trans_obj.reconnecting.connect(self.reconnecting)
+        trans_obj.reconnected.connect(self.reconnected)
+        trans_obj.outbox_updated.connect(self.outbox_updated)
         trans_obj.message_205.connect(self.sig_205)
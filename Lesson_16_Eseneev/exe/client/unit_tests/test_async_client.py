@@ -0,0 +1,107 @@
+import asyncio
+import os
+import socket
+import sys
+import time
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), ".."))
+# Каталог сервера: рядом с клиентом в поставке exe или в пакетах.
+for SERVER_DIR in (
+    os.path.join(os.getcwd(), "..", "..", "server"),
+    os.path.join(os.getcwd(), "..", "..", "..", "server", "server"),
+):
+    if os.path.isfile(os.path.join(SERVER_DIR, "server", "core.py")):
+        # Пакет common сервера совпадает с клиентским, кроме импорта
+        # классов сервера в декораторе login_required.
+        sys.path.insert(0, SERVER_DIR)
+        break
+from client.async_client import AsyncClient
+from common.errors import ServerError
+from common.variables import *
+from server.core import MessageProcessor
+from server.memory_storage import MemoryStorage
+
+
+def free_port():
+    """Функция выбора свободного порта для тестового сервера."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestAsyncClient(unittest.IsolatedAsyncioTestCase):
+    """Тесты асинхронного клиента с сервером и хранилищем в памяти."""
+
+    def setUp(self):
+        # Клиенты создаются вне цикла событий, в котором работают.
+        self.database = MemoryStorage()
+        self.clients = dict()
+        for name in ("alice", "bob"):
+            client = AsyncClient(name, "secret", f"{name}-key")
+            self.database.add_user(name, client.password_hash())
+            self.clients[name] = client
+        self.server = MessageProcessor("127.0.0.1", free_port(), self.database)
+        self.server.daemon = True
+        self.server.start()
+        self.addCleanup(self.close_server)
+        # Ждём, пока сервер начнёт принимать соединения.
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", self.server.port), 1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    def close_server(self):
+        """Метод остановки тестового сервера."""
+        self.server.running = False
+        self.server.join(5)
+        self.server.wakeup_reader.close()
+        self.server.wakeup_writer.close()
+        self.server.sock.close()
+
+    async def asyncSetUp(self):
+        for client in self.clients.values():
+            await client.connect("127.0.0.1", self.server.port, attempts=1)
+            self.addAsyncCleanup(client.close)
+
+    async def test_connect(self):
+        """Авторизованные клиенты активны на сервере и получили токен."""
+        active = [row[0] for row in self.database.active_users_list()]
+        self.assertEqual(sorted(active), ["alice", "bob"])
+        for client in self.clients.values():
+            self.assertTrue(client.connected)
+            self.assertTrue(client.resume_token)
+
+    async def test_unknown_user(self):
+        """Незарегистрированному пользователю сервер отказывает во входе."""
+        client = AsyncClient("carol", "secret")
+        with self.assertRaises(ServerError):
+            await client.connect("127.0.0.1", self.server.port, attempts=1)
+        self.assertFalse(client.connected)
+
+    async def test_messages(self):
+        """Сообщение доставляется получателю через итератор messages()."""
+        await self.clients["alice"].send_message("bob", "hello")
+        messages = self.clients["bob"].messages()
+        message = await asyncio.wait_for(messages.__anext__(), 5)
+        self.assertEqual(message[SENDER], "alice")
+        self.assertEqual(message[MESSAGE_TEXT], "hello")
+
+    async def test_contacts(self):
+        """Контакт добавляется и удаляется на сервере."""
+        client = self.clients["alice"]
+        self.assertEqual(await client.get_contacts(), [])
+        await client.add_contact("bob")
+        self.assertEqual(await client.get_contacts(), ["bob"])
+        await client.remove_contact("bob")
+        self.assertEqual(await client.get_contacts(), [])
+
+    async def test_key_request(self):
+        """Сервер выдаёт открытый ключ, переданный пользователем при входе."""
+        self.assertEqual(await self.clients["alice"].key_request("bob"), "bob-key")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+Бенчмарк запросов к базе данных сервера на больших таблицах.
+Заполняет временную базу: USERS пользователей, по ROWS строк в таблицах
+контактов и истории входов, и измеряет время типовых запросов
+с индексами и без них (как в базе предыдущих версий), а затем время
+обновления такой базы миграциями.
+
+Запуск из каталога сервера: python benchmarks/bench_database.py [строк]
+"""
+
+import datetime
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from server.database import ServerStorage
+from server.migrations import MIGRATIONS, migrate
+
+# Количество пользователей и строк в таблицах контактов и истории входов
+USERS = 10000
+ROWS = 1000000
+# Количество запросов в одном замере
+NUMBER = 50
+
+# Индексы, которых не было в базе предыдущих версий
+INDEXES = (
+    "ix_contacts_user_contact",
+    "ix_contacts_contact",
+    "ix_history_user",
+    "ix_login_history_name_date",
+)
+
+
+def fill(database, rows):
+    """Функция заполнения базы тестовыми данными."""
+    tables = database.metadata.tables
+    now = datetime.datetime.now()
+    with database.database_engine.begin() as connection:
+        connection.execute(
+            tables["Users"].insert(),
+            [
+                {"id": number, "name": f"user{number}", "last_login": now}
+                for number in range(1, USERS + 1)
+            ],
+        )
+        connection.execute(
+            tables["History"].insert(),
+            [
+                {"user": number, "sent": 0, "accepted": 0}
+                for number in range(1, USERS + 1)
+            ],
+        )
+        per_user = rows // USERS
+        connection.execute(
+            tables["Contacts"].insert(),
+            [
+                {"user": number, "contact": (number + shift) % USERS + 1}
+                for number in range(1, USERS + 1)
+                for shift in range(per_user)
+            ],
+        )
+        connection.execute(
+            tables["Login_history"].insert(),
+            [
+                {
+                    "name": number,
+                    "date_time": now - datetime.timedelta(minutes=shift),
+                    "ip": "127.0.0.1",
+                    "port": "7777",
+                }
+                for number in range(1, USERS + 1)
+                for shift in range(per_user)
+            ],
+        )
+
+
+def measure(database):
+    """Функция замера типовых запросов, возвращает мкс на запрос."""
+    names = [f"user{random.randint(1, USERS)}" for _ in range(NUMBER)]
+    session = database.session
+    UsersContacts = database.UsersContacts
+    UsersHistory = database.UsersHistory
+
+    def contacts():
+        for name in names:
+            database.get_contacts(name)
+
+    def contact_exists():
+        for name in names:
+            user = database.user_record(name)
+            session.query(UsersContacts).filter_by(user=user.id, contact=1).count()
+
+    def reverse_contacts():
+        for name in names:
+            user = database.user_record(name)
+            session.query(UsersContacts).filter_by(contact=user.id).count()
+
+    def login_history():
+        for name in names:
+            database.login_history(name)
+
+    def statistics():
+        for name in names:
+            user = database.user_record(name)
+            session.query(UsersHistory).filter_by(user=user.id).first()
+
+    results = {}
+    for title, func in (
+        ("get_contacts", contacts),
+        ("проверка контакта", contact_exists),
+        ("контакт у других", reverse_contacts),
+        ("login_history", login_history),
+        ("строка History", statistics),
+    ):
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        results[title] = seconds / NUMBER * 1e6
+    return results
+
+
+def main():
+    # Логирование на уровне debug измеряло бы скорость записи в журнал.
+    logging.getLogger("server").setLevel(logging.ERROR)
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else ROWS
+
+    path = os.path.join(tempfile.mkdtemp(), "bench_database.db3")
+    database = ServerStorage(path)
+    start = time.perf_counter()
+    fill(database, rows)
+    print(f"База заполнена за {time.perf_counter() - start:.1f} с: {rows} строк.")
+
+    indexed = measure(database)
+
+    # Приводим базу к виду предыдущих версий: без индексов и миграций.
+    with database.database_engine.begin() as connection:
+        for index in INDEXES:
+            connection.execute(f"DROP INDEX {index}")
+        connection.execute("PRAGMA user_version = 0")
+    plain = measure(database)
+
+    print(f"{'Запрос':<20}{'без индексов':>15}{'с индексами':>15}  мкс/запрос")
+    for title in indexed:
+        print(f"{title:<20}{plain[title]:>15.1f}{indexed[title]:>15.1f}")
+
+    start = time.perf_counter()
+    migrate(database.database_engine)
+    print(
+        f"Обновление базы до версии {MIGRATIONS[-1][0]}: "
+        f"{time.perf_counter() - start:.1f} с."
+    )
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
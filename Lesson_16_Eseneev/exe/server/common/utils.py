@@ -1,4 +1,6 @@
 import json
+import socket
+import struct
 import sys
 
 from common.decos import log
@@ -6,34 +8,135 @@ from common.variables import *
 
 sys.path.append("../")
 
+# Заголовок сообщения в режиме с длиной: 4 байта, сетевой порядок.
+FRAME_HEADER = struct.Struct("!I")
+
+
+def encode_message(message, framed=False):
+    """
+    Функция кодирования словаря в байты для передачи.
+    В режиме framed перед JSON добавляется заголовок с его длиной.
+    """
+    encoded_message = json.dumps(message).encode(ENCODING)
+    if framed:
+        return FRAME_HEADER.pack(len(encoded_message)) + encoded_message
+    return encoded_message
+
+
+def decode_message(data):
+    """
+    Функция декодирования полученных байт в словарь.
+    Если получен не словарь, генерирует исключение TypeError.
+    """
+    response = json.loads(data.decode(ENCODING))
+    if isinstance(response, dict):
+        return response
+    else:
+        raise TypeError
+
+
+class MessageDecoder:
+    """
+    Класс - буфер сборки входящих сообщений одного соединения.
+    Принимает данные по мере поступления и возвращает все
+    полностью полученные сообщения. В режиме framed сообщения
+    разделяются заголовком длины, поэтому склеенные и разрезанные
+    на части сообщения собираются корректно. Без заголовка (старые
+    клиенты) каждая порция данных должна содержать целые сообщения.
+    """
+
+    def __init__(self, framed=False):
+        self.framed = framed
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Метод добавления данных в буфер, возвращает список сообщений."""
+        self.buffer += data
+        messages = []
+        if self.framed:
+            while len(self.buffer) >= FRAME_HEADER.size:
+                (length,) = FRAME_HEADER.unpack_from(self.buffer)
+                if length > MAX_FRAME_LENGTH:
+                    raise TypeError
+                end = FRAME_HEADER.size + length
+                if len(self.buffer) < end:
+                    break
+                messages.append(
+                    decode_message(bytes(self.buffer[FRAME_HEADER.size : end]))
+                )
+                del self.buffer[:end]
+        else:
+            text = self.buffer.decode(ENCODING)
+            self.buffer.clear()
+            # Несколько склеенных JSON объектов разбираем по очереди.
+            decoder = json.JSONDecoder()
+            position = 0
+            while True:
+                message, position = decoder.raw_decode(text, position)
+                if not isinstance(message, dict):
+                    raise TypeError
+                messages.append(message)
+                while position < len(text) and text[position].isspace():
+                    position += 1
+                if position == len(text):
+                    break
+        return messages
+
+
+def recv_exact(sock, length, started=False):
+    """
+    Функция чтения из сокета ровно length байт.
+    Таймаут сокета прерывает ожидание только если сообщение ещё не
+    начало поступать, иначе дочитываем его до конца.
+    """
+    data = bytearray()
+    while len(data) < length:
+        try:
+            chunk = sock.recv(length - len(data))
+        except socket.timeout:
+            if data or started:
+                continue
+            raise
+        if not chunk:
+            raise ConnectionResetError
+        data += chunk
+    return bytes(data)
+
 
 @log
-def get_message(client):
+def get_message(client, framed=None):
     """
     Функция приёма сообщений от удалённых компьютеров.
     Принимает сообщения JSON, декодирует полученное сообщение
     и проверяет что получен словарь.
     :param client: сокет для передачи данных.
+    :param framed: сообщение передаётся с заголовком длины, по умолчанию
+        берётся из атрибута framed соединения.
     :return: словарь - сообщение.
     """
-    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
-    json_response = encoded_response.decode(ENCODING)
-    response = json.loads(json_response)
-    if isinstance(response, dict):
-        return response
+    if framed is None:
+        framed = getattr(client, "framed", False)
+    if framed:
+        (length,) = FRAME_HEADER.unpack(recv_exact(client, FRAME_HEADER.size))
+        if length > MAX_FRAME_LENGTH:
+            raise TypeError
+        encoded_response = recv_exact(client, length, started=True)
     else:
-        raise TypeError
+        encoded_response = client.recv(MAX_PACKAGE_LENGTH)
+    return decode_message(encoded_response)
 
 
 @log
-def send_message(sock, message):
+def send_message(sock, message, framed=None):
     """
     Функция отправки словарей через сокет.
     Кодирует словарь в формат JSON и отправляет через сокет.
     :param sock: сокет для передачи
     :param message: словарь для передачи
+    :param framed: передавать с заголовком длины, по умолчанию
+        берётся из атрибута framed соединения.
     :return: ничего не возвращает
     """
-    js_message = json.dumps(message)
-    encoded_message = js_message.encode(ENCODING)
-    sock.send(encoded_message)
+    if framed is None:
+        framed = getattr(sock, "framed", False)
+    sock.send(encode_message(message, framed))
@@ -1,7 +1,9 @@
 import argparse
 import configparser
 import logging
+import multiprocessing
 import os
+import socket
 import sys
 
 from PyQt5.QtCore import Qt
@@ -10,28 +12,58 @@ from PyQt5.QtWidgets import QApplication
 import logs.config_server_log
 from common.decos import log
 from common.utils import *
+from server.bulk_import import import_users
+from server.async_core import AsyncMessageProcessor
 from server.core import MessageProcessor
-from server.database import ServerStorage
+from server.backends import open_storage
 from server.main_window import MainWindow
+from server.retention import HistoryRetention
+from server.workers import WorkerPool
 
 # Инициализация логирования сервера.
 logger = logging.getLogger("server")
 
+# Параметры, которых может не быть в server.ini от предыдущих версий.
+DEFAULT_SETTINGS = {
+    "Engine": "select",
+    "Write_high_watermark": str(WRITE_HIGH_WATERMARK),
+    "Write_low_watermark": str(WRITE_LOW_WATERMARK),
+    "Slow_consumer_policy": SLOW_CONSUMER_POLICY,
+    "Handshake_timeout": str(HANDSHAKE_TIMEOUT),
+    "Stats_flush_interval": str(STATS_FLUSH_INTERVAL),
+    "Workers": "1",
+    "Database_backend": "sqlite",
+    "Database_url": "",
+    "Database_wal": "yes",
+    "Active_users_mirror": "yes",
+    "Login_history_days": str(LOGIN_HISTORY_DAYS),
+    "Login_history_archive": "",
+    "Retention_interval": str(RETENTION_INTERVAL),
+}
+
 
 @log
-def arg_parser(default_port, default_address):
+def arg_parser(default_port, default_address, default_engine, default_workers):
     """Парсер аргументов коммандной строки."""
     logger.debug(f"Инициализация парсера аргументов коммандной строки: {sys.argv}")
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", default=default_port, type=int, nargs="?")
     parser.add_argument("-a", default=default_address, nargs="?")
     parser.add_argument("--no_gui", action="store_true")
+    parser.add_argument(
+        "--engine", default=default_engine, choices=("select", "asyncio"), nargs="?"
+    )
+    parser.add_argument("--workers", default=default_workers, type=int, nargs="?")
+    parser.add_argument("--import_users", metavar="FILE")
     namespace = parser.parse_args(sys.argv[1:])
     listen_address = namespace.a
     listen_port = namespace.p
     gui_flag = namespace.no_gui
+    engine = namespace.engine
+    workers = namespace.workers
+    import_file = namespace.import_users
     logger.debug("Аргументы успешно загружены.")
-    return listen_address, listen_port, gui_flag
+    return listen_address, listen_port, gui_flag, engine, workers, import_file
 
 
 @log
@@ -42,15 +74,16 @@ def config_load():
     config.read(f"{dir_path}/{'server.ini'}")
     # Если конфиг файл загружен правильно, запускаемся, иначе конфиг по
     # умолчанию.
-    if "SETTINGS" in config:
-        return config
-    else:
+    if "SETTINGS" not in config:
         config.add_section("SETTINGS")
         config.set("SETTINGS", "Default_port", str(DEFAULT_PORT))
         config.set("SETTINGS", "Listen_Address", "")
         config.set("SETTINGS", "Database_path", "")
         config.set("SETTINGS", "Database_file", "server_database.db3")
-        return config
+    # Недостающие параметры задаём по умолчанию.
+    for key, value in DEFAULT_SETTINGS.items():
+        config["SETTINGS"].setdefault(key, value)
+    return config
 
 
 @log
@@ -61,19 +94,99 @@ def main():
 
     # Загрузка параметров командной строки, если нет параметров, то задаём
     # значения по умоланию.
-    listen_address, listen_port, gui_flag = arg_parser(
-        config["SETTINGS"]["Default_port"], config["SETTINGS"]["Listen_Address"]
+    listen_address, listen_port, gui_flag, engine, workers, import_file = arg_parser(
+        config["SETTINGS"]["Default_port"],
+        config["SETTINGS"]["Listen_Address"],
+        config["SETTINGS"]["Engine"],
+        config["SETTINGS"]["Workers"],
     )
 
     # Инициализация базы данных
-    database = ServerStorage(
-        os.path.join(
-            config["SETTINGS"]["Database_path"], config["SETTINGS"]["Database_file"]
-        )
+    database_path = os.path.join(
+        config["SETTINGS"]["Database_path"], config["SETTINGS"]["Database_file"]
     )
+    backend = config["SETTINGS"]["Database_backend"]
+    database = open_storage(
+        backend,
+        database_path,
+        config["SETTINGS"]["Database_url"],
+        wal=config["SETTINGS"].getboolean("Database_wal"),
+        active_mirror=config["SETTINGS"].getboolean("Active_users_mirror"),
+    )
+
+    # Импорт пользователей из файла без запуска сервера
+    if import_file:
+
+        def show_progress(done, total):
+            print(f"\rИмпортировано {done} из {total}", end="", flush=True)
+
+        added, skipped = import_users(database, import_file, progress=show_progress)
+        print(f"\nИмпортировано пользователей: {added}, пропущено: {skipped}.")
+        return
+
+    # Сворачивание устаревшей истории входов в фоновом потоке. Хранилище
+    # в памяти не рассчитано на запись из нескольких потоков.
+    retention = None
+    history_days = config["SETTINGS"].getint("Login_history_days")
+    if history_days > 0 and backend != "memory":
+        retention = HistoryRetention(
+            database,
+            history_days,
+            config["SETTINGS"]["Login_history_archive"] or None,
+            config["SETTINGS"].getfloat("Retention_interval"),
+        )
+        retention.start()
+
+    # Несколько процессов на одном порту возможны только при поддержке
+    # SO_REUSEPORT.
+    if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        logger.warning(
+            "Система не поддерживает SO_REUSEPORT, сервер запущен в одном процессе."
+        )
+        workers = 1
+    # Хранилище в памяти принадлежит одному процессу.
+    if workers > 1 and backend == "memory":
+        logger.warning(
+            "Хранилище в памяти не разделяется между процессами, "
+            "сервер запущен в одном процессе."
+        )
+        workers = 1
 
     # Создание экземпляра класса - сервера и его запуск:
-    server = MessageProcessor(listen_address, listen_port, database)
+    if workers > 1:
+        server = WorkerPool(
+            workers,
+            {
+                "engine": engine,
+                "address": listen_address,
+                "port": listen_port,
+                "backend": backend,
+                "database": database_path,
+                "url": config["SETTINGS"]["Database_url"],
+                "wal": config["SETTINGS"].getboolean("Database_wal"),
+                "high_watermark": config["SETTINGS"].getint("Write_high_watermark"),
+                "low_watermark": config["SETTINGS"].getint("Write_low_watermark"),
+                "slow_policy": config["SETTINGS"]["Slow_consumer_policy"],
+                "handshake_timeout": config["SETTINGS"].getint("Handshake_timeout"),
+                "stats_interval": config["SETTINGS"].getfloat("Stats_flush_interval"),
+            },
+            database,
+        )
+    else:
+        if engine == "asyncio":
+            server_class = AsyncMessageProcessor
+        else:
+            server_class = MessageProcessor
+        server = server_class(
+            listen_address,
+            listen_port,
+            database,
+            high_watermark=config["SETTINGS"].getint("Write_high_watermark"),
+            low_watermark=config["SETTINGS"].getint("Write_low_watermark"),
+            slow_policy=config["SETTINGS"]["Slow_consumer_policy"],
+            handshake_timeout=config["SETTINGS"].getint("Handshake_timeout"),
+            stats_interval=config["SETTINGS"].getfloat("Stats_flush_interval"),
+        )
     server.daemon = True
     server.start()
 
@@ -98,9 +211,19 @@ def main():
         # Запускаем GUI
         server_app.exec_()
 
-        # По закрытию окон останавливаем обработчик сообщений
+        # По закрытию окон останавливаем обработчик сообщений и ждём
+        # его завершения, чтобы сохранилась накопленная статистика.
         server.running = False
+        server.join()
+
+    # Прерываем сворачивание истории: незавершённая порция будет
+    # обработана при следующем запуске.
+    if retention:
+        retention.stop()
+        retention.join()
 
 
 if __name__ == "__main__":
+    # Нужно для запуска рабочих процессов из собранного exe.
+    multiprocessing.freeze_support()
     main()
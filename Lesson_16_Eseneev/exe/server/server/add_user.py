@@ -1,6 +1,3 @@
-import binascii
-import hashlib
-
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import (
     QApplication,
@@ -11,6 +8,8 @@ from PyQt5.QtWidgets import (
     QPushButton,
 )
 
+from server.bulk_import import hash_password
+
 
 class RegisterUser(QDialog):
     """Класс диалог регистрации пользователя на сервере."""
@@ -79,12 +78,20 @@ class RegisterUser(QDialog):
         else:
             # Генерируем хэш пароля, в качестве соли будем использовать логин в
             # нижнем регистре.
-            passwd_bytes = self.client_passwd.text().encode("utf-8")
-            salt = self.client_name.text().lower().encode("utf-8")
-            passwd_hash = hashlib.pbkdf2_hmac("sha512", passwd_bytes, salt, 10000)
-            self.database.add_user(
-                self.client_name.text(), binascii.hexlify(passwd_hash)
+            passwd_hash = hash_password(
+                self.client_name.text(), self.client_passwd.text()
             )
+            # Запись в базу выполняет поток сервера, дожидаемся её.
+            try:
+                self.server.threadsafe(
+                    self.database.add_user, self.client_name.text(), passwd_hash
+                ).result()
+            # Ошибка записи в потоке сервера сообщается пользователю.
+            except Exception as error:
+                self.messages.critical(
+                    self, "Ошибка", f"Не удалось зарегистрировать пользователя: {error}"
+                )
+                return
             self.messages.information(
                 self, "Успех", "Пользователь успешно зарегистрирован."
             )
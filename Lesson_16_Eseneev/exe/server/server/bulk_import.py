@@ -0,0 +1,106 @@
+import binascii
+import concurrent.futures
+import csv
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+
+# Загрузка логера
+logger = logging.getLogger("server")
+
+# Количество пользователей, записываемых в базу одной транзакцией
+IMPORT_BATCH_SIZE = 500
+# Количество паролей, передаваемых процессу хэширования за раз
+HASH_CHUNK_SIZE = 64
+
+
+def hash_password(name, password):
+    """
+    Функция вычисления хэша пароля пользователя. В качестве соли
+    используется логин в нижнем регистре.
+    """
+    passwd_hash = hashlib.pbkdf2_hmac(
+        "sha512", password.encode("utf-8"), name.lower().encode("utf-8"), 10000
+    )
+    return binascii.hexlify(passwd_hash)
+
+
+def hash_account(account):
+    """Функция хэширования пароля пары имя - пароль в процессе пула."""
+    name, password = account
+    return name, hash_password(name, password)
+
+
+def read_accounts(path):
+    """
+    Генератор пар имя - пароль из файла.
+    Файл .jsonl содержит по объекту {"name": ..., "password": ...} в строке,
+    остальные файлы читаются как CSV со столбцами имя и пароль,
+    строка заголовка name,password пропускается.
+    """
+    with open(path, encoding="utf-8", newline="") as file:
+        if path.lower().endswith((".jsonl", ".json")):
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record.get("name", ""), record.get("password", "")
+        else:
+            for row in csv.reader(file):
+                if len(row) < 2 or row[:2] == ["name", "password"]:
+                    continue
+                yield row[0], row[1]
+
+
+def import_users(database, path, write=None, progress=None, processes=None):
+    """
+    Функция импорта пользователей из файла.
+    Пароли хэшируются в пуле из processes процессов (по умолчанию по
+    числу ядер), пользователи записываются пакетами по IMPORT_BATCH_SIZE
+    функцией write (по умолчанию database.add_users). Пустые имена и
+    пароли, повторы в файле и уже зарегистрированные пользователи
+    пропускаются. После каждого пакета вызывается progress(обработано,
+    всего). Возвращает количество импортированных и пропущенных.
+    """
+    if write is None:
+        write = database.add_users
+    known = {name for name, _ in database.users_list()}
+    accounts = []
+    skipped = 0
+    for name, password in read_accounts(path):
+        name = name.strip()
+        if not name or not password or name in known:
+            skipped += 1
+            continue
+        known.add(name)
+        accounts.append((name, password))
+    logger.info(
+        f"Импорт пользователей из {path}: {len(accounts)} новых, "
+        f"{skipped} пропущено."
+    )
+
+    total = len(accounts)
+    batch = []
+    done = 0
+    if progress:
+        progress(done, total)
+    # Процессы запускаем методом spawn, как и рабочие процессы сервера.
+    with concurrent.futures.ProcessPoolExecutor(
+        processes or os.cpu_count(), mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        for account in executor.map(hash_account, accounts, chunksize=HASH_CHUNK_SIZE):
+            batch.append(account)
+            if len(batch) == IMPORT_BATCH_SIZE:
+                write(batch)
+                done += len(batch)
+                batch = []
+                if progress:
+                    progress(done, total)
+    if batch:
+        write(batch)
+        done += len(batch)
+        if progress:
+            progress(done, total)
+    logger.info(f"Импортировано пользователей: {done}.")
+    return done, skipped
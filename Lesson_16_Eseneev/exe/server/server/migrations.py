@@ -0,0 +1,50 @@
+import logging
+
+# Загрузка логера
+logger = logging.getLogger("server")
+
+# Миграции базы данных сервера: (версия, описание, SQL команды).
+# Версия схемы хранится в PRAGMA user_version. Новая база создаётся
+# сразу в последней версии, поэтому команды должны быть повторяемыми.
+MIGRATIONS = (
+    (
+        1,
+        "индексы контактов, статистики и истории входов",
+        (
+            # Перед созданием уникального индекса удаляем повторы контактов.
+            "DELETE FROM Contacts WHERE id NOT IN "
+            "(SELECT MIN(id) FROM Contacts GROUP BY user, contact)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_contacts_user_contact "
+            "ON Contacts (user, contact)",
+            "CREATE INDEX IF NOT EXISTS ix_contacts_contact ON Contacts (contact)",
+            "CREATE INDEX IF NOT EXISTS ix_history_user ON History (user)",
+            "CREATE INDEX IF NOT EXISTS ix_login_history_name_date "
+            "ON Login_history (name, date_time)",
+        ),
+    ),
+)
+
+# Последняя версия схемы
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(connection):
+    """Функция возвращающая версию схемы базы данных."""
+    return connection.execute("PRAGMA user_version").scalar()
+
+
+def migrate(engine):
+    """
+    Функция обновления схемы базы данных до последней версии.
+    Каждая миграция выполняется в отдельной транзакции вместе с записью
+    новой версии, поэтому прерванное обновление продолжится при
+    следующем запуске.
+    """
+    for version, description, statements in MIGRATIONS:
+        with engine.begin() as connection:
+            if schema_version(connection) >= version:
+                continue
+            for statement in statements:
+                connection.execute(statement)
+            connection.execute(f"PRAGMA user_version = {version}")
+        logger.info(f"База данных обновлена до версии {version}: {description}.")
@@ -1,6 +1,13 @@
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QStandardItem, QStandardItemModel
-from PyQt5.QtWidgets import QApplication, QComboBox, QDialog, QLabel, QPushButton
+from PyQt5.QtWidgets import (
+    QApplication,
+    QComboBox,
+    QDialog,
+    QLabel,
+    QMessageBox,
+    QPushButton,
+)
 
 
 class DelUserDialog(QDialog):
@@ -36,6 +43,8 @@ class DelUserDialog(QDialog):
         self.btn_cancel.move(230, 60)
         self.btn_cancel.clicked.connect(self.close)
 
+        self.messages = QMessageBox()
+
         self.all_users_fill()
 
     def all_users_fill(self):
@@ -44,11 +53,18 @@ class DelUserDialog(QDialog):
 
     def remove_user(self):
         """Метод - обработчик удаления пользователя."""
-        self.database.remove_user(self.selector.currentText())
-        if self.selector.currentText() in self.server.names:
-            sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
-            self.server.remove_client(sock)
+        # Запись в базу выполняет поток сервера, дожидаемся её.
+        try:
+            self.server.threadsafe(
+                self.database.remove_user, self.selector.currentText()
+            ).result()
+        # Ошибка записи в потоке сервера сообщается пользователю.
+        except Exception as error:
+            self.messages.critical(
+                self, "Ошибка", f"Не удалось удалить пользователя: {error}"
+            )
+            return
+        self.server.kick_user(self.selector.currentText())
         # Рассылаем клиентам сообщение о необходимости обновить справочники
         self.server.service_update_lists()
         self.close()
@@ -0,0 +1,80 @@
+class SessionRegistry:
+    """
+    Класс - реестр соединений сервера.
+    Хранит все соединения, имена авторизованных пользователей и
+    соединения, ожидающие авторизации. Поиск соединения по имени,
+    имени по соединению, проверка авторизации, добавление и удаление
+    выполняются за постоянное время независимо от числа клиентов.
+    """
+
+    def __init__(self):
+        # Соединение - имя пользователя (None до авторизации)
+        self.connections = dict()
+        # Имя пользователя - соединение
+        self.names = dict()
+        # Соединения, ожидающие авторизации, в порядке подключения
+        self.pending = dict()
+
+    def __contains__(self, connection):
+        return connection in self.connections
+
+    def __iter__(self):
+        # Копия, чтобы соединения можно было удалять при обходе.
+        return iter(list(self.connections))
+
+    def __len__(self):
+        return len(self.connections)
+
+    def add(self, connection):
+        """Метод регистрации нового соединения."""
+        self.connections[connection] = None
+        self.pending[connection] = None
+
+    def authenticate(self, connection, name):
+        """Метод регистрации успешной авторизации пользователя."""
+        self.connections[connection] = name
+        self.names[name] = connection
+        self.pending.pop(connection, None)
+
+    def remove(self, connection):
+        """Метод удаления соединения, возвращает имя пользователя или None."""
+        name = self.connections.pop(connection, None)
+        self.pending.pop(connection, None)
+        if name is not None and self.names.get(name) is connection:
+            del self.names[name]
+        return name
+
+    def forget(self, name):
+        """
+        Метод удаления имени пользователя без закрытия соединения.
+        Возвращает соединение пользователя или None.
+        """
+        connection = self.names.pop(name, None)
+        if connection is not None:
+            self.connections[connection] = None
+        return connection
+
+    def get(self, name):
+        """Метод возвращающий соединение пользователя или None."""
+        return self.names.get(name)
+
+    def name_of(self, connection):
+        """Метод возвращающий имя пользователя соединения или None."""
+        return self.connections.get(connection)
+
+    def is_authenticated(self, connection):
+        """Метод проверки, что соединение принадлежит авторизованному клиенту."""
+        return self.connections.get(connection) is not None
+
+    def expired(self, now):
+        """
+        Метод возвращающий соединения, срок авторизации которых истёк.
+        Сроки растут в порядке подключения, поэтому просматриваются
+        только самые старые соединения.
+        """
+        expired = []
+        for connection in self.pending:
+            if connection.auth_deadline >= now:
+                break
+            expired.append(connection)
+        return expired
@@ -0,0 +1,932 @@
+import binascii
+import hmac
+import os
+import queue
+import socket
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.getcwd(), ".."))
+from common.variables import *
+from common.utils import MessageDecoder, get_message, send_message
+from server.async_core import AsyncMessageProcessor, ClientProtocol
+from server.core import ClientConnection, MessageProcessor
+from server.dispatch import HANDLERS, find_handler, message_handler
+from server.memory_storage import MemoryStorage
+from server.workers import (
+    FORWARD,
+    KICK,
+    LOGIN,
+    LOGOUT,
+    STOP,
+    UPDATE_LISTS,
+    Router,
+    WorkerPool,
+)
+
+
+def free_port():
+    """Функция выбора свободного порта для тестового сервера."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def close_server(server):
+    """Функция закрытия сокетов остановленного тестового сервера."""
+    server.wakeup_reader.close()
+    server.wakeup_writer.close()
+    if server.sock is not None:
+        server.sock.close()
+
+
+class TestServerEngines(unittest.TestCase):
+    """Тесты устойчивости сервера к некорректным данным клиентов."""
+
+    def start_server(self, server_class):
+        """Метод запуска сервера с хранилищем в памяти."""
+        return self.run_server(server_class("127.0.0.1", free_port(), MemoryStorage()))
+
+    def run_server(self, server):
+        """Метод запуска созданного сервера, ждёт начала приёма соединений."""
+        server.daemon = True
+        server.start()
+        self.addCleanup(close_server, server)
+        self.addCleanup(server.join, 5)
+        self.addCleanup(setattr, server, "running", False)
+        # Ждём, пока сервер начнёт принимать соединения.
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", server.port), 1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        return server
+
+    def check_invalid_utf8(self, server_class):
+        """Данные не в UTF-8 отключают клиента, но не останавливают сервер."""
+        server = self.start_server(server_class)
+        with socket.create_connection(("127.0.0.1", server.port), 5) as sock:
+            sock.sendall(b"\xff\xfe{}")
+            self.assertEqual(sock.recv(100), b"")
+        time.sleep(0.2)
+        self.assertTrue(server.is_alive())
+        with socket.create_connection(("127.0.0.1", server.port), 5):
+            pass
+
+    def test_invalid_utf8_select(self):
+        self.check_invalid_utf8(MessageProcessor)
+
+    def test_invalid_utf8_asyncio(self):
+        self.check_invalid_utf8(AsyncMessageProcessor)
+
+    def check_failed_call(self, server_class):
+        """Ошибка вызова, переданного из другого потока, не останавливает сервер."""
+        server = self.start_server(server_class)
+        calls = []
+        server.threadsafe(server.database.remove_user, "nobody")
+        server.threadsafe(calls.append, 1)
+        for _ in range(50):
+            if calls:
+                break
+            time.sleep(0.1)
+        self.assertEqual(calls, [1])
+        self.assertTrue(server.is_alive())
+
+    def test_failed_call_select(self):
+        self.check_failed_call(MessageProcessor)
+
+    def test_failed_call_asyncio(self):
+        self.check_failed_call(AsyncMessageProcessor)
+
+    def check_removed_during_auth(self, server_class):
+        """Пользователь, удалённый до ответа на запрос 511, не входит."""
+        server = self.start_server(server_class)
+        server.database.add_user("user", b"hash")
+        with socket.create_connection(("127.0.0.1", server.port), 5) as sock:
+            presence = {ACTION: PRESENCE, TIME: 1}
+            presence[USER] = {ACCOUNT_NAME: "user", PUBLIC_KEY: "key"}
+            send_message(sock, presence)
+            request = get_message(sock)
+            self.assertEqual(request[RESPONSE], 511)
+            server.threadsafe(server.database.remove_user, "user").result(5)
+            digest = hmac.new(b"hash", request[DATA].encode(ENCODING), "md5").digest()
+            send_message(
+                sock,
+                {RESPONSE: 511, DATA: binascii.b2a_base64(digest).decode("ascii")},
+            )
+            self.assertEqual(get_message(sock)[RESPONSE], 400)
+        time.sleep(0.2)
+        self.assertTrue(server.is_alive())
+        self.assertNotIn("user", server.names)
+
+    def test_removed_during_auth_select(self):
+        self.check_removed_during_auth(MessageProcessor)
+
+    def test_removed_during_auth_asyncio(self):
+        self.check_removed_during_auth(AsyncMessageProcessor)
+
+    def check_bad_presence(self, server_class):
+        """На presence без имени пользователя сервер отвечает 400."""
+        server = self.start_server(server_class)
+        with socket.create_connection(("127.0.0.1", server.port), 5) as sock:
+            send_message(sock, {ACTION: PRESENCE, TIME: 1, USER: {}})
+            self.assertEqual(get_message(sock)[RESPONSE], 400)
+        self.assertTrue(server.is_alive())
+
+    def test_bad_presence_select(self):
+        self.check_bad_presence(MessageProcessor)
+
+    def test_bad_presence_asyncio(self):
+        self.check_bad_presence(AsyncMessageProcessor)
+
+    def check_client_error(self, server_class, error):
+        """Ошибка обработки сообщения одного клиента отключает только его."""
+        server = server_class("127.0.0.1", free_port(), MemoryStorage())
+
+        def handle_message(message, client):
+            raise error
+
+        server.handle_message = handle_message
+        self.run_server(server)
+        with socket.create_connection(("127.0.0.1", server.port), 5) as sock:
+            send_message(sock, {ACTION: PRESENCE, TIME: 1})
+            self.assertEqual(sock.recv(100), b"")
+        time.sleep(0.2)
+        self.assertTrue(server.is_alive())
+
+    def test_client_error_select(self):
+        for error in (KeyError(ACCOUNT_NAME), ValueError()):
+            with self.subTest(error=error):
+                self.check_client_error(MessageProcessor, error)
+
+    def test_client_error_asyncio(self):
+        for error in (KeyError(ACCOUNT_NAME), ValueError()):
+            with self.subTest(error=error):
+                self.check_client_error(AsyncMessageProcessor, error)
+
+    def check_call_result(self, server_class):
+        """Результат и исключение вызова из другого потока можно дождаться."""
+        server = self.start_server(server_class)
+        server.database.add_user("user", b"hash")
+        self.assertTrue(server.threadsafe(server.database.check_user, "user").result(5))
+        with self.assertRaises(ValueError):
+            server.threadsafe(server.database.add_user, "user", b"hash").result(5)
+        server.threadsafe(server.database.remove_user, "user").result(5)
+        self.assertFalse(server.database.check_user("user"))
+
+    def test_call_result_select(self):
+        self.check_call_result(MessageProcessor)
+
+    def test_call_result_asyncio(self):
+        self.check_call_result(AsyncMessageProcessor)
+
+
+class LimitedSocket:
+    """Тестовый сокет, принимающий за один вызов не больше limit байт."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = bytearray()
+
+    def send(self, data):
+        self.data += data[: self.limit]
+        return min(len(data), self.limit)
+
+    def close(self):
+        pass
+
+
+class TestWriteQueue(unittest.TestCase):
+    """Тесты очереди отправки клиенту и политик для медленных клиентов."""
+
+    def connect(self, policy, sock=None):
+        """Метод создания соединения с сервером с маленькой очередью отправки."""
+        self.server = MessageProcessor(
+            "127.0.0.1",
+            7777,
+            MemoryStorage(),
+            high_watermark=100,
+            low_watermark=10,
+            slow_policy=policy,
+        )
+        self.addCleanup(close_server, self.server)
+        if sock is None:
+            sock, self.client_sock = socket.socketpair()
+            self.addCleanup(sock.close)
+            self.addCleanup(self.client_sock.close)
+            self.client_sock.settimeout(1)
+        connection = ClientConnection(sock, self.server, ("127.0.0.1", 0))
+        self.server.sessions.add(connection)
+        return connection
+
+    def test_pause(self):
+        """Выше верхней границы чтение приостанавливается до нижней."""
+        sock = LimitedSocket(45)
+        connection = self.connect("pause", sock)
+        self.assertEqual(connection.send(b"x" * 100), 100)
+        self.assertFalse(connection.paused)
+        self.assertEqual(connection.send(b"y"), 1)
+        self.assertTrue(connection.paused)
+        self.assertEqual(connection.queue_size, 101)
+        connection.flush()
+        self.assertTrue(connection.paused)
+        connection.flush()
+        self.assertTrue(connection.paused)
+        connection.flush()
+        self.assertFalse(connection.paused)
+        self.assertEqual(connection.flushed, 101)
+        self.assertEqual(bytes(sock.data), b"x" * 100 + b"y")
+
+    def test_flush(self):
+        """Данные из очереди передаются в сокет при его готовности."""
+        connection = self.connect("pause")
+        connection.send(b"data")
+        self.assertEqual(connection.flushed, 0)
+        connection.flush()
+        self.assertEqual(connection.flushed, 4)
+        self.assertEqual(self.client_sock.recv(100), b"data")
+
+    def test_drop(self):
+        """При политике drop данные сверх верхней границы отбрасываются."""
+        connection = self.connect("drop")
+        connection.send(b"x" * 100)
+        self.assertEqual(connection.send(b"y"), 0)
+        self.assertFalse(connection.paused)
+        self.assertEqual(connection.queue_size, 100)
+
+    def test_disconnect(self):
+        """При политике disconnect переполненный клиент отключается."""
+        connection = self.connect("disconnect")
+        self.server.sessions.authenticate(connection, "user")
+        connection.send(b"x" * 100)
+        with self.assertRaises(ConnectionAbortedError):
+            connection.send(b"y")
+        message = {ACTION: MESSAGE, SENDER: "other", DESTINATION: "user", TIME: 1}
+        message[MESSAGE_TEXT] = "text"
+        self.server.process_message(message)
+        self.assertNotIn(connection, self.server.sessions)
+        self.assertNotIn("user", self.server.names)
+
+
+class FakeTransport:
+    """Тестовый транспорт asyncio, запоминающий вызовы протокола."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.reading = True
+        self.aborted = False
+
+    def set_write_buffer_limits(self, high, low):
+        pass
+
+    def get_write_buffer_size(self):
+        return len(self.data)
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 0)
+
+    def write(self, data):
+        self.data += data
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def is_closing(self):
+        return self.aborted
+
+    def abort(self):
+        self.aborted = True
+
+    def close(self):
+        pass
+
+
+class TestAsyncWriteQueue(unittest.TestCase):
+    """Тесты политик для медленных клиентов асинхронного сервера."""
+
+    def connect(self, policy):
+        """Метод создания протокола соединения с тестовым транспортом."""
+        server = AsyncMessageProcessor(
+            "127.0.0.1", 7777, MemoryStorage(), slow_policy=policy
+        )
+        self.addCleanup(close_server, server)
+        protocol = ClientProtocol(server)
+        protocol.connection_made(FakeTransport())
+        self.assertIn(protocol, server.sessions)
+        return protocol
+
+    def test_pause(self):
+        """При политике pause чтение останавливается до разгрузки очереди."""
+        protocol = self.connect("pause")
+        protocol.pause_writing()
+        self.assertFalse(protocol.transport.reading)
+        self.assertEqual(protocol.send(b"data"), 4)
+        protocol.resume_writing()
+        self.assertTrue(protocol.transport.reading)
+        self.assertFalse(protocol.paused)
+
+    def test_drop(self):
+        """При политике drop данные не пишутся, пока очередь переполнена."""
+        protocol = self.connect("drop")
+        protocol.pause_writing()
+        self.assertTrue(protocol.transport.reading)
+        self.assertEqual(protocol.send(b"data"), 0)
+        protocol.resume_writing()
+        self.assertEqual(protocol.send(b"data"), 4)
+        self.assertEqual(protocol.transport.data, b"data")
+        self.assertEqual(protocol.flushed, 0)
+
+    def test_disconnect(self):
+        """При политике disconnect соединение разрывается."""
+        protocol = self.connect("disconnect")
+        protocol.pause_writing()
+        self.assertTrue(protocol.transport.aborted)
+
+
+class FakeServer:
+    """Тестовый сервер: только словарь имён авторизованных клиентов."""
+
+    def __init__(self, names):
+        self.names = names
+
+
+class TestDispatch(unittest.TestCase):
+    """Тесты реестра обработчиков сообщений."""
+
+    client = object()
+    server = FakeServer({"user": client})
+
+    def test_registry(self):
+        """Все действия протокола зарегистрированы обработчиками сервера."""
+        handlers = {
+            PRESENCE: MessageProcessor.on_presence,
+            MESSAGE: MessageProcessor.on_message,
+            EXIT: MessageProcessor.on_exit,
+            GET_CONTACTS: MessageProcessor.on_get_contacts,
+            ADD_CONTACT: MessageProcessor.on_add_contact,
+            REMOVE_CONTACT: MessageProcessor.on_remove_contact,
+            USERS_REQUEST: MessageProcessor.on_users_request,
+            USERS_CHANGES_REQUEST: MessageProcessor.on_users_changes_request,
+            PUBLIC_KEY_REQUEST: MessageProcessor.on_public_key_request,
+        }
+        for action, func in handlers.items():
+            self.assertIs(HANDLERS[action].func, func)
+
+    def test_unknown_action(self):
+        """Для неизвестного действия и сообщения без действия обработчика нет."""
+        self.assertIsNone(find_handler({ACTION: "Wrong"}, self.client, self.server))
+        self.assertIsNone(find_handler({TIME: 1}, self.client, self.server))
+
+    def test_missing_key(self):
+        """Сообщение без обязательного ключа не проходит проверку."""
+        message = {ACTION: GET_CONTACTS, TIME: 1}
+        self.assertIsNone(find_handler(message, self.client, self.server))
+
+    def test_owner(self):
+        """Ключ владельца должен содержать имя приславшего клиента."""
+        message = {ACTION: GET_CONTACTS, TIME: 1, USER: "user"}
+        self.assertIs(
+            find_handler(message, self.client, self.server),
+            MessageProcessor.on_get_contacts,
+        )
+        self.assertIsNone(find_handler(message, object(), self.server))
+        message[USER] = "other"
+        self.assertIsNone(find_handler(message, self.client, self.server))
+
+    def test_no_owner(self):
+        """Сообщение без ключа владельца принимается от любого клиента."""
+        message = {ACTION: PRESENCE, TIME: 1}
+        message[USER] = {ACCOUNT_NAME: "guest", PUBLIC_KEY: "key"}
+        self.assertIs(
+            find_handler(message, object(), self.server), MessageProcessor.on_presence
+        )
+
+    def test_nested_keys(self):
+        """Вложенный словарь должен содержать обязательные ключи."""
+        for user in ({}, {ACCOUNT_NAME: "guest"}, {PUBLIC_KEY: "key"}, "guest", None):
+            message = {ACTION: PRESENCE, TIME: 1, USER: user}
+            self.assertIsNone(find_handler(message, object(), self.server))
+
+    def test_new_action(self):
+        """Обработчик нового действия добавляется декоратором."""
+        self.addCleanup(HANDLERS.pop, "test_action")
+
+        @message_handler("test_action", keys=(DATA,), owner=USER)
+        def on_test(server, message, client):
+            pass
+
+        message = {ACTION: "test_action", DATA: 1, USER: "user"}
+        self.assertIs(find_handler(message, self.client, self.server), on_test)
+        del message[DATA]
+        self.assertIsNone(find_handler(message, self.client, self.server))
+
+
+class DroppingConnection:
+    """
+    Тестовое соединение с политикой drop: пока установлен paused,
+    данные отбрасываются, как в асинхронном сервере.
+    """
+
+    framed = True
+
+    def __init__(self):
+        self.paused = True
+        self.written = 0
+        self.data = bytearray()
+
+    queue_size = 0
+
+    @property
+    def flushed(self):
+        return self.written
+
+    def send(self, data):
+        if self.paused:
+            return 0
+        self.data += data
+        self.written += len(data)
+        return len(data)
+
+    def getpeername(self):
+        return ("127.0.0.1", 0)
+
+    def close(self):
+        pass
+
+
+class TestOfflineDelivery(unittest.TestCase):
+    """Тесты сохранения и доставки сообщений отключённым пользователям."""
+
+    def setUp(self):
+        self.database = MemoryStorage()
+        for name in ("sender", "recipient"):
+            self.database.add_user(name, b"hash")
+        self.server = MessageProcessor("127.0.0.1", 7777, self.database)
+        self.addCleanup(close_server, self.server)
+
+    def connect(self, name):
+        """Метод создания авторизованного соединения, возвращает его и сокет клиента."""
+        server_sock, client_sock = socket.socketpair()
+        self.addCleanup(server_sock.close)
+        self.addCleanup(client_sock.close)
+        client_sock.settimeout(1)
+        connection = ClientConnection(server_sock, self.server, ("127.0.0.1", 0))
+        connection.decoder.framed = True
+        self.server.sessions.add(connection)
+        self.server.sessions.authenticate(connection, name)
+        return connection, client_sock
+
+    def store(self, text, message_id=None):
+        """Метод отправки сообщения от sender получателю recipient."""
+        message = {
+            ACTION: MESSAGE,
+            SENDER: "sender",
+            DESTINATION: "recipient",
+            TIME: 1,
+            MESSAGE_TEXT: text,
+        }
+        if message_id is not None:
+            message[MESSAGE_ID] = message_id
+        self.server.on_message(message, self.sender)
+        self.sender.outbuf.clear()
+
+    def offline_texts(self):
+        return [
+            message[MESSAGE_TEXT]
+            for _, message in self.database.get_offline_messages("recipient", 100)
+        ]
+
+    def test_store_and_dedup(self):
+        """Повтор сообщения с тем же идентификатором не сохраняется."""
+        self.sender, _ = self.connect("sender")
+        self.store("first", "id1")
+        self.store("first", "id1")
+        self.store("second", "id2")
+        self.store("third")
+        self.store("third")
+        self.assertEqual(self.offline_texts(), ["first", "second", "third", "third"])
+
+    def test_deliver_after_flush(self):
+        """Сообщения удаляются из базы только после передачи в сокет."""
+        self.sender, _ = self.connect("sender")
+        for number in range(3):
+            self.store(f"m{number}")
+        recipient, client_sock = self.connect("recipient")
+        self.server.start_offline_delivery(recipient)
+        self.server.deliver_offline()
+        self.assertEqual(len(self.offline_texts()), 3)
+        recipient.flush()
+        self.server.deliver_offline()
+        self.assertEqual(self.offline_texts(), [])
+        self.assertEqual(self.server.offline_delivery, dict())
+        messages = MessageDecoder(True).feed(client_sock.recv(65536))
+        self.assertEqual([m[MESSAGE_TEXT] for m in messages], ["m0", "m1", "m2"])
+
+    def test_disconnect_before_flush(self):
+        """Если клиент отключился до передачи, сообщения остаются в базе."""
+        self.sender, _ = self.connect("sender")
+        self.store("kept")
+        recipient, _ = self.connect("recipient")
+        self.server.start_offline_delivery(recipient)
+        self.server.deliver_offline()
+        self.server.remove_client(recipient)
+        self.server.deliver_offline()
+        self.assertEqual(self.offline_texts(), ["kept"])
+
+    def deliver_all(self, recipient, client_sock):
+        """Метод доставки всей очереди, возвращает тексты принятых сообщений."""
+        for _ in range(10):
+            self.server.deliver_offline()
+            recipient.flush()
+        messages = MessageDecoder(True).feed(client_sock.recv(65536))
+        return [message[MESSAGE_TEXT] for message in messages]
+
+    @mock.patch("server.core.OFFLINE_BATCH_SIZE", 2)
+    def test_live_during_delivery(self):
+        """Новое сообщение во время доставки приходит после отложенных."""
+        self.sender, _ = self.connect("sender")
+        for number in range(3):
+            self.store(f"m{number}")
+        recipient, client_sock = self.connect("recipient")
+        self.server.start_offline_delivery(recipient)
+        self.server.deliver_offline()
+        self.store("live")
+        self.assertNotIn(b"live", recipient.outbuf)
+        self.assertEqual(
+            self.deliver_all(recipient, client_sock), ["m0", "m1", "m2", "live"]
+        )
+        self.assertEqual(self.offline_texts(), [])
+        self.assertEqual(self.server.offline_delivery, dict())
+
+    @mock.patch("server.core.OFFLINE_LOGIN_LIMIT", 2)
+    def test_live_after_limit(self):
+        """После предела за вход новое сообщение ждёт оставшиеся в очереди."""
+        self.sender, _ = self.connect("sender")
+        for number in range(3):
+            self.store(f"m{number}")
+        recipient, client_sock = self.connect("recipient")
+        self.server.start_offline_delivery(recipient)
+        self.assertEqual(self.deliver_all(recipient, client_sock), ["m0", "m1"])
+        self.assertEqual(self.offline_texts(), ["m2"])
+        self.assertFalse(self.server.offline_ready())
+        self.store("live")
+        self.assertEqual(self.offline_texts(), ["m2", "live"])
+        self.assertTrue(self.server.offline_ready())
+        self.assertEqual(self.deliver_all(recipient, client_sock), ["m2", "live"])
+        self.assertEqual(self.offline_texts(), [])
+
+    def test_dropped_batch(self):
+        """Порция, отброшенная политикой drop, отправляется позже."""
+        self.sender, _ = self.connect("sender")
+        self.store("late")
+        recipient = DroppingConnection()
+        self.server.sessions.add(recipient)
+        self.server.sessions.authenticate(recipient, "recipient")
+        self.server.start_offline_delivery(recipient)
+        self.server.deliver_offline()
+        self.assertEqual(recipient.data, b"")
+        self.assertEqual(self.offline_texts(), ["late"])
+        recipient.paused = False
+        self.server.deliver_offline()
+        self.server.deliver_offline()
+        self.assertEqual(self.offline_texts(), [])
+        messages = MessageDecoder(True).feed(recipient.data)
+        self.assertEqual([m[MESSAGE_TEXT] for m in messages], ["late"])
+
+
+class TestResumeToken(unittest.TestCase):
+    """Тесты токена восстановления сессии."""
+
+    def setUp(self):
+        self.database = MemoryStorage()
+        for name in ("user", "other"):
+            self.database.add_user(name, b"hash")
+        self.server = MessageProcessor("127.0.0.1", 7777, self.database)
+        self.addCleanup(close_server, self.server)
+
+    def test_accept(self):
+        """Выданный токен принимается для того же пользователя один раз."""
+        token = self.server.resume_token("user")
+        self.assertFalse(self.server.check_resume_token("other", token))
+        self.assertTrue(self.server.check_resume_token("user", token))
+        self.assertFalse(self.server.check_resume_token("user", token))
+
+    def test_rotated(self):
+        """Новый токен делает недействительным выданный ранее."""
+        old = self.server.resume_token("user")
+        token = self.server.resume_token("user")
+        self.assertFalse(self.server.check_resume_token("user", old))
+        self.assertTrue(self.server.check_resume_token("user", token))
+
+    def test_expired(self):
+        """Токен с истёкшим сроком не принимается, даже с верной подписью."""
+        _, nonce, _ = self.server.resume_token("user").split(":")
+        expires = str(int(time.time()) - 1)
+        signature = self.server.resume_signature("user", expires, nonce)
+        token = f"{expires}:{nonce}:{signature}"
+        self.assertFalse(self.server.check_resume_token("user", token))
+
+    def test_bad_token(self):
+        """Токен с чужой подписью или без разделителя не принимается."""
+        token = self.server.resume_token("user")
+        expires, nonce, signature = token.split(":")
+        expires = str(int(expires) + 1)
+        self.assertFalse(
+            self.server.check_resume_token("user", f"{expires}:{nonce}:{signature}")
+        )
+        self.assertFalse(self.server.check_resume_token("user", signature))
+        self.assertFalse(self.server.check_resume_token("user", None))
+        # Отклонённые токены не расходуют выданный.
+        self.assertTrue(self.server.check_resume_token("user", token))
+
+    def test_removed_user(self):
+        """Удаление пользователя делает его токены недействительными."""
+        token = self.server.resume_token("user")
+        self.database.remove_user("user")
+        self.assertFalse(self.server.check_resume_token("user", token))
+
+    def presence(self, token, key="key"):
+        """Метод отправки presence с токеном, возвращает соединение и сокет клиента."""
+        server_sock, client_sock = socket.socketpair()
+        self.addCleanup(server_sock.close)
+        self.addCleanup(client_sock.close)
+        client_sock.settimeout(1)
+        connection = ClientConnection(server_sock, self.server, ("127.0.0.1", 0))
+        self.server.sessions.add(connection)
+        message = {
+            ACTION: PRESENCE,
+            TIME: 1,
+            USER: {ACCOUNT_NAME: "user", PUBLIC_KEY: key},
+            FRAMING: True,
+            RESUME_TOKEN: token,
+        }
+        self.server.autorize_user(message, connection)
+        return connection, client_sock
+
+    def test_resume_session(self):
+        """С верным токеном пользователь входит без запроса 511."""
+        connection, client_sock = self.presence(self.server.resume_token("user"))
+        self.assertIsNone(connection.auth_pending)
+        self.assertIs(self.server.names.get("user"), connection)
+        # Ответ содержит новый токен взамен использованного.
+        connection.flush()
+        (response,) = MessageDecoder(True).feed(client_sock.recv(65536))
+        self.assertEqual(response[RESPONSE], 200)
+        self.assertTrue(self.server.check_resume_token("user", response[RESUME_TOKEN]))
+
+    def test_resume_keeps_key(self):
+        """При восстановлении сессии ключ из сообщения не заменяет сохранённый."""
+        self.database.user_login("user", "127.0.0.1", 7777, "key")
+        self.database.user_logout("user")
+        connection, _ = self.presence(self.server.resume_token("user"), "forged")
+        self.assertIs(self.server.names.get("user"), connection)
+        self.assertEqual(self.database.get_pubkey("user"), "key")
+
+    def test_replay(self):
+        """Повторно предъявленный токен требует обычной авторизации."""
+        token = self.server.resume_token("user")
+        first, _ = self.presence(token)
+        self.server.remove_client(first)
+        second, _ = self.presence(token)
+        self.assertNotIn("user", self.server.names)
+        self.assertIsNotNone(second.auth_pending)
+
+    def test_resume_rejected(self):
+        """С неверным токеном пользователь входит по ответу на запрос 511."""
+        connection, client_sock = self.presence("1:bad")
+        self.assertNotIn("user", self.server.names)
+        connection.flush()
+        (request,) = MessageDecoder(True).feed(client_sock.recv(65536))
+        self.assertEqual(request[RESPONSE], 511)
+        digest = hmac.new(b"hash", request[DATA].encode(ENCODING), "md5").digest()
+        answer = {RESPONSE: 511, DATA: binascii.b2a_base64(digest).decode("ascii")}
+        self.server.handle_message(answer, connection)
+        self.assertIs(self.server.names.get("user"), connection)
+
+
+class TestHandshake(unittest.TestCase):
+    """Тесты авторизации клиента."""
+
+    def setUp(self):
+        self.database = MemoryStorage()
+        self.database.add_user("user", b"hash")
+        self.server = MessageProcessor(
+            "127.0.0.1", 7777, self.database, handshake_timeout=60
+        )
+        self.addCleanup(close_server, self.server)
+
+    def connect(self):
+        """Метод создания неавторизованного соединения."""
+        server_sock, client_sock = socket.socketpair()
+        self.addCleanup(server_sock.close)
+        self.addCleanup(client_sock.close)
+        connection = ClientConnection(server_sock, self.server, ("127.0.0.1", 0))
+        self.server.sessions.add(connection)
+        return connection
+
+    def test_deadline(self):
+        """Клиент, не авторизовавшийся вовремя, отключается."""
+        late = self.connect()
+        late.auth_deadline = time.monotonic() - 1
+        waiting = self.connect()
+        self.server.check_handshakes()
+        self.assertNotIn(late, self.server.sessions)
+        self.assertIn(waiting, self.server.sessions)
+
+    def test_stale_user(self):
+        """Если запись пользователя устарела, вход отклоняется, а не роняет сервер."""
+
+        def user_login(*args):
+            raise ValueError("Пользователь не зарегистрирован.")
+
+        self.database.user_login = user_login
+        connection = self.connect()
+        message = {ACTION: PRESENCE, TIME: 1}
+        message[USER] = {ACCOUNT_NAME: "user", PUBLIC_KEY: "key"}
+        self.server.login_user(message, connection)
+        self.assertNotIn(connection, self.server.sessions)
+        self.assertNotIn("user", self.server.names)
+        self.assertEqual(self.database.active_users_list(), [])
+
+    def test_send_failed(self):
+        """Если ответ 200 не отправлен, клиент отключается без доставки."""
+        self.server.high_watermark = 0
+        self.server.slow_policy = "disconnect"
+        connection = self.connect()
+        connection.decoder.framed = True
+        message = {ACTION: PRESENCE, TIME: 1, OFFLINE: True}
+        message[USER] = {ACCOUNT_NAME: "user", PUBLIC_KEY: "key"}
+        self.server.login_user(message, connection)
+        self.assertNotIn(connection, self.server.sessions)
+        self.assertNotIn("user", self.server.names)
+        self.assertEqual(self.server.offline_delivery, {})
+
+
+class TestRouter(unittest.TestCase):
+    """Тесты связи рабочих процессов сервера."""
+
+    def setUp(self):
+        # Очереди процессов заменены очередями потоков.
+        self.inboxes = [queue.Queue(), queue.Queue()]
+        self.status = queue.Queue()
+        self.database = MemoryStorage()
+        for name in ("sender", "user"):
+            self.database.add_user(name, b"hash")
+        self.routers = []
+        self.servers = []
+        for number in range(2):
+            router = Router(number, self.inboxes, self.status)
+            server = MessageProcessor("127.0.0.1", 7777, self.database, router=router)
+            self.addCleanup(close_server, server)
+            router.processor = server
+            self.routers.append(router)
+            self.servers.append(server)
+
+    def events(self, events_queue):
+        """Метод возвращающий события из очереди."""
+        events = []
+        while not events_queue.empty():
+            events.append(events_queue.get_nowait())
+        return events
+
+    def connect(self, server, name):
+        """Метод создания авторизованного соединения, возвращает его и сокет клиента."""
+        server_sock, client_sock = socket.socketpair()
+        self.addCleanup(server_sock.close)
+        self.addCleanup(client_sock.close)
+        client_sock.settimeout(1)
+        connection = ClientConnection(server_sock, server, ("127.0.0.1", 0))
+        server.sessions.add(connection)
+        server.sessions.authenticate(connection, name)
+        return connection, client_sock
+
+    def test_announce(self):
+        """Вход и выход рассылаются остальным процессам и главному процессу."""
+        self.routers[0].announce_login("user", "127.0.0.1", 1)
+        self.assertEqual(self.routers[0].owner("user"), 0)
+        self.assertEqual(self.events(self.inboxes[0]), [])
+        (event,) = self.events(self.inboxes[1])
+        self.assertEqual(event[:5], (LOGIN, "user", 0, "127.0.0.1", 1))
+        self.assertEqual(self.events(self.status), [event])
+        self.routers[0].announce_logout("user")
+        self.assertIsNone(self.routers[0].owner("user"))
+        self.assertEqual(self.events(self.inboxes[1]), [(LOGOUT, "user", 0)])
+        self.assertEqual(self.events(self.status), [(LOGOUT, "user", 0)])
+
+    def test_forward(self):
+        """Сообщение передаётся только процессу, к которому подключён получатель."""
+        message = {ACTION: MESSAGE, SENDER: "sender", DESTINATION: "user"}
+        self.assertFalse(self.routers[0].forward(message))
+        self.routers[0].directory["user"] = 0
+        self.assertFalse(self.routers[0].forward(message))
+        self.routers[0].directory["user"] = 1
+        self.assertTrue(self.routers[0].forward(message))
+        self.assertEqual(self.events(self.inboxes[1]), [(FORWARD, message)])
+
+    def test_events(self):
+        """Поток связи применяет события других процессов к своему серверу."""
+        connection, client_sock = self.connect(self.servers[1], "user")
+        message = {
+            ACTION: MESSAGE,
+            SENDER: "sender",
+            DESTINATION: "user",
+            TIME: 1,
+            MESSAGE_TEXT: "text",
+        }
+        for event in (
+            (LOGIN, "sender", 0, "127.0.0.1", 1, None),
+            (FORWARD, message),
+            (UPDATE_LISTS,),
+            (KICK, "user"),
+            (STOP,),
+        ):
+            self.inboxes[1].put(event)
+        self.routers[1].start()
+        self.routers[1].join(5)
+        self.assertFalse(self.routers[1].is_alive())
+        self.assertFalse(self.servers[1].running)
+        self.assertEqual(self.routers[1].owner("sender"), 0)
+        # Переданное сообщение отправлено до отключения пользователя.
+        data = b""
+        while True:
+            chunk = client_sock.recv(MAX_PACKAGE_LENGTH)
+            if not chunk:
+                break
+            data += chunk
+        (received,) = MessageDecoder().feed(data)
+        self.assertEqual(received[MESSAGE_TEXT], "text")
+        self.assertNotIn("user", self.servers[1].names)
+        self.assertEqual(self.events(self.inboxes[0]), [(LOGOUT, "user", 1)])
+
+    def test_cross_worker_message(self):
+        """Сообщение пользователю другого процесса доставляется через его очередь."""
+        sender, _ = self.connect(self.servers[0], "sender")
+        recipient, client_sock = self.connect(self.servers[1], "user")
+        self.routers[0].directory["user"] = 1
+        message = {
+            ACTION: MESSAGE,
+            SENDER: "sender",
+            DESTINATION: "user",
+            TIME: 1,
+            MESSAGE_TEXT: "text",
+        }
+        self.servers[0].on_message(message, sender)
+        self.assertEqual(self.database.get_offline_messages("user", 10), [])
+        self.inboxes[1].put((STOP,))
+        self.routers[1].start()
+        self.routers[1].join(5)
+        recipient.flush()
+        (received,) = MessageDecoder().feed(client_sock.recv(MAX_PACKAGE_LENGTH))
+        self.assertEqual(received[MESSAGE_TEXT], "text")
+
+
+class TestWorkerPool(unittest.TestCase):
+    """Тесты пула рабочих процессов без запуска процессов."""
+
+    def setUp(self):
+        self.database = MemoryStorage()
+        self.pool = WorkerPool(2, {"stats_interval": 60}, self.database)
+        self.pool.processes = []
+
+    def test_sessions(self):
+        """События входа и выхода ведут справочник и список активных."""
+        self.pool.status.put((LOGIN, "user", 1, "127.0.0.1", 1, None))
+        self.pool.start()
+        for _ in range(50):
+            if self.database.active_users_list():
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.pool.names, {"user": 1})
+        self.assertEqual(
+            self.database.active_users_list(), [("user", "127.0.0.1", 1, None)]
+        )
+        # Выход из другого процесса не отменяет вход в процессе 1.
+        self.pool.status.put((LOGOUT, "user", 0))
+        self.pool.status.put((LOGOUT, "user", 1))
+        for _ in range(50):
+            if not self.database.active_users_list():
+                break
+            time.sleep(0.1)
+        self.pool.running = False
+        self.pool.join(5)
+        self.assertEqual(self.pool.names, dict())
+        self.assertEqual(self.database.active_users_list(), [])
+        self.assertEqual(self.pool.inboxes[0].get(timeout=1), (STOP,))
+
+    def test_kick(self):
+        """Отключение пользователя передаётся только его процессу."""
+        self.pool.names["user"] = 1
+        self.pool.kick_user("user")
+        self.pool.kick_user("nobody")
+        self.assertEqual(self.pool.inboxes[1].get(timeout=1), (KICK, "user"))
+        self.assertTrue(self.pool.inboxes[0].empty())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,234 @@
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.getcwd(), ".."))
+from server.database import ServerStorage
+from server.memory_storage import MemoryStorage
+from server.storage import Storage
+
+# Каталог с базой SQLite для тестов ServerStorage
+TEMP_DIR = tempfile.mkdtemp()
+# Отображения таблиц создаются один раз за процесс, поэтому база одна
+# на все тесты и очищается перед каждым.
+SERVER_STORAGE = None
+
+
+def tearDownModule():
+    if SERVER_STORAGE is not None:
+        SERVER_STORAGE.session.close()
+        SERVER_STORAGE.database_engine.dispose()
+        SERVER_STORAGE.reader_engine.dispose()
+    shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+
+class TestStorageInterface(unittest.TestCase):
+    """Тесты абстрактного интерфейса хранилища."""
+
+    def test_abstract(self):
+        """Интерфейс и хранилище без обязательных методов не создаются."""
+
+        class PartialStorage(Storage):
+            def user_record(self, name):
+                return None
+
+        with self.assertRaises(TypeError):
+            Storage()
+        with self.assertRaises(TypeError):
+            PartialStorage()
+
+
+class StorageContract:
+    """
+    Проверки, общие для всех хранилищ данных сервера.
+    Наследник задаёт метод make_storage, создающий пустое хранилище.
+    """
+
+    def setUp(self):
+        self.storage = self.make_storage()
+        self.storage.add_user("user", b"hash")
+        self.storage.add_user("contact", b"hash")
+
+    def test_users(self):
+        """Зарегистрированный пользователь есть в списке и его можно удалить."""
+        self.assertTrue(self.storage.check_user("user"))
+        self.assertFalse(self.storage.check_user("nobody"))
+        self.assertEqual(self.storage.get_hash("user"), b"hash")
+        self.assertIsNone(self.storage.get_pubkey("user"))
+        self.assertEqual(
+            [name for name, _ in self.storage.users_list()], ["user", "contact"]
+        )
+        self.storage.remove_user("contact")
+        self.assertFalse(self.storage.check_user("contact"))
+        self.assertEqual([name for name, _ in self.storage.users_list()], ["user"])
+
+    def test_add_users(self):
+        """Пакетная регистрация пропускает уже зарегистрированных."""
+        self.assertEqual(self.storage.add_users([]), 0)
+        self.assertEqual(self.storage.add_users([("a", b"1"), ("b", b"2")]), 2)
+        self.assertEqual(self.storage.add_users([("b", b"2"), ("c", b"3")]), 1)
+        self.assertEqual(self.storage.get_hash("c"), b"3")
+        self.assertEqual(len(self.storage.users_list()), 5)
+
+    def test_users_changes(self):
+        """Изменения справочника возвращаются после известной версии."""
+        version = self.storage.users_version()
+        self.storage.add_user("new", b"hash")
+        self.storage.remove_user("contact")
+        current, added, removed = self.storage.users_changes(version)
+        self.assertEqual(current, self.storage.users_version())
+        self.assertGreater(current, version)
+        self.assertEqual((added, removed), (["new"], ["contact"]))
+        self.assertEqual(self.storage.users_changes(current), (current, [], []))
+        self.assertIsNone(self.storage.users_changes(current + 1))
+
+    def test_login(self):
+        """Вход записывается в историю и список активных пользователей."""
+        with self.assertRaises(ValueError):
+            self.storage.user_login("nobody", "127.0.0.1", 7777, "key")
+        self.storage.user_login("user", "127.0.0.1", 7777, "key")
+        self.assertEqual(self.storage.get_pubkey("user"), "key")
+        self.assertEqual(
+            [row[:3] for row in self.storage.active_users_list()],
+            [("user", "127.0.0.1", 7777)],
+        )
+        history = self.storage.login_history("user")
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history[0][0], "user")
+        self.assertEqual(history[0][2:], ("127.0.0.1", "7777"))
+        self.storage.user_logout("user")
+        self.assertEqual(self.storage.active_users_list(), [])
+        self.storage.flush()
+
+    def test_resume_nonce(self):
+        """Метка токена используется один раз, новая заменяет прежнюю."""
+        self.assertFalse(self.storage.take_resume_nonce("user", None))
+        self.storage.set_resume_nonce("user", "old")
+        self.storage.set_resume_nonce("user", "new")
+        self.assertFalse(self.storage.take_resume_nonce("user", "old"))
+        self.assertFalse(self.storage.take_resume_nonce("contact", "new"))
+        self.assertTrue(self.storage.take_resume_nonce("user", "new"))
+        self.assertFalse(self.storage.take_resume_nonce("user", "new"))
+        self.storage.set_resume_nonce("user", "next")
+        self.storage.remove_user("user")
+        self.assertFalse(self.storage.take_resume_nonce("user", "next"))
+
+    def test_contacts(self):
+        """Контакт добавляется один раз, неизвестный пользователь пропускается."""
+        self.storage.add_contact("user", "contact")
+        self.storage.add_contact("user", "contact")
+        self.storage.add_contact("user", "nobody")
+        self.assertEqual(self.storage.get_contacts("user"), ["contact"])
+        self.storage.remove_contact("user", "contact")
+        self.assertEqual(self.storage.get_contacts("user"), [])
+
+    def test_offline_messages(self):
+        """Сообщения выдаются по порядку, повтор по идентификатору не сохраняется."""
+        for number in range(3):
+            self.assertTrue(
+                self.storage.store_offline_message(
+                    "user", "contact", {"text": number}, f"id{number}"
+                )
+            )
+        self.assertFalse(
+            self.storage.store_offline_message("user", "contact", {"text": 0}, "id0")
+        )
+        self.assertTrue(
+            self.storage.store_offline_message("contact", "contact", {}, "id0")
+        )
+        rows = self.storage.get_offline_messages("contact", 2)
+        self.assertEqual([message for _, message in rows], [{"text": 0}, {"text": 1}])
+        self.storage.remove_offline_messages([row_id for row_id, _ in rows])
+        rows = self.storage.get_offline_messages("contact", 10)
+        self.assertEqual([message for _, message in rows], [{"text": 2}, {}])
+        self.assertEqual(self.storage.get_offline_messages("user", 10), [])
+
+    def test_statistics(self):
+        """Статистика учитывает сообщения до и после записи в хранилище."""
+        self.storage.process_message("user", "contact")
+        self.storage.process_message("user", "contact")
+        expected = {"user": (2, 0), "contact": (0, 2)}
+        history = self.storage.message_history()
+        self.assertEqual({row[0]: row[2:] for row in history}, expected)
+        self.storage.flush()
+        history = self.storage.message_history()
+        self.assertEqual({row[0]: row[2:] for row in history}, expected)
+        now = datetime.datetime.now()
+        hour = datetime.timedelta(hours=1)
+        self.assertEqual(
+            self.storage.top_senders(now - hour, now + hour)[0], ("user", 2, 0)
+        )
+        self.assertEqual(
+            sum(
+                count
+                for _, count in self.storage.message_throughput(now - hour, now + hour)
+            ),
+            2,
+        )
+
+
+class TestMemoryStorage(StorageContract, unittest.TestCase):
+    """Проверки хранилища в памяти процесса."""
+
+    def make_storage(self):
+        return MemoryStorage()
+
+
+class TestServerStorage(StorageContract, unittest.TestCase):
+    """Проверки хранилища в базе SQLite."""
+
+    def make_storage(self):
+        global SERVER_STORAGE
+        if SERVER_STORAGE is None:
+            SERVER_STORAGE = ServerStorage(os.path.join(TEMP_DIR, "server.db3"))
+        storage = SERVER_STORAGE
+        for table in reversed(storage.metadata.sorted_tables):
+            storage.session.execute(table.delete())
+        storage.session.commit()
+        storage.users_cache.clear()
+        # Сбрасываем данные в памяти: статистику и активных пользователей.
+        Storage.__init__(storage)
+        return storage
+
+    def race_read(self, change):
+        """
+        Читает запись пользователя мимо кэша, выполняя change после
+        чтения строки из базы, но до записи результата в кэш.
+        """
+        storage = self.storage
+        execute = storage.execute
+
+        def racing_execute(session, statement, params):
+            row = execute(session, statement, params).first()
+            storage.execute = execute
+            change()
+            return mock.Mock(**{"first.return_value": row})
+
+        storage.forget_user("user")
+        storage.execute = racing_execute
+        self.addCleanup(setattr, storage, "execute", execute)
+        return storage.user_record("user")
+
+    def test_cache_login_race(self):
+        """Прочитанная до входа запись не затирает в кэше новый ключ."""
+        record = self.race_read(
+            lambda: self.storage.user_login("user", "127.0.0.1", 7777, "key")
+        )
+        self.assertIsNone(record.pubkey)
+        self.assertEqual(self.storage.users_cache["user"].pubkey, "key")
+        self.assertEqual(self.storage.get_pubkey("user"), "key")
+
+    def test_cache_remove_race(self):
+        """Прочитанная до удаления запись не попадает в кэш."""
+        record = self.race_read(lambda: self.storage.remove_user("user"))
+        self.assertIsNotNone(record)
+        self.assertNotIn("user", self.storage.users_cache)
+        self.assertFalse(self.storage.check_user("user"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,520 @@
+import asyncio
+import binascii
+import collections
+import errno
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import random
+import socket
+import time
+
+from common.errors import ServerError
+from common.utils import MessageDecoder, encode_message
+from common.variables import *
+
+# Логер
+logger = logging.getLogger("client")
+# Время ожидания подключения и ответа сервера на запрос в секундах
+CONNECT_TIMEOUT = 5
+REQUEST_TIMEOUT = 5
+# Попыток подключения при запуске клиента
+CONNECT_ATTEMPTS = 5
+# Начальная и наибольшая задержка перед повторным подключением в секундах
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+
+def backoff_delay(attempt):
+    """
+    Функция задержки перед попыткой подключения номер attempt (с нуля).
+    Предел задержки удваивается с каждой попыткой, а сама задержка
+    выбирается случайно от нуля до него, чтобы клиенты, одновременно
+    потерявшие связь при перезапуске сервера, не подключались разом.
+    """
+    return random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2**attempt))
+
+
+async def wait_for(awaitable, timeout):
+    """
+    Функция ожидания с таймаутом. По истечении таймаута генерирует
+    socket.timeout, поэтому все ошибки связи с сервером - OSError.
+    """
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise socket.timeout("Сервер не ответил вовремя.")
+
+
+def connection_reset():
+    """Функция создания исключения потери соединения с сервером."""
+    return ConnectionResetError(errno.ECONNRESET, "Потеряно соединение с сервером.")
+
+
+class AsyncClient:
+    """
+    Класс - клиент мессенджера на asyncio без графического интерфейса.
+    Выполняет подключение и авторизацию, запросы к серверу и приём
+    сообщений. Один цикл событий может обслуживать тысячи клиентов,
+    поэтому класс подходит для ботов, интеграционных тестов и генераторов
+    нагрузки, а транспорт графического клиента работает поверх него.
+
+    Запросы получают идентификатор, который сервер повторяет в ответе,
+    поэтому одновременно может выполняться несколько запросов. Сообщения,
+    присланные сервером самостоятельно, передаются обработчикам:
+    on_message - сообщения пользователей, on_users_changed - 205. Если
+    обработчик on_message не задан, сообщения выдаёт асинхронный итератор
+    messages(). Обработчик может быть функцией или корутиной, корутина
+    выполняется отдельной задачей.
+
+    При reconnect=True после разрыва соединения клиент переподключается
+    в фоне и восстанавливает сессию по токену, выданному сервером, вызывая
+    on_reconnecting и on_reconnected. Если сервер отказал во входе или
+    переподключение выключено, вызывается on_connection_lost.
+    Все ошибки связи с сервером - OSError, ответ 400 - ServerError.
+    """
+
+    def __init__(self, username, password, pubkey="", reconnect=False):
+        # Имя пользователя, пароль и публичный ключ, передаваемый серверу
+        self.username = username
+        self.password = password
+        self.pubkey = pubkey
+        # Хэш пароля для ответа на запрос 511, вычисляется при подключении
+        self.passwd_hash = None
+        # Адрес и порт сервера, потоки чтения и записи соединения
+        self.ip_address = None
+        self.port = None
+        self.reader = None
+        self.writer = None
+        # Передаются ли сообщения с заголовком длины (согласуется при входе),
+        # буфер сборки входящих и разобранные, но не прочитанные сообщения.
+        self.framed = False
+        self.decoder = MessageDecoder()
+        self.received = collections.deque()
+        # Токен восстановления сессии, выданный сервером при входе
+        self.resume_token = None
+        # Запросы, ожидающие ответа: идентификатор - Future, в порядке
+        # отправки, и счётчик идентификаторов запросов.
+        self.pending = dict()
+        self.request_ids = itertools.count(1)
+        # Задачи чтения сокета и переподключения
+        self.reader_task = None
+        self.reconnect_task = None
+        # Флаги открытого соединения, переподключения и завершения работы
+        self.connected = False
+        self.auto_reconnect = reconnect
+        self.closing = False
+        # Сообщения пользователей для итератора messages(), None - конец.
+        # Очередь создаётся в работающем цикле событий, см. inbox.
+        self.messages_queue = None
+        # Обработчики событий
+        self.on_message = None
+        self.on_users_changed = None
+        self.on_reconnecting = None
+        self.on_reconnected = None
+        self.on_connection_lost = None
+
+    @property
+    def inbox(self):
+        """
+        Очередь сообщений для итератора messages(). В Python до 3.10
+        очередь привязывается к циклу событий при создании, поэтому
+        создаётся при первом обращении из работающего цикла, а не в
+        конструкторе.
+        """
+        if self.messages_queue is None:
+            self.messages_queue = asyncio.Queue()
+        return self.messages_queue
+
+    async def connect(self, ip_address, port, attempts=CONNECT_ATTEMPTS):
+        """
+        Метод подключения и авторизации на сервере.
+        Выполняет до attempts попыток подключения с растущей задержкой.
+        Если подключиться или авторизоваться не удалось, генерирует
+        ServerError.
+        """
+        self.ip_address = ip_address
+        self.port = port
+        # Хэш пароля вычисляется долго, поэтому до подключения, чтобы не
+        # задерживать авторизацию, и в пуле потоков, чтобы не задерживать
+        # остальных клиентов цикла событий.
+        if self.passwd_hash is None:
+            self.passwd_hash = await asyncio.get_running_loop().run_in_executor(
+                None, self.password_hash
+            )
+        for attempt in range(attempts):
+            logger.info(f"Попытка подключения №{attempt + 1}")
+            try:
+                await self.open()
+            except OSError:
+                if attempt < attempts - 1:
+                    await asyncio.sleep(backoff_delay(attempt))
+                continue
+            break
+        # Если соединится не удалось - исключение
+        else:
+            logger.critical("Не удалось установить соединение с сервером")
+            raise ServerError("Не удалось установить соединение с сервером")
+
+        try:
+            await self.login()
+        except ServerError:
+            self.writer.close()
+            raise
+        except (OSError, json.JSONDecodeError, TypeError, UnicodeDecodeError):
+            self.writer.close()
+            raise ServerError("Сбой соединения в процессе авторизации.")
+
+    async def open(self):
+        """Метод открытия соединения с сервером."""
+        self.reader, self.writer = await wait_for(
+            asyncio.open_connection(self.ip_address, self.port), CONNECT_TIMEOUT
+        )
+        logger.debug("Установлено соединение с сервером")
+
+    async def login(self):
+        """
+        Метод авторизации на сервере и запуска задачи чтения сокета.
+        Если сервер выдал токен при прошлом входе, он передаётся в
+        presence, и при верном токене сервер сразу отвечает 200 без
+        запроса 511, поэтому хэш пароля не вычисляется. Ответ на
+        presence с токеном передаётся с заголовком длины. Ответ 400
+        вызывает ServerError, ошибки соединения передаются вызывающему.
+        """
+        presence = {
+            ACTION: PRESENCE,
+            TIME: time.time(),
+            USER: {ACCOUNT_NAME: self.username, PUBLIC_KEY: self.pubkey},
+            FRAMING: True,
+            OFFLINE: True,
+        }
+        if self.resume_token:
+            presence[RESUME_TOKEN] = self.resume_token
+        self.set_framing(bool(self.resume_token))
+        # Приветственное сообщение всегда передаётся без заголовка длины.
+        self.writer.write(encode_message(presence))
+        ans = await wait_for(self.read_message(), REQUEST_TIMEOUT)
+        if RESPONSE in ans and ans[RESPONSE] == 511:
+            # Токена нет или он не принят, продолжаем процедуру
+            # авторизации. Старый сервер не подтверждает режим
+            # с заголовком длины, тогда работаем без него.
+            self.set_framing(bool(ans.get(FRAMING)))
+            digest = hmac.new(
+                self.passwd_hash, ans[DATA].encode("utf-8"), AUTH_DIGEST
+            ).digest()
+            my_ans = dict(RESPONSE_511)
+            my_ans[DATA] = binascii.b2a_base64(digest).decode("ascii")
+            self.writer.write(encode_message(my_ans, self.framed))
+            ans = await wait_for(self.read_message(), REQUEST_TIMEOUT)
+        # Если сервер вернул ошибку, бросаем исключение.
+        if ans.get(RESPONSE) == 400:
+            raise ServerError(f"{ans[ERROR]}")
+        if ans.get(RESPONSE) != 200:
+            raise TypeError
+        self.resume_token = ans.get(RESUME_TOKEN)
+
+        # Отложенные сообщения сервер присылает сразу после входа, их
+        # примет задача чтения.
+        self.connected = True
+        self.reader_task = asyncio.ensure_future(self.read_loop())
+
+    def password_hash(self):
+        """Метод вычисления хэша пароля для ответа на запрос 511."""
+        passwd_bytes = self.password.encode("utf-8")
+        salt = self.username.lower().encode("utf-8")
+        passwd_hash = hashlib.pbkdf2_hmac("sha512", passwd_bytes, salt, 10000)
+        return binascii.hexlify(passwd_hash)
+
+    def set_framing(self, framed):
+        """Метод выбора режима передачи сообщений соединения."""
+        self.framed = framed
+        self.decoder = MessageDecoder(framed)
+        self.received.clear()
+
+    async def read_message(self):
+        """Метод чтения следующего сообщения сервера."""
+        while not self.received:
+            data = await self.reader.read(MAX_PACKAGE_LENGTH)
+            if not data:
+                raise connection_reset()
+            self.received.extend(self.decoder.feed(data))
+        return self.received.popleft()
+
+    async def read_loop(self):
+        """
+        Корутина задачи чтения сокета.
+        Ответы передаёт ожидающим их запросам, остальные сообщения -
+        обработчикам. При закрытии соединения ожидающие запросы
+        завершаются ошибкой, а клиент переподключается или сообщает о
+        потере соединения.
+        """
+        logger.debug("Запущена задача - приёмник сообщений с сервера.")
+        try:
+            while True:
+                message = await self.read_message()
+                logger.debug(f"Принято сообщение с сервера: {message}")
+                if RESPONSE in message and message[RESPONSE] != 205:
+                    self.resolve(message)
+                else:
+                    self.dispatch(message)
+        except (OSError, json.JSONDecodeError, TypeError, UnicodeDecodeError):
+            pass
+
+        self.connected = False
+        self.writer.close()
+        pending = list(self.pending.values())
+        self.pending.clear()
+        for future in pending:
+            if not future.done():
+                future.set_exception(connection_reset())
+        if self.closing:
+            return
+        logger.warning(f"Потеряно соединение с сервером.")
+        if self.auto_reconnect:
+            self.reconnect_task = asyncio.ensure_future(self.reconnect())
+        else:
+            self.lost()
+
+    async def reconnect(self):
+        """
+        Корутина восстановления соединения после разрыва.
+        Повторяет подключение со случайной задержкой, растущей с каждой
+        попыткой, пока оно не удастся или клиент не будет закрыт.
+        """
+        self.notify(self.on_reconnecting)
+        attempt = 0
+        while True:
+            await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+            logger.info(f"Попытка переподключения №{attempt}")
+            try:
+                await self.open()
+            except OSError:
+                continue
+            try:
+                await self.login()
+            except ServerError as err:
+                logger.critical(f"Сервер отказал во входе: {err}")
+                self.writer.close()
+                self.lost()
+                return
+            except (OSError, json.JSONDecodeError, TypeError, UnicodeDecodeError):
+                self.writer.close()
+                continue
+            break
+        logger.info("Соединение с сервером восстановлено.")
+        self.notify(self.on_reconnected)
+
+    def lost(self):
+        """Метод завершения работы клиента после потери соединения."""
+        self.closing = True
+        self.inbox.put_nowait(None)
+        self.notify(self.on_connection_lost)
+
+    def resolve(self, ans):
+        """
+        Метод передачи ответа сервера ожидающему его запросу.
+        Старый сервер не повторяет идентификатор запроса, но отвечает
+        по порядку, поэтому ответ без идентификатора относится к самому
+        раннему из ожидающих запросов.
+        """
+        if REQUEST_ID in ans:
+            future = self.pending.pop(ans[REQUEST_ID], None)
+        elif self.pending:
+            future = self.pending.pop(next(iter(self.pending)))
+        else:
+            future = None
+        if future is None:
+            logger.error(f"Принят ответ на неизвестный запрос: {ans}")
+        # Запрос мог не дождаться ответа и быть отменён.
+        elif not future.done():
+            future.set_result(ans)
+
+    def dispatch(self, message):
+        """Метод передачи обработчикам сообщений, присланных сервером."""
+        if message.get(RESPONSE) == 205:
+            self.notify(self.on_users_changed, message)
+        elif (
+            ACTION in message
+            and message[ACTION] == MESSAGE
+            and SENDER in message
+            and DESTINATION in message
+            and MESSAGE_TEXT in message
+            and message[DESTINATION] == self.username
+        ):
+            logger.debug(
+                f"Получено сообщение от пользователя {message[SENDER]}:{message[MESSAGE_TEXT]}"
+            )
+            if self.on_message is None:
+                self.inbox.put_nowait(message)
+            else:
+                self.notify(self.on_message, message)
+        else:
+            logger.error(f"Принято некорректное сообщение с сервера: {message}")
+
+    def notify(self, handler, *args):
+        """
+        Метод вызова обработчика события. Ошибка обработчика
+        записывается в журнал и не прерывает работу клиента.
+        """
+        if handler is None:
+            return
+        try:
+            result = handler(*args)
+        except Exception:
+            logger.exception("Ошибка обработчика события клиента.")
+            return
+        if asyncio.iscoroutine(result):
+            asyncio.ensure_future(result).add_done_callback(self.handler_done)
+
+    @staticmethod
+    def handler_done(task):
+        """Метод записи в журнал ошибки обработчика - корутины."""
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                "Ошибка обработчика события клиента.", exc_info=task.exception()
+            )
+
+    async def messages(self):
+        """Асинхронный итератор сообщений пользователей до закрытия клиента."""
+        while True:
+            message = await self.inbox.get()
+            if message is None:
+                self.inbox.put_nowait(None)
+                return
+            yield message
+
+    async def request(self, message, timeout=REQUEST_TIMEOUT):
+        """
+        Метод отправки запроса серверу, возвращает ответ на него.
+        Если ответ не получен за timeout секунд, генерирует socket.timeout,
+        при потере соединения - ConnectionResetError. Запрос записывается
+        в сокет сразу, поэтому несколько запросов, запущенных вместе,
+        уходят серверу по порядку и выполняются одновременно.
+        """
+        if not self.connected:
+            raise connection_reset()
+        message = dict(message)
+        request_id = message[REQUEST_ID] = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(encode_message(message, self.framed))
+        try:
+            await self.writer.drain()
+        except OSError:
+            self.pending.pop(request_id, None)
+            raise
+        # Отменённый запрос остаётся в таблице до ответа сервера,
+        # опоздавший ответ не достанется следующему запросу.
+        return await wait_for(future, timeout)
+
+    @staticmethod
+    def check_response(ans, code):
+        """
+        Метод проверки кода ответа сервера. Ответ 400 и неожиданный
+        код вызывают ServerError.
+        """
+        if ans.get(RESPONSE) == code:
+            return ans
+        if ans.get(RESPONSE) == 400:
+            raise ServerError(f"{ans[ERROR]}")
+        raise ServerError(f"Принят неожиданный ответ сервера: {ans}")
+
+    async def send_message(self, to, message, message_id=None):
+        """
+        Метод отправки сообщения пользователю. С идентификатором
+        message_id повтор сообщения сервер не сохранит для отключённого
+        получателя дважды.
+        """
+        message_dict = {
+            ACTION: MESSAGE,
+            SENDER: self.username,
+            DESTINATION: to,
+            TIME: time.time(),
+            MESSAGE_TEXT: message,
+        }
+        if message_id is not None:
+            message_dict[MESSAGE_ID] = message_id
+        self.check_response(await self.request(message_dict), 200)
+        logger.debug(f"Отправлено сообщение для пользователя {to}")
+
+    async def get_contacts(self):
+        """Метод запроса списка контактов пользователя."""
+        req = {ACTION: GET_CONTACTS, TIME: time.time(), USER: self.username}
+        return self.check_response(await self.request(req), 202)[LIST_INFO]
+
+    async def add_contact(self, contact):
+        """Метод добавления контакта пользователя на сервере."""
+        req = {
+            ACTION: ADD_CONTACT,
+            TIME: time.time(),
+            USER: self.username,
+            ACCOUNT_NAME: contact,
+        }
+        self.check_response(await self.request(req), 200)
+
+    async def remove_contact(self, contact):
+        """Метод удаления контакта пользователя на сервере."""
+        req = {
+            ACTION: REMOVE_CONTACT,
+            TIME: time.time(),
+            USER: self.username,
+            ACCOUNT_NAME: contact,
+        }
+        self.check_response(await self.request(req), 200)
+
+    async def get_users(self):
+        """
+        Метод запроса списка известных пользователей, возвращает кортеж
+        (список, версия справочника). Старый сервер версию не передаёт,
+        тогда она None.
+        """
+        req = {ACTION: USERS_REQUEST, TIME: time.time(), ACCOUNT_NAME: self.username}
+        ans = self.check_response(await self.request(req), 202)
+        return ans[LIST_INFO], ans.get(USERS_VERSION)
+
+    async def get_users_changes(self, version):
+        """
+        Метод запроса изменений списка пользователей после версии version,
+        возвращает кортеж (новая версия, добавленные, удалённые). Если
+        сервер не знает версии version, он присылает полный список, тогда
+        добавленные - все пользователи, а удалённые - None.
+        """
+        req = {
+            ACTION: USERS_CHANGES_REQUEST,
+            TIME: time.time(),
+            ACCOUNT_NAME: self.username,
+            USERS_VERSION: version,
+        }
+        ans = await self.request(req)
+        if ans.get(RESPONSE) == 202:
+            return ans.get(USERS_VERSION), ans[LIST_INFO], None
+        self.check_response(ans, 206)
+        return ans[USERS_VERSION], ans[ADDED], ans[REMOVED]
+
+    async def key_request(self, user):
+        """Метод запроса публичного ключа пользователя."""
+        req = {ACTION: PUBLIC_KEY_REQUEST, TIME: time.time(), ACCOUNT_NAME: user}
+        return self.check_response(await self.request(req), 511)[DATA]
+
+    async def close(self):
+        """
+        Метод завершения работы клиента. Сообщает серверу о выходе,
+        закрывает соединение и завершает итератор messages().
+        """
+        self.closing = True
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+        if self.connected:
+            message = {ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: self.username}
+            # Соединение закрывается после отправки данных из буфера,
+            # сервер получит сообщение о выходе.
+            self.writer.write(encode_message(message, self.framed))
+        if self.writer is not None:
+            self.writer.close()
+        if self.reader_task is not None:
+            await self.reader_task
+        self.inbox.put_nowait(None)
+        logger.debug("Клиент завершает работу.")
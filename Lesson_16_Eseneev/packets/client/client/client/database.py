@@ -1,5 +1,6 @@
 import datetime
 import os
+import uuid
 
 from common.variables import *
 from sqlalchemy import (
@@ -11,10 +12,19 @@ from sqlalchemy import (
     Table,
     Text,
     create_engine,
+    delete,
+    select,
+    update,
 )
 from sqlalchemy.orm import mapper, sessionmaker
 from sqlalchemy.sql import default_comparator
 
+# Состояния исходящих сообщений в истории: доставлено серверу, ожидает
+# отправки, отклонено сервером.
+MESSAGE_SENT = "sent"
+MESSAGE_PENDING = "pending"
+MESSAGE_FAILED = "failed"
+
 
 class ClientDatabase:
     """
@@ -53,6 +63,20 @@ class ClientDatabase:
             self.id = None
             self.name = contact
 
+    class Outbox:
+        """
+        Класс - отображение для таблицы исходящих сообщений, ожидающих
+        подтверждения сервера.
+        """
+
+        def __init__(self, history_id, contact, message):
+            self.id = None
+            self.history_id = history_id
+            self.contact = contact
+            self.message = message
+            self.message_id = uuid.uuid4().hex
+            self.error = None
+
     # Конструктор класса:
     def __init__(self, name):
         # Создаём движок базы данных, поскольку разрешено несколько
@@ -100,6 +124,21 @@ class ClientDatabase:
             Column("name", String, unique=True),
         )
 
+        # Создаём таблицу исходящих сообщений. Сообщение хранится
+        # зашифрованным для отправки, запись истории ссылается на него.
+        # Подтверждённые сервером сообщения удаляются, отклонённые
+        # остаются с текстом ошибки.
+        self.outbox_table = Table(
+            "outbox",
+            self.metadata,
+            Column("id", Integer, primary_key=True),
+            Column("history_id", Integer, index=True),
+            Column("contact", String),
+            Column("message", Text),
+            Column("message_id", String),
+            Column("error", Text),
+        )
+
         # Создаём таблицы
         self.metadata.create_all(self.database_engine)
 
@@ -107,6 +146,7 @@ class ClientDatabase:
         mapper(self.KnownUsers, users)
         mapper(self.MessageStat, history)
         mapper(self.Contacts, contacts)
+        mapper(self.Outbox, self.outbox_table)
 
         # Создаём сессию
         Session = sessionmaker(bind=self.database_engine)
@@ -140,12 +180,73 @@ class ClientDatabase:
             self.session.add(user_row)
         self.session.commit()
 
+    def update_users(self, added, removed):
+        """
+        Метод применяющий изменения таблицы известных пользователей.
+        Удалённые пользователи удаляются и из контактов.
+        """
+        for user in added:
+            if not self.session.query(self.KnownUsers).filter_by(username=user).count():
+                self.session.add(self.KnownUsers(user))
+        if removed:
+            self.session.query(self.KnownUsers).filter(
+                self.KnownUsers.username.in_(removed)
+            ).delete(synchronize_session=False)
+            self.session.query(self.Contacts).filter(
+                self.Contacts.name.in_(removed)
+            ).delete(synchronize_session=False)
+        self.session.commit()
+
     def save_message(self, contact, direction, message):
         """Метод сохраняющий сообщение в базе данных."""
         message_row = self.MessageStat(contact, direction, message)
         self.session.add(message_row)
         self.session.commit()
 
+    def queue_message(self, contact, message, encrypted):
+        """
+        Метод сохраняющий исходящее сообщение в истории и в очереди
+        отправки одной транзакцией.
+        """
+        message_row = self.MessageStat(contact, "out", message)
+        self.session.add(message_row)
+        self.session.flush()
+        self.session.add(self.Outbox(message_row.id, contact, encrypted))
+        self.session.commit()
+
+    def get_outbox(self, limit):
+        """
+        Метод возвращающий не более limit сообщений, ожидающих отправки,
+        в порядке постановки в очередь: (id, контакт, сообщение,
+        идентификатор сообщения). Вызывается из потока отправки, поэтому
+        работает через собственное соединение, а не через сессию.
+        """
+        outbox = self.outbox_table
+        query = (
+            select(
+                [outbox.c.id, outbox.c.contact, outbox.c.message, outbox.c.message_id]
+            )
+            .where(outbox.c.error.is_(None))
+            .order_by(outbox.c.id)
+            .limit(limit)
+        )
+        with self.database_engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(query)]
+
+    def mark_sent(self, ids):
+        """Метод удаления из очереди сообщений, подтверждённых сервером."""
+        outbox = self.outbox_table
+        with self.database_engine.begin() as connection:
+            connection.execute(delete(outbox).where(outbox.c.id.in_(ids)))
+
+    def mark_failed(self, row_id, error):
+        """Метод пометки сообщения, отклонённого сервером."""
+        outbox = self.outbox_table
+        with self.database_engine.begin() as connection:
+            connection.execute(
+                update(outbox).where(outbox.c.id == row_id).values(error=error)
+            )
+
     def get_contacts(self):
         """Метод возвращающий список всех контактов."""
         return [contact[0] for contact in self.session.query(self.Contacts.name).all()]
@@ -169,17 +270,34 @@ class ClientDatabase:
             return False
 
     def get_history(self, contact):
-        """Метод возвращающий историю сообщений с определённым пользователем."""
-        query = self.session.query(self.MessageStat).filter_by(contact=contact)
-        return [
-            (
-                history_row.contact,
-                history_row.direction,
-                history_row.message,
-                history_row.date,
+        """
+        Метод возвращающий историю сообщений с определённым пользователем.
+        Последний элемент записи - состояние сообщения: MESSAGE_SENT,
+        MESSAGE_PENDING или MESSAGE_FAILED.
+        """
+        query = (
+            self.session.query(self.MessageStat, self.Outbox.id, self.Outbox.error)
+            .outerjoin(self.Outbox, self.Outbox.history_id == self.MessageStat.id)
+            .filter(self.MessageStat.contact == contact)
+        )
+        history = []
+        for history_row, outbox_id, error in query.all():
+            if outbox_id is None:
+                state = MESSAGE_SENT
+            elif error is None:
+                state = MESSAGE_PENDING
+            else:
+                state = MESSAGE_FAILED
+            history.append(
+                (
+                    history_row.contact,
+                    history_row.direction,
+                    history_row.message,
+                    history_row.date,
+                    state,
+                )
             )
-            for history_row in query.all()
-        ]
+        return history
 
 
 # отладка
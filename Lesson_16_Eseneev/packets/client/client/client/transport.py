@@ -1,32 +1,43 @@
-import binascii
-import hashlib
-import hmac
+import asyncio
 import json
 import logging
-import socket
 import threading
-import time
 
+from client.async_client import AsyncClient
 from common.errors import ServerError
-from common.utils import *
 from common.variables import *
 from PyQt5.QtCore import QObject, pyqtSignal
 
-# Логер и объект блокировки для работы с сокетом.
+# Логер
 logger = logging.getLogger("client")
-socket_lock = threading.Lock()
+# Исходящих сообщений, читаемых из очереди в базе за один раз
+OUTBOX_BATCH_SIZE = 50
+# Интервал повторной отправки неподтверждённых сообщений в секундах
+OUTBOX_RETRY_INTERVAL = 5
 
 
 class ClientTransport(threading.Thread, QObject):
     """
     Класс реализующий транспортную подсистему клиентского
     модуля. Отвечает за взаимодействие с сервером.
+    Работа с сервером выполняется клиентом AsyncClient в цикле событий
+    потока транспорта, а класс связывает его с графическим интерфейсом
+    и базой клиента: события клиента передаёт сигналами Qt, а вызовы
+    из потока интерфейса выполняет в цикле событий и дожидается
+    результата. Справочник пользователей и контакты хранятся в базе
+    клиента и обновляются по изменениям, в том числе после
+    переподключения. Сообщения пользователям отправляются из очереди в
+    базе клиента отдельной задачей.
     """
 
-    # Сигналы новое сообщение и потеря соединения
+    # Сигналы новое сообщение, потеря соединения, разрыв соединения и
+    # его восстановление, изменение очереди исходящих сообщений
     new_message = pyqtSignal(dict)
     message_205 = pyqtSignal()
     connection_lost = pyqtSignal()
+    reconnecting = pyqtSignal()
+    reconnected = pyqtSignal()
+    outbox_updated = pyqtSignal()
 
     def __init__(self, port, ip_address, database, username, passwd, keys):
         # Вызываем конструкторы предков
@@ -37,18 +48,38 @@ class ClientTransport(threading.Thread, QObject):
         self.database = database
         # Имя пользователя
         self.username = username
-        # Пароль
-        self.password = passwd
-        # Сокет для работы с сервером
-        self.transport = None
-        # Набор ключей для шифрования
-        self.keys = keys
-        # Устанавливаем соединение:
-        self.connection_init(port, ip_address)
-        # Обновляем таблицы известных пользователей и контактов
+        # Версия справочника пользователей в базе клиента, None - неизвестна
+        self.users_version = None
+        # Цикл событий потока транспорта. До запуска потока он выполняется
+        # в вызывающем потоке только на время подключения.
+        self.loop = asyncio.new_event_loop()
+        # Клиент сервера, публичный ключ передаётся серверу при входе
+        pubkey = keys.publickey().export_key().decode("ascii")
+        self.client = AsyncClient(username, passwd, pubkey, reconnect=True)
+        # Обработчик сообщений пользователей назначается при запуске потока,
+        # до этого сообщения накапливаются в очереди клиента.
+        self.client.on_users_changed = self.users_changed
+        self.client.on_reconnecting = self.reconnecting.emit
+        self.client.on_reconnected = self.resync
+        self.client.on_connection_lost = self.connection_lost.emit
+        # Задача отправки исходящих сообщений и событие, будящее её.
+        # Создаются в цикле событий при подключении.
+        self.sender = None
+        self.outbox_event = None
+        # Устанавливаем соединение и обновляем таблицы известных
+        # пользователей и контактов
+        self.loop.run_until_complete(self.start_client(ip_address, port))
+
+    async def start_client(self, ip_address, port):
+        """Корутина подключения к серверу и начального обновления списков."""
+        # Событие установлено, чтобы отправить оставшиеся с прошлого
+        # запуска сообщения.
+        self.outbox_event = asyncio.Event()
+        self.outbox_event.set()
+        await self.client.connect(ip_address, port)
         try:
-            self.user_list_update()
-            self.contacts_list_update()
+            await self.update_users()
+            await self.update_contacts()
         except OSError as err:
             if err.errno:
                 logger.critical(f"Потеряно соединение с сервером.")
@@ -57,237 +88,225 @@ class ClientTransport(threading.Thread, QObject):
         except json.JSONDecodeError:
             logger.critical(f"Потеряно соединение с сервером.")
             raise ServerError("Потеряно соединение с сервером!")
-            # Флаг продолжения работы транспорта.
-        self.running = True
-
-    def connection_init(self, port, ip):
-        """Метод отвечающий за устанновку соединения с сервером."""
-        # Инициализация сокета и сообщение серверу о нашем появлении
-        self.transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-        # Таймаут необходим для освобождения сокета.
-        self.transport.settimeout(5)
+    def call(self, coro):
+        """
+        Метод выполнения корутины в цикле событий транспорта из потока
+        интерфейса, возвращает её результат или генерирует её исключение.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
 
-        # Соединяемся, 5 попыток соединения, флаг успеха ставим в True если
-        # удалось
-        connected = False
-        for i in range(5):
-            logger.info(f"Попытка подключения №{i + 1}")
-            try:
-                self.transport.connect((ip, port))
-            except (OSError, ConnectionRefusedError):
-                pass
+    async def users_changed(self, message):
+        """
+        Корутина обработки сообщения 205 об изменении справочника.
+        Сервер присылает изменения справочника от известной ему версии.
+        Если наша версия другая, запрашиваем изменения от неё. Старый
+        сервер изменений не присылает.
+        """
+        try:
+            if (
+                self.users_version is not None
+                and message.get(SINCE_VERSION) == self.users_version
+            ):
+                self.apply_users_changes(
+                    message[USERS_VERSION], message[ADDED], message[REMOVED]
+                )
+            elif USERS_VERSION in message:
+                await self.update_users_changes()
             else:
-                connected = True
-                break
-            time.sleep(1)
+                await self.update_users()
+                await self.update_contacts()
+        except (OSError, ServerError) as err:
+            logger.error(f"Ошибка обработки сообщения сервера: {err}")
+        self.message_205.emit()
 
-        # Если соединится не удалось - исключение
-        if not connected:
-            logger.critical("Не удалось установить соединение с сервером")
-            raise ServerError("Не удалось установить соединение с сервером")
-
-        logger.debug("Установлено соединение с сервером")
-
-        # Запускаем процедуру авторизации
-        # Получаем хэш пароля
-        passwd_bytes = self.password.encode("utf-8")
-        salt = self.username.lower().encode("utf-8")
-        passwd_hash = hashlib.pbkdf2_hmac("sha512", passwd_bytes, salt, 10000)
-        passwd_hash_string = binascii.hexlify(passwd_hash)
-
-        # Получаем публичный ключ и декодируем его из байтов
-        pubkey = self.keys.publickey().export_key().decode("ascii")
-
-        # Авторизируемся на сервере
-        with socket_lock:
-            presense = {
-                ACTION: PRESENCE,
-                TIME: time.time(),
-                USER: {ACCOUNT_NAME: self.username, PUBLIC_KEY: pubkey},
-            }
-            # Отправляем серверу приветственное сообщение.
-            try:
-                send_message(self.transport, presense)
-                ans = get_message(self.transport)
-                # Если сервер вернул ошибку, бросаем исключение.
-                if RESPONSE in ans:
-                    if ans[RESPONSE] == 400:
-                        raise ServerError(ans[ERROR])
-                    elif ans[RESPONSE] == 511:
-                        # Если всё нормально, то продолжаем процедуру
-                        # авторизации.
-                        ans_data = ans[DATA]
-                        hash = hmac.new(passwd_hash_string, ans_data.encode("utf-8"))
-                        digest = hash.digest()
-                        my_ans = RESPONSE_511
-                        my_ans[DATA] = binascii.b2a_base64(digest).decode("ascii")
-                        send_message(self.transport, my_ans)
-                        self.process_server_ans(get_message(self.transport))
-            except (OSError, json.JSONDecodeError):
-                raise ServerError("Сбой соединения в процессе авторизации.")
+    async def resync(self):
+        """
+        Корутина, выполняемая после переподключения: справочник
+        пользователей и контакты обновляются по изменениям, затем
+        отправляются накопившиеся исходящие сообщения.
+        """
+        try:
+            await self.update_users_changes()
+            await self.update_contacts()
+        except (OSError, ServerError) as err:
+            logger.error(f"Не удалось обновить списки после переподключения: {err}")
+        self.reconnected.emit()
+        self.outbox_event.set()
 
-    def process_server_ans(self, message):
-        """Метод обработчик поступающих сообщений с сервера."""
-        logger.debug(f"Разбор сообщения от сервера: {message}")
+    async def update_contacts(self):
+        """
+        Корутина обновления с сервера списка контактов.
+        В базу вносятся только отличия от полученного списка.
+        """
+        logger.debug(f"Запрос контакт листа для пользователся {self.username}")
+        try:
+            contacts = set(await self.client.get_contacts())
+        except ServerError:
+            logger.error("Не удалось обновить список контактов.")
+            return
+        known = set(self.database.get_contacts())
+        for contact in contacts - known:
+            self.database.add_contact(contact)
+        for contact in known - contacts:
+            self.database.del_contact(contact)
 
-        # Если это подтверждение чего-либо
-        if RESPONSE in message:
-            if message[RESPONSE] == 200:
-                return
-            elif message[RESPONSE] == 400:
-                raise ServerError(f"{message[ERROR]}")
-            elif message[RESPONSE] == 205:
-                self.user_list_update()
-                self.contacts_list_update()
-                self.message_205.emit()
-            else:
-                logger.error(
-                    f"Принят неизвестный код подтверждения {message[RESPONSE]}"
-                )
+    async def update_users(self):
+        """Корутина обновления с сервера списка пользователей."""
+        logger.debug(f"Запрос списка известных пользователей {self.username}")
+        try:
+            users, self.users_version = await self.client.get_users()
+        except ServerError:
+            logger.error("Не удалось обновить список известных пользователей.")
+            return
+        self.database.add_users(users)
 
-        # Если это сообщение от пользователя добавляем в базу, даём сигнал о
-        # новом сообщении
-        elif (
-            ACTION in message
-            and message[ACTION] == MESSAGE
-            and SENDER in message
-            and DESTINATION in message
-            and MESSAGE_TEXT in message
-            and message[DESTINATION] == self.username
-        ):
-            logger.debug(
-                f"Получено сообщение от пользователя {message[SENDER]}:{message[MESSAGE_TEXT]}"
+    async def update_users_changes(self):
+        """
+        Корутина запроса с сервера изменений списка пользователей
+        после версии, известной клиенту.
+        """
+        if self.users_version is None:
+            await self.update_users()
+            return
+        logger.debug(f"Запрос изменений списка пользователей {self.username}")
+        try:
+            version, added, removed = await self.client.get_users_changes(
+                self.users_version
             )
-            self.new_message.emit(message)
+        except ServerError:
+            logger.error("Не удалось обновить список известных пользователей.")
+            return
+        if removed is None:
+            # Сервер не знает нашей версии и прислал полный список.
+            self.database.add_users(added)
+            self.users_version = version
+            await self.update_contacts()
+        else:
+            self.apply_users_changes(version, added, removed)
+
+    def apply_users_changes(self, version, added, removed):
+        """Метод применяющий изменения списка пользователей."""
+        logger.debug(f"Изменения списка пользователей: +{added} -{removed}")
+        self.database.update_users(added, removed)
+        self.users_version = version
 
     def contacts_list_update(self):
         """Метод обновляющий с сервера список контактов."""
-        self.database.contacts_clear()
-        logger.debug(f"Запрос контакт листа для пользователся {self.name}")
-        req = {ACTION: GET_CONTACTS, TIME: time.time(), USER: self.username}
-        logger.debug(f"Сформирован запрос {req}")
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
-        logger.debug(f"Получен ответ {ans}")
-        if RESPONSE in ans and ans[RESPONSE] == 202:
-            for contact in ans[LIST_INFO]:
-                self.database.add_contact(contact)
-        else:
-            logger.error("Не удалось обновить список контактов.")
+        self.call(self.update_contacts())
 
     def user_list_update(self):
         """Метод обновляющий с сервера список пользователей."""
-        logger.debug(f"Запрос списка известных пользователей {self.username}")
-        req = {ACTION: USERS_REQUEST, TIME: time.time(), ACCOUNT_NAME: self.username}
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
-        if RESPONSE in ans and ans[RESPONSE] == 202:
-            self.database.add_users(ans[LIST_INFO])
-        else:
-            logger.error("Не удалось обновить список известных пользователей.")
+        self.call(self.update_users())
+
+    def users_changes_update(self):
+        """Метод обновляющий с сервера список пользователей по изменениям."""
+        self.call(self.update_users_changes())
 
     def key_request(self, user):
         """Метод запрашивающий с сервера публичный ключ пользователя."""
         logger.debug(f"Запрос публичного ключа для {user}")
-        req = {ACTION: PUBLIC_KEY_REQUEST, TIME: time.time(), ACCOUNT_NAME: user}
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
-        if RESPONSE in ans and ans[RESPONSE] == 511:
-            return ans[DATA]
-        else:
+        try:
+            return self.call(self.client.key_request(user))
+        except ServerError:
             logger.error(f"Не удалось получить ключ собеседника{user}.")
 
     def add_contact(self, contact):
         """Метод отправляющий на сервер сведения о добавлении контакта."""
         logger.debug(f"Создание контакта {contact}")
-        req = {
-            ACTION: ADD_CONTACT,
-            TIME: time.time(),
-            USER: self.username,
-            ACCOUNT_NAME: contact,
-        }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.call(self.client.add_contact(contact))
 
     def remove_contact(self, contact):
         """Метод отправляющий на сервер сведения о удалении контакта."""
         logger.debug(f"Удаление контакта {contact}")
-        req = {
-            ACTION: REMOVE_CONTACT,
-            TIME: time.time(),
-            USER: self.username,
-            ACCOUNT_NAME: contact,
-        }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
-
-    def transport_shutdown(self):
-        """Метод уведомляющий сервер о завершении работы клиента."""
-        self.running = False
-        message = {ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: self.username}
-        with socket_lock:
-            try:
-                send_message(self.transport, message)
-            except OSError:
-                pass
-        logger.debug("Транспорт завершает работу.")
-        time.sleep(0.5)
+        self.call(self.client.remove_contact(contact))
 
     def send_message(self, to, message):
         """Метод отправляющий на сервер сообщения для пользователя."""
-        message_dict = {
-            ACTION: MESSAGE,
-            SENDER: self.username,
-            DESTINATION: to,
-            TIME: time.time(),
-            MESSAGE_TEXT: message,
-        }
-        logger.debug(f"Сформирован словарь сообщения: {message_dict}")
-        # Необходимо дождаться освобождения сокета для отправки сообщения
-        with socket_lock:
-            send_message(self.transport, message_dict)
-            self.process_server_ans(get_message(self.transport))
-            logger.info(f"Отправлено сообщение для пользователя {to}")
+        self.call(self.client.send_message(to, message))
+        logger.info(f"Отправлено сообщение для пользователя {to}")
 
-    def run(self):
-        """Метод содержащий основной цикл работы транспортного потока."""
-        logger.debug("Запущен процесс - приёмник собщений с сервера.")
-        while self.running:
-            # Отдыхаем секунду и снова пробуем захватить сокет.
-            # если не сделать тут задержку, то отправка может достаточно долго
-            # ждать освобождения сокета.
-            time.sleep(1)
-            message = None
-            with socket_lock:
+    def flush_outbox(self):
+        """Метод запуска отправки сообщений из очереди исходящих."""
+        self.loop.call_soon_threadsafe(self.outbox_event.set)
+
+    async def outbox_loop(self):
+        """
+        Корутина задачи отправки исходящих сообщений.
+        Берёт из очереди в базе до OUTBOX_BATCH_SIZE сообщений и
+        отправляет их серверу по одному в порядке постановки в очередь,
+        удаляя подтверждённые. Сообщения, отклонённые сервером,
+        помечаются ошибкой и больше не отправляются. На первом
+        неподтверждённом сообщении отправка останавливается, чтобы
+        следующие не обогнали его: оно и остаток очереди отправляются
+        снова после переподключения или через OUTBOX_RETRY_INTERVAL
+        секунд. Сообщение передаётся с идентификатором, по которому
+        сервер не сохранит повтор для отключённого получателя.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self.outbox_event.wait(), OUTBOX_RETRY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.outbox_event.clear()
+            if self.client.closing:
+                break
+            if not self.client.connected:
+                continue
+            rows = self.database.get_outbox(OUTBOX_BATCH_SIZE)
+            if not rows:
+                continue
+            sent = []
+            complete = True
+            for row_id, contact, message, message_id in rows:
                 try:
-                    self.transport.settimeout(0.5)
-                    message = get_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        logger.critical(f"Потеряно соединение с сервером.")
-                        self.running = False
-                        self.connection_lost.emit()
-                # Проблемы с соединением
-                except (
-                    ConnectionError,
-                    ConnectionAbortedError,
-                    ConnectionResetError,
-                    json.JSONDecodeError,
-                    TypeError,
-                ):
-                    logger.debug(f"Потеряно соединение с сервером.")
-                    self.running = False
-                    self.connection_lost.emit()
-                finally:
-                    self.transport.settimeout(5)
+                    await self.client.send_message(contact, message, message_id)
+                except ServerError as err:
+                    logger.error(f"Сообщение для {contact} не принято: {err}")
+                    self.database.mark_failed(row_id, str(err))
+                except OSError:
+                    complete = False
+                    break
+                else:
+                    sent.append(row_id)
+            if sent:
+                self.database.mark_sent(sent)
+                logger.info(f"Отправлено сообщений из очереди: {len(sent)}")
+            self.outbox_updated.emit()
+            # Пакет подтверждён полностью - отправляем остаток очереди.
+            if complete:
+                self.outbox_event.set()
+
+    async def stop(self):
+        """Корутина завершения работы клиента и задачи отправки."""
+        await self.client.close()
+        self.outbox_event.set()
+        # Дожидаемся записи в базу результатов последней отправки.
+        if self.sender is not None:
+            await self.sender
+        self.loop.stop()
 
-            # Если сообщение получено, то вызываем функцию обработчик:
-            if message:
-                logger.debug(f"Принято сообщение с сервера: {message}")
-                self.process_server_ans(message)
+    def transport_shutdown(self):
+        """Метод уведомляющий сервер о завершении работы клиента."""
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop)
+        logger.debug("Транспорт завершает работу.")
+
+    def run(self):
+        """
+        Метод содержащий основной цикл работы транспортного потока.
+        Выполняет цикл событий клиента: приём сообщений сервера,
+        переподключение после разрыва соединения и отправку исходящих
+        сообщений, до вызова transport_shutdown.
+        """
+        logger.debug("Запущен процесс - обработчик сообщений с сервера.")
+        asyncio.set_event_loop(self.loop)
+        # Сообщения, принятые при подключении, передаём окну, уже
+        # подключившему сигналы.
+        while not self.client.inbox.empty():
+            self.new_message.emit(self.client.inbox.get_nowait())
+        self.client.on_message = self.new_message.emit
+        self.sender = self.loop.create_task(self.outbox_loop())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
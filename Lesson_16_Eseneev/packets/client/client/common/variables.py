@@ -6,10 +6,36 @@ DEFAULT_PORT = 7777
 DEFAULT_IP_ADDRESS = "127.0.0.1"
 # Максимальная очередь подключений
 MAX_CONNECTIONS = 5
+# Границы очереди отправки клиенту в байтах: выше верхней применяется
+# политика для медленных клиентов, ниже нижней работа возобновляется.
+WRITE_HIGH_WATERMARK = 65536
+WRITE_LOW_WATERMARK = 16384
+# Политика для медленных клиентов: pause, drop или disconnect
+SLOW_CONSUMER_POLICY = "pause"
+# Время на авторизацию клиента после подключения в секундах
+HANDSHAKE_TIMEOUT = 5
+# Срок действия токена восстановления сессии в секундах
+RESUME_TOKEN_LIFETIME = 3600
+# Интервал записи накопленной статистики сообщений в базу в секундах
+STATS_FLUSH_INTERVAL = 5
+# Срок хранения подробной истории входов в днях, более старые записи
+# сворачиваются в итоги по дням. 0 - хранить всю историю.
+LOGIN_HISTORY_DAYS = 90
+# Интервал проверки устаревшей истории входов в секундах
+RETENTION_INTERVAL = 600
+# Отложенных сообщений, отправляемых клиенту за один проход цикла сервера
+OFFLINE_BATCH_SIZE = 100
+# Отложенных сообщений, отправляемых за один вход пользователя
+OFFLINE_LOGIN_LIMIT = 1000
 # Максимальная длинна сообщения в байтах
 MAX_PACKAGE_LENGTH = 10240
+# Максимальная длинна сообщения в режиме с заголовком длины
+MAX_FRAME_LENGTH = 1048576
 # Кодировка проекта
 ENCODING = "utf-8"
+# Алгоритм хэша ответа на запрос 511. До Python 3.8 hmac по умолчанию
+# использовал MD5, с ним совместимы клиенты и серверы прошлых версий.
+AUTH_DIGEST = "md5"
 # Текущий уровень логирования
 LOGGING_LEVEL = logging.DEBUG
 # База данных для хранения данных сервера:
@@ -37,7 +63,23 @@ LIST_INFO = "data_list"
 REMOVE_CONTACT = "remove"
 ADD_CONTACT = "add"
 USERS_REQUEST = "get_users"
+USERS_CHANGES_REQUEST = "get_users_changes"
 PUBLIC_KEY_REQUEST = "pubkey_need"
+# Согласование передачи сообщений с заголовком длины (в presence и 511)
+FRAMING = "framing"
+# Клиент готов принять отложенные сообщения сразу после входа (в presence)
+OFFLINE = "offline"
+# Токен восстановления сессии без повторной авторизации (в 200 и presence)
+RESUME_TOKEN = "resume_token"
+# Идентификатор сообщения, повторы с тем же идентификатором не сохраняются
+MESSAGE_ID = "message_id"
+# Идентификатор запроса клиента, сервер повторяет его в ответе
+REQUEST_ID = "request_id"
+# Версия справочника пользователей и изменения в нём (в 202, 205 и 206)
+USERS_VERSION = "users_version"
+SINCE_VERSION = "since_version"
+ADDED = "added"
+REMOVED = "removed"
 
 # Словари - ответы:
 # 200
@@ -48,6 +90,8 @@ RESPONSE_202 = {RESPONSE: 202, LIST_INFO: None}
 RESPONSE_400 = {RESPONSE: 400, ERROR: None}
 # 205
 RESPONSE_205 = {RESPONSE: 205}
+# 206
+RESPONSE_206 = {RESPONSE: 206, USERS_VERSION: None, ADDED: None, REMOVED: None}
 
 # 511
 RESPONSE_511 = {RESPONSE: 511, DATA: None}
@@ -0,0 +1,113 @@
+"""
+Микро-бенчмарк разбора сообщений сервера.
+Измеряет время обработки одного сообщения process_client_message
+для каждого действия: поиск обработчика, проверку схемы, вызов
+обработчика и постановку ответа в очередь. Сеть заменена заглушкой,
+а сервер работает с хранилищем в памяти и с базой SQLite: разница
+между столбцами - время работы с базой.
+
+Запуск из каталога сервера: python benchmarks/bench_dispatch.py
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common.variables import *
+from server.core import ClientConnection, MessageProcessor
+from server.database import ServerStorage
+from server.memory_storage import MemoryStorage
+
+# Количество сообщений в одном замере
+NUMBER = 20000
+
+
+class DummySocket:
+    """Заглушка сокета клиента."""
+
+    def fileno(self):
+        return -1
+
+    def getpeername(self):
+        return "127.0.0.1", 0
+
+    def close(self):
+        pass
+
+
+def measure(database):
+    """Функция замера, возвращает мкс на сообщение для каждого действия."""
+    for name in ("test1", "test2"):
+        database.add_user(name, b"hash")
+        database.user_login(name, "127.0.0.1", 0, "key")
+    server = MessageProcessor("127.0.0.1", DEFAULT_PORT, database)
+    client = ClientConnection(DummySocket(), server, ("127.0.0.1", 0))
+    receiver = ClientConnection(DummySocket(), server, ("127.0.0.1", 0))
+    for name, connection in (("test1", client), ("test2", receiver)):
+        server.sessions.add(connection)
+        server.sessions.authenticate(connection, name)
+
+    messages = {
+        MESSAGE: {
+            ACTION: MESSAGE,
+            SENDER: "test1",
+            DESTINATION: "test2",
+            TIME: 1,
+            MESSAGE_TEXT: "text",
+        },
+        GET_CONTACTS: {ACTION: GET_CONTACTS, TIME: 1, USER: "test1"},
+        ADD_CONTACT: {
+            ACTION: ADD_CONTACT,
+            USER: "test1",
+            TIME: 1,
+            ACCOUNT_NAME: "test2",
+        },
+        REMOVE_CONTACT: {
+            ACTION: REMOVE_CONTACT,
+            USER: "test1",
+            TIME: 1,
+            ACCOUNT_NAME: "test2",
+        },
+        USERS_REQUEST: {ACTION: USERS_REQUEST, TIME: 1, ACCOUNT_NAME: "test1"},
+        PUBLIC_KEY_REQUEST: {
+            ACTION: PUBLIC_KEY_REQUEST,
+            TIME: 1,
+            ACCOUNT_NAME: "test2",
+        },
+        "unknown": {ACTION: "unknown", TIME: 1},
+        "invalid": {ACTION: MESSAGE, TIME: 1},
+    }
+
+    def dispatch(message):
+        server.process_client_message(message, client)
+        # Очереди отправки не должны расти во время замера.
+        client.outbuf.clear()
+        receiver.outbuf.clear()
+
+    results = dict()
+    for action, message in messages.items():
+        seconds = min(timeit.repeat(lambda: dispatch(message), number=NUMBER, repeat=3))
+        results[action] = seconds / NUMBER * 1e6
+    return results
+
+
+def main():
+    # Логирование на уровне debug измеряло бы скорость записи в журнал.
+    logging.getLogger("server").setLevel(logging.ERROR)
+
+    memory = measure(MemoryStorage())
+    path = os.path.join(tempfile.mkdtemp(), "bench_dispatch.db3")
+    sqlite = measure(ServerStorage(path))
+    os.remove(path)
+
+    print(f"{'Действие':<15}{'память':>12}{'SQLite':>12}  мкс/сообщение")
+    for action in memory:
+        print(f"{action:<15}{memory[action]:>12.2f}{sqlite[action]:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
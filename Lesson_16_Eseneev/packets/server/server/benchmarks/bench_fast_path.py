@@ -0,0 +1,173 @@
+"""
+Бенчмарк частых операций базы данных сервера: запросы ORM, которыми
+они выполнялись раньше, против готовых команд SQLAlchemy Core.
+Заполняет временную базу USERS пользователями с CONTACTS контактами
+и выводит количество операций в секунду. Команды Core замеряются с
+пустым кэшем пользователей, чтение из кэша вынесено в отдельную строку.
+
+Запуск из каталога сервера: python benchmarks/bench_fast_path.py [операций]
+"""
+
+import datetime
+import logging
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from server.database import ServerStorage
+
+# Количество пользователей и контактов у каждого
+USERS = 1000
+CONTACTS = 50
+# Количество операций в одном замере
+NUMBER = 2000
+
+
+def fill(database):
+    """Функция заполнения базы тестовыми данными."""
+    tables = database.metadata.tables
+    now = datetime.datetime.now()
+    with database.database_engine.begin() as connection:
+        connection.execute(
+            tables["Users"].insert(),
+            [
+                {
+                    "id": number,
+                    "name": f"user{number}",
+                    "last_login": now,
+                    "passwd_hash": b"hash",
+                    "pubkey": "key",
+                }
+                for number in range(1, USERS + 1)
+            ],
+        )
+        connection.execute(
+            tables["Contacts"].insert(),
+            [
+                {"user": number, "contact": (number + shift) % USERS + 1}
+                for number in range(1, USERS + 1)
+                for shift in range(CONTACTS)
+            ],
+        )
+
+
+# Прежняя реализация операций запросами ORM.
+
+
+def orm_user_record(database, name):
+    return database.session.query(database.AllUsers).filter_by(name=name).first()
+
+
+def orm_auth_reads(database, name):
+    query = database.session.query(database.AllUsers).filter_by(name=name)
+    query.count()
+    query.first().passwd_hash
+    query.first().pubkey
+
+
+def orm_user_login(database, name, ip_address, port, key):
+    query = database.session.query(database.AllUsers).filter_by(name=name)
+    if not query.count():
+        raise ValueError("Пользователь не зарегистрирован.")
+    user = query.first()
+    user.last_login = datetime.datetime.now()
+    if user.pubkey != key:
+        user.pubkey = key
+    database.session.add(
+        database.LoginHistory(user.id, datetime.datetime.now(), ip_address, port)
+    )
+    database.session.commit()
+
+
+def orm_get_contacts(database, name):
+    user = database.session.query(database.AllUsers).filter_by(name=name).first()
+    query = (
+        database.session.query(database.UsersContacts, database.AllUsers.name)
+        .filter_by(user=user.id)
+        .join(database.AllUsers, database.UsersContacts.contact == database.AllUsers.id)
+    )
+    return [contact[1] for contact in query.all()]
+
+
+def measure(func, number):
+    """Функция замера, возвращает количество операций в секунду."""
+    seconds = min(timeit.repeat(func, number=1, repeat=3))
+    return number / seconds
+
+
+def main():
+    # Логирование на уровне debug измеряло бы скорость записи в журнал.
+    logging.getLogger("server").setLevel(logging.ERROR)
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else NUMBER
+
+    path = os.path.join(tempfile.mkdtemp(), "bench_fast_path.db3")
+    database = ServerStorage(path)
+    fill(database)
+    names = [f"user{random.randint(1, USERS)}" for _ in range(number)]
+
+    def orm_record():
+        for name in names:
+            orm_user_record(database, name)
+
+    def core_record():
+        # Запись каждый раз читается из базы, как при промахе кэша.
+        for name in names:
+            database.forget_user(name)
+            database.user_record(name)
+
+    def core_auth_reads():
+        # Каждое обращение идёт в базу готовой командой Core.
+        for name in names:
+            database.forget_user(name)
+            database.check_user(name)
+            database.forget_user(name)
+            database.get_hash(name)
+            database.forget_user(name)
+            database.get_pubkey(name)
+
+    def orm_auth():
+        for name in names:
+            orm_auth_reads(database, name)
+
+    def cached_auth_reads():
+        # Записи уже в кэше после первого повтора замера.
+        for name in names:
+            database.check_user(name)
+            database.get_hash(name)
+            database.get_pubkey(name)
+
+    def orm_login():
+        for name in names:
+            orm_user_login(database, name, "127.0.0.1", 7777, "key")
+
+    def core_login():
+        for name in names:
+            database.user_login(name, "127.0.0.1", 7777, "key")
+            database.user_logout(name)
+
+    def orm_contacts():
+        for name in names:
+            orm_get_contacts(database, name)
+
+    def core_contacts():
+        for name in names:
+            database.get_contacts(name)
+
+    print(f"{'Операция':<30}{'ORM':>12}{'Core':>12}  операций/с")
+    for title, orm, core in (
+        ("запись пользователя", orm_record, core_record),
+        ("check_user/get_hash/get_pubkey", orm_auth, core_auth_reads),
+        ("то же из кэша", orm_auth, cached_auth_reads),
+        ("user_login", orm_login, core_login),
+        ("get_contacts", orm_contacts, core_contacts),
+    ):
+        print(f"{title:<30}{measure(orm, number):>12.0f}{measure(core, number):>12.0f}")
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import sys
 
 import logs.config_client_log
 import logs.config_server_log
+from common.variables import ACTION, PRESENCE
 
 sys.path.append("../")
 
@@ -25,41 +26,53 @@ def log(func_to_log):
     """
 
     def log_saver(*args, **kwargs):
-        logger.debug(
-            f"Была вызвана функция {func_to_log.__name__} c параметрами {args} , {kwargs}. Вызов из модуля {func_to_log.__module__}"
-        )
+        # Строку с параметрами собираем, только если она попадёт в журнал.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Была вызвана функция {func_to_log.__name__} c параметрами {args} , {kwargs}. Вызов из модуля {func_to_log.__module__}"
+            )
         ret = func_to_log(*args, **kwargs)
         return ret
 
     return log_saver
 
 
+# Классы сервера для login_required, импортируются при первом вызове.
+SERVER_CLASSES = None
+
+
 def login_required(func):
     """
     Декоратор, проверяющий, что клиент авторизован на сервере.
-    Проверяет, что передаваемый объект сокета находится в
-    списке авторизованных клиентов.
+    Проверяет по реестру сессий сервера, что передаваемый
+    объект сокета принадлежит авторизованному клиенту.
     За исключением передачи словаря-запроса
     на авторизацию. Если клиент не авторизован,
     генерирует исключение TypeError
     """
 
     def checker(*args, **kwargs):
+        global SERVER_CLASSES
         # проверяем, что первый аргумент - экземпляр MessageProcessor
         # Импортить необходимо тут, иначе ошибка рекурсивного импорта.
-        from server.core import MessageProcessor
+        if SERVER_CLASSES is None:
+            from server.async_core import ClientProtocol
+            from server.core import ClientConnection, MessageProcessor
 
-        from common.variables import ACTION, PRESENCE
+            SERVER_CLASSES = (
+                MessageProcessor,
+                (socket.socket, ClientConnection, ClientProtocol),
+            )
+        processor_class, connection_classes = SERVER_CLASSES
 
-        if isinstance(args[0], MessageProcessor):
+        if isinstance(args[0], processor_class):
             found = False
             for arg in args:
-                if isinstance(arg, socket.socket):
-                    # Проверяем, что данный сокет есть в списке names класса
-                    # MessageProcessor
-                    for client in args[0].names:
-                        if args[0].names[client] == arg:
-                            found = True
+                if isinstance(arg, connection_classes):
+                    # Проверяем, что данный сокет авторизован в реестре
+                    # сессий MessageProcessor
+                    if args[0].sessions.is_authenticated(arg):
+                        found = True
 
             # Теперь надо проверить, что передаваемые аргументы не presence
             # сообщение. Если presense, то разрешаем
@@ -0,0 +1,218 @@
+import asyncio
+import concurrent.futures
+import logging
+import socket
+import threading
+import time
+
+from common.utils import MessageDecoder
+from common.variables import *
+from server.core import MessageProcessor, run_call
+
+# Загрузка логера
+logger = logging.getLogger("server")
+
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    Класс - протокол соединения с клиентом для асинхронного сервера.
+    Получает данные по готовности сокета и передаёт их серверу.
+    Для обработчиков сервера выглядит как сокет (методы send,
+    getpeername, close), поэтому send_message работает без изменений.
+    Очередь отправки хранится в транспорте, при её переполнении
+    применяется политика сервера для медленных клиентов.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        # Буфер сборки входящих сообщений
+        self.decoder = MessageDecoder()
+        # Ожидаемый ответ на запрос 511: (сообщение presence, хэш) или None
+        self.auth_pending = None
+        # Момент, до которого клиент должен авторизоваться, None - авторизован
+        self.auth_deadline = time.monotonic() + server.handshake_timeout
+        # Очередь отправки выше верхней границы
+        self.paused = False
+        # Всего байт, принятых в буфер отправки
+        self.written = 0
+
+    @property
+    def framed(self):
+        """Передаются ли сообщения с заголовком длины."""
+        return self.decoder.framed
+
+    @property
+    def queue_size(self):
+        """Размер очереди исходящих данных в байтах."""
+        return self.transport.get_write_buffer_size()
+
+    @property
+    def flushed(self):
+        """Всего байт, переданных из буфера отправки в сокет."""
+        return self.written - self.transport.get_write_buffer_size()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.set_write_buffer_limits(
+            self.server.high_watermark, self.server.low_watermark
+        )
+        self.server.client_connected(self)
+
+    def data_received(self, data):
+        self.server.client_data(self, data)
+
+    def connection_lost(self, exc):
+        self.server.client_disconnected(self)
+
+    def pause_writing(self):
+        """Вызывается транспортом при переполнении очереди отправки."""
+        self.paused = True
+        if self.server.slow_policy == "pause":
+            self.transport.pause_reading()
+        elif self.server.slow_policy == "disconnect":
+            logger.warning(
+                f"Очередь клиента {self.getpeername()} переполнена, соединение закрыто."
+            )
+            self.transport.abort()
+
+    def resume_writing(self):
+        """Вызывается транспортом, когда очередь отправки разгрузилась."""
+        self.paused = False
+        if self.server.slow_policy == "pause" and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def send(self, data):
+        """Метод постановки данных в буфер отправки транспорта."""
+        if self.paused and self.server.slow_policy == "drop":
+            logger.warning(
+                f"Очередь клиента {self.getpeername()} переполнена, сообщение отброшено."
+            )
+            return 0
+        self.transport.write(data)
+        self.written += len(data)
+        return len(data)
+
+    def getpeername(self):
+        return self.transport.get_extra_info("peername")
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncMessageProcessor(MessageProcessor):
+    """
+    Асинхронный вариант основного класса сервера на базе asyncio.
+    Приём соединений, чтение и запись выполняются по готовности сокетов
+    в цикле событий, поэтому простаивающие клиенты не нагружают процессор.
+    Обработка сообщений и работа с базой такие же, как у MessageProcessor.
+    Работает в качестве отдельного потока.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Цикл событий потока сервера
+        self.loop = None
+        # Запланирована ли отправка отложенных сообщений
+        self.offline_scheduled = False
+
+    def run(self):
+        """Метод основной цикл потока."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        """Корутина, принимающая соединения до сброса флага running."""
+        logger.info(
+            f"Запущен асинхронный сервер, порт для подключений: {self.port} , адрес с которого принимаются подключения: {self.addr}. Если адрес не указан, принимаются соединения с любых адресов."
+        )
+        self.sock = await self.loop.create_server(
+            lambda: ClientProtocol(self),
+            self.addr,
+            self.port,
+            family=socket.AF_INET,
+            backlog=MAX_CONNECTIONS,
+            reuse_port=bool(self.router),
+        )
+        # Флаг running сбрасывается из другого потока, проверяем его
+        # редко, чтобы не нагружать процессор. Заодно отключаем клиентов,
+        # не успевших авторизоваться, и сохраняем накопленные данные.
+        while self.running:
+            await asyncio.sleep(0.5)
+            self.check_handshakes()
+            self.check_flush()
+        self.sock.close()
+        await self.sock.wait_closed()
+        for client in self.sessions:
+            self.remove_client(client)
+        self.database.flush()
+
+    def client_connected(self, client):
+        """Метод регистрации нового соединения."""
+        logger.info(f"Установлено соедение с ПК {client.getpeername()}")
+        self.sessions.add(client)
+
+    def client_data(self, client, data):
+        """
+        Метод обработки данных, поступивших от клиента.
+        За одно чтение может быть получено несколько сообщений.
+        """
+        try:
+            for message in client.decoder.feed(data):
+                # Клиент мог быть отключён обработчиком предыдущего сообщения.
+                if client not in self.sessions:
+                    break
+                self.handle_message(message, client)
+        # ValueError - в том числе ошибки разбора JSON и UTF-8.
+        except (OSError, KeyError, TypeError, ValueError):
+            if client in self.sessions:
+                self.remove_client(client)
+
+    def client_disconnected(self, client):
+        """Метод обработки закрытия соединения со стороны клиента."""
+        if client in self.sessions:
+            self.remove_client(client)
+
+    def schedule_offline_delivery(self):
+        """Метод планирования отправки отложенных сообщений в цикле событий."""
+        if not self.offline_scheduled:
+            self.offline_scheduled = True
+            self.loop.call_soon(self.offline_step)
+
+    def offline_step(self):
+        """
+        Метод отправки порции отложенных сообщений в цикле событий.
+        Следующая порция планируется сразу, если есть клиент с местом
+        в очереди отправки, иначе с небольшой задержкой.
+        """
+        self.offline_scheduled = False
+        self.deliver_offline()
+        # Клиентов, получивших предел сообщений, ждать не нужно, пока
+        # им не поступит новое сообщение.
+        if any(
+            delivery.rows or not delivery.capped
+            for delivery in self.offline_delivery.values()
+        ):
+            self.offline_scheduled = True
+            self.loop.call_later(0 if self.offline_ready() else 0.1, self.offline_step)
+
+    def threadsafe(self, func, *args):
+        """
+        Метод вызова функции в потоке сервера.
+        Используется для вызовов из потока графического интерфейса.
+        Возвращает concurrent.futures.Future с результатом вызова.
+        """
+        future = concurrent.futures.Future()
+        if self.loop is None or threading.current_thread() is self:
+            run_call(future, func, args)
+        else:
+            self.loop.call_soon_threadsafe(run_call, future, func, args)
+        return future
+
+    def remove_client(self, client):
+        """Метод отключения клиента, безопасный для вызова из любого потока."""
+        self.threadsafe(super().remove_client, client)
@@ -1,22 +1,156 @@
 import binascii
+import collections
+import concurrent.futures
+import hashlib
 import hmac
-import json
 import logging
 import os
 import select
 import socket
 import threading
+import time
 
 from common.decos import login_required
 from common.descryptors import Port
 from common.metaclasses import ServerMaker
-from common.utils import get_message, send_message
+from common.utils import MessageDecoder, encode_message, send_message
 from common.variables import *
+from server.dispatch import find_handler, message_handler
+from server.sessions import SessionRegistry
 
 # Загрузка логера
 logger = logging.getLogger("server")
 
 
+def run_call(future, func, args):
+    """
+    Функция выполнения вызова, переданного из другого потока.
+    Результат или исключение вызова передаются в future. Ошибка вызова,
+    например удаление уже удалённого пользователя из окна сервера,
+    записывается в лог и не должна останавливать сервер.
+    """
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        result = func(*args)
+    except Exception as err:
+        logger.exception(f"Ошибка выполнения вызова {func} в потоке сервера.")
+        future.set_exception(err)
+    else:
+        future.set_result(result)
+
+
+class ClientConnection:
+    """
+    Класс - соединение с клиентом для движка select.
+    Оборачивает сокет клиента и хранит буфер сборки входящих
+    сообщений с выбранным режимом передачи, очередь исходящих
+    данных, которая отправляется при готовности сокета к записи,
+    и состояние авторизации.
+    """
+
+    def __init__(self, sock, server, address):
+        self.sock = sock
+        self.server = server
+        # Адрес клиента запоминаем при подключении: после сброса
+        # соединения сокет его уже не вернёт.
+        self.address = address
+        self.decoder = MessageDecoder()
+        # Ожидаемый ответ на запрос 511: (сообщение presence, хэш) или None
+        self.auth_pending = None
+        # Момент, до которого клиент должен авторизоваться, None - авторизован
+        self.auth_deadline = time.monotonic() + server.handshake_timeout
+        # Очередь исходящих данных и всего принятых в неё байт
+        self.outbuf = bytearray()
+        self.written = 0
+        # Чтение приостановлено до разгрузки очереди (политика pause)
+        self.paused = False
+
+    @property
+    def framed(self):
+        """Передаются ли сообщения с заголовком длины."""
+        return self.decoder.framed
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    @property
+    def queue_size(self):
+        """Размер очереди исходящих данных в байтах."""
+        return len(self.outbuf)
+
+    @property
+    def flushed(self):
+        """Всего байт, переданных из очереди в сокет."""
+        return self.written - len(self.outbuf)
+
+    def send(self, data):
+        """
+        Метод постановки данных в очередь отправки.
+        При переполнении очереди применяет политику сервера
+        для медленных клиентов.
+        """
+        if len(self.outbuf) >= self.server.high_watermark:
+            if self.server.slow_policy == "drop":
+                logger.warning(
+                    f"Очередь клиента {self.getpeername()} переполнена, сообщение отброшено."
+                )
+                return 0
+            elif self.server.slow_policy == "disconnect":
+                raise ConnectionAbortedError("Очередь отправки переполнена")
+            self.paused = True
+        self.outbuf += data
+        self.written += len(data)
+        return len(data)
+
+    def flush(self):
+        """Метод отправки накопленных данных, вызывается при готовности сокета."""
+        if self.outbuf:
+            sent = self.sock.send(self.outbuf)
+            del self.outbuf[:sent]
+        if self.paused and len(self.outbuf) <= self.server.low_watermark:
+            self.paused = False
+
+    def getpeername(self):
+        return self.address
+
+    def close(self):
+        # Ответ об ошибке перед закрытием отправляем без ожидания.
+        if self.outbuf:
+            try:
+                self.sock.setblocking(False)
+                self.sock.send(self.outbuf)
+            except OSError:
+                pass
+        self.sock.close()
+
+
+class OfflineDelivery:
+    """Класс - состояние доставки отложенных сообщений одному клиенту."""
+
+    __slots__ = ("delivered", "limit", "rows", "mark", "done")
+
+    def __init__(self):
+        # Сообщений отправлено за этот вход и их предел, None - без
+        # предела: за очередью ждёт новое сообщение.
+        self.delivered = 0
+        self.limit = OFFLINE_LOGIN_LIMIT
+        # id сообщений порции, ещё не переданной в сокет, и количество
+        # байт, принятых в очередь клиента вместе с ней.
+        self.rows = []
+        self.mark = 0
+        # Отправлена последняя порция
+        self.done = False
+
+    @property
+    def capped(self):
+        """Отправлен ли предел сообщений за этот вход."""
+        return self.limit is not None and self.delivered >= self.limit
+
+
 class MessageProcessor(threading.Thread):
     """
     Основной класс сервера. Принимает содинения, словари - пакеты
@@ -26,19 +160,44 @@ class MessageProcessor(threading.Thread):
 
     port = Port()
 
-    def __init__(self, listen_address, listen_port, database):
+    def __init__(
+        self,
+        listen_address,
+        listen_port,
+        database,
+        high_watermark=WRITE_HIGH_WATERMARK,
+        low_watermark=WRITE_LOW_WATERMARK,
+        slow_policy=SLOW_CONSUMER_POLICY,
+        handshake_timeout=HANDSHAKE_TIMEOUT,
+        stats_interval=STATS_FLUSH_INTERVAL,
+        router=None,
+    ):
         # Параментры подключения
         self.addr = listen_address
         self.port = listen_port
 
+        # Границы очереди отправки клиенту и политика для медленных
+        # клиентов: pause - не читать от клиента, drop - отбрасывать
+        # сообщения, disconnect - отключать клиента.
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.slow_policy = slow_policy
+
+        # Время на авторизацию после подключения в секундах
+        self.handshake_timeout = handshake_timeout
+
         # База данных сервера
         self.database = database
 
+        # Интервал записи статистики сообщений в базу и время следующей записи
+        self.stats_interval = stats_interval
+        self.stats_flush_at = time.monotonic() + stats_interval
+
         # Сокет, через который будет осуществляться работа
         self.sock = None
 
-        # Список подключённых клиентов.
-        self.clients = []
+        # Реестр подключённых клиентов и авторизованных пользователей.
+        self.sessions = SessionRegistry()
 
         # Сокеты
         self.listen_sockets = None
@@ -47,12 +206,31 @@ class MessageProcessor(threading.Thread):
         # Флаг продолжения работы
         self.running = True
 
-        # Словарь содержащий сопоставленные имена и соответствующие им сокеты.
-        self.names = dict()
+        # Связь с другими рабочими процессами сервера (режим workers),
+        # None если сервер работает в одном процессе.
+        self.router = router
+
+        # Вызовы из других потоков и сокет для пробуждения основного цикла.
+        self.calls = collections.deque()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+
+        # Клиенты, которым отправляются отложенные сообщения: соединение -
+        # состояние доставки OfflineDelivery.
+        self.offline_delivery = dict()
+
+        # Версия справочника пользователей, изменения которой уже
+        # разосланы клиентам.
+        self.users_version = database.users_version()
 
         # Конструктор предка
         super().__init__()
 
+    @property
+    def names(self):
+        """Словарь имя пользователя - соединение авторизованных клиентов."""
+        return self.sessions.names
+
     def run(self):
         """Метод основной цикл потока."""
         # Инициализация Сокета
@@ -60,39 +238,149 @@ class MessageProcessor(threading.Thread):
 
         # Основной цикл программы сервера
         while self.running:
-            # Ждём подключения, если таймаут вышел, ловим исключение.
-            try:
-                client, client_address = self.sock.accept()
-            except OSError:
-                pass
-            else:
-                logger.info(f"Установлено соедение с ПК {client_address}")
-                client.settimeout(5)
-                self.clients.append(client)
-
+            # Ждём готовности слушающего сокета, клиентов с данными и
+            # клиентов, которым есть что отправить. От клиентов с
+            # переполненной очередью отправки не читаем.
+            readers = [client for client in self.sessions if not client.paused]
+            writers = [client for client in self.sessions if client.outbuf]
             recv_data_lst = []
-            send_data_lst = []
-            err_lst = []
-            # Проверяем на наличие ждущих клиентов
+            self.listen_sockets = []
+            # Пока есть кому отправлять отложенные сообщения, не ждём.
+            timeout = 0 if self.offline_ready() else 0.5
             try:
-                if self.clients:
-                    (
-                        recv_data_lst,
-                        self.listen_sockets,
-                        self.error_sockets,
-                    ) = select.select(self.clients, self.clients, [], 0)
+                recv_data_lst, self.listen_sockets, self.error_sockets = select.select(
+                    [self.sock, self.wakeup_reader] + readers, writers, [], timeout
+                )
             except OSError as err:
                 logger.error(f"Ошибка работы с сокетами: {err.errno}")
 
+            # Вызовы, переданные из других потоков
+            if self.wakeup_reader in recv_data_lst:
+                recv_data_lst.remove(self.wakeup_reader)
+                self.run_calls()
+
+            # Новое подключение
+            if self.sock in recv_data_lst:
+                recv_data_lst.remove(self.sock)
+                self.accept_client()
+
             # принимаем сообщения и если ошибка, исключаем клиента.
-            if recv_data_lst:
-                for client_with_message in recv_data_lst:
-                    try:
-                        self.process_client_message(
-                            get_message(client_with_message), client_with_message
-                        )
-                    except (OSError, json.JSONDecodeError, TypeError):
-                        self.remove_client(client_with_message)
+            for client_with_message in recv_data_lst:
+                if client_with_message not in self.sessions:
+                    continue
+                # Ошибка данных одного клиента отключает только его.
+                # ValueError - в том числе ошибки разбора JSON и UTF-8.
+                try:
+                    self.process_client_data(client_with_message)
+                except (OSError, KeyError, TypeError, ValueError):
+                    self.remove_client(client_with_message)
+
+            # Отправляем накопленные данные клиентам, готовым к приёму.
+            for client in self.listen_sockets:
+                if client not in self.sessions:
+                    continue
+                try:
+                    client.flush()
+                except OSError:
+                    self.remove_client(client)
+
+            # Отключаем клиентов, не успевших авторизоваться.
+            self.check_handshakes()
+
+            # Отправляем очередные порции отложенных сообщений.
+            if self.offline_delivery:
+                self.deliver_offline()
+
+            self.check_flush()
+
+        # Выполняем вызовы, поступившие при остановке, чтобы не
+        # оставить их ожидающих. Сохраняем данные, накопленные с
+        # последней записи.
+        self.run_calls()
+        self.database.flush()
+
+    def check_flush(self):
+        """
+        Метод записи в базу накопленной статистики сообщений и копии
+        списка активных пользователей, если подошёл срок.
+        """
+        now = time.monotonic()
+        if now >= self.stats_flush_at:
+            self.stats_flush_at = now + self.stats_interval
+            self.database.flush()
+
+    def threadsafe(self, func, *args):
+        """
+        Метод вызова функции в потоке сервера.
+        Используется для вызовов из других потоков. Возвращает
+        concurrent.futures.Future, по которому можно дождаться
+        выполнения вызова и получить его результат или исключение.
+        """
+        future = concurrent.futures.Future()
+        if not self.is_alive() or threading.current_thread() is self:
+            run_call(future, func, args)
+        else:
+            self.calls.append((future, func, args))
+            try:
+                self.wakeup_writer.send(b"\0")
+            except OSError:
+                pass
+        return future
+
+    def run_calls(self):
+        """Метод выполнения вызовов, переданных из других потоков."""
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except OSError:
+            pass
+        while self.calls:
+            run_call(*self.calls.popleft())
+
+    def accept_client(self):
+        """Метод приёма нового подключения."""
+        try:
+            client, client_address = self.sock.accept()
+        except OSError:
+            return
+        logger.info(f"Установлено соедение с ПК {client_address}")
+        client.settimeout(5)
+        self.sessions.add(ClientConnection(client, self, client_address))
+
+    def process_client_data(self, client):
+        """
+        Метод чтения данных клиента. За одно чтение может быть получено
+        несколько сообщений, все они передаются обработчику по очереди.
+        """
+        data = client.recv(MAX_PACKAGE_LENGTH)
+        if not data:
+            raise ConnectionResetError
+        for message in client.decoder.feed(data):
+            # Клиент мог быть отключён обработчиком предыдущего сообщения.
+            if client not in self.sessions:
+                break
+            self.handle_message(message, client)
+
+    def handle_message(self, message, client):
+        """
+        Метод передачи сообщения клиента обработчику.
+        Если клиенту отправлен запрос 511, сообщение - ответ на него.
+        """
+        if client.auth_pending:
+            presence, digest = client.auth_pending
+            client.auth_pending = None
+            self.auth_response(presence, client, digest, message)
+        else:
+            self.process_client_message(message, client)
+
+    def check_handshakes(self):
+        """Метод отключения клиентов, не авторизовавшихся вовремя."""
+        now = time.monotonic()
+        for client in self.sessions.expired(now):
+            logger.warning(
+                f"Клиент {client.getpeername()} не авторизовался за {self.handshake_timeout} с, соединение закрыто."
+            )
+            self.remove_client(client)
 
     def remove_client(self, client):
         """
@@ -100,14 +388,38 @@ class MessageProcessor(threading.Thread):
         Ищет клиента и удаляет его из списков и базы:
         """
         logger.info(f"Клиент {client.getpeername()} отключился от сервера.")
-        for name in self.names:
-            if self.names[name] == client:
-                self.database.user_logout(name)
-                del self.names[name]
-                break
-        self.clients.remove(client)
+        name = self.sessions.remove(client)
+        self.offline_delivery.pop(client, None)
+        if name is not None:
+            self.database.user_logout(name)
+            if self.router:
+                self.router.announce_logout(name)
         client.close()
 
+    def kick_user(self, name):
+        """
+        Метод отключения пользователя, удалённого из базы.
+        Безопасен для вызова из любого потока.
+        """
+
+        def kick():
+            # Пользователя в базе уже нет, убираем его только из списка
+            # активных.
+            client = self.sessions.forget(name)
+            self.database.user_logout(name)
+            if client:
+                if self.router:
+                    self.router.announce_logout(name)
+                self.remove_client(client)
+
+        self.threadsafe(kick)
+
+    def is_online(self, name):
+        """Метод проверки, подключён ли пользователь к этому или другому процессу."""
+        if name in self.names:
+            return True
+        return bool(self.router) and self.router.owner(name) is not None
+
     def init_socket(self):
         """Метод инициализатор сокета."""
         logger.info(
@@ -115,6 +427,12 @@ class MessageProcessor(threading.Thread):
         )
         # Готовим сокет
         transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Перезапущенный сервер сразу занимает порт, не дожидаясь закрытия
+        # соединений прежнего, иначе клиентам некуда переподключаться.
+        transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Рабочие процессы слушают один порт, соединения распределяет ОС.
+        if self.router:
+            transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         transport.bind((self.addr, self.port))
         transport.settimeout(0.5)
 
@@ -125,247 +443,499 @@ class MessageProcessor(threading.Thread):
     def process_message(self, message):
         """
         Метод отправки сообщения клиенту.
+        Сообщение ставится в очередь отправки получателя.
         """
-        if (
-            message[DESTINATION] in self.names
-            and self.names[message[DESTINATION]] in self.listen_sockets
-        ):
+        if message[DESTINATION] in self.names:
+            destination = self.names[message[DESTINATION]]
+            # Пока получателю доставляются отложенные сообщения, новое
+            # ставится в ту же очередь, иначе оно придёт раньше старых.
+            delivery = self.offline_delivery.get(destination)
+            if delivery is not None:
+                self.database.store_offline_message(
+                    message[SENDER],
+                    message[DESTINATION],
+                    message,
+                    message.get(MESSAGE_ID),
+                )
+                delivery.limit = None
+                delivery.done = False
+                self.schedule_offline_delivery()
+                logger.info(
+                    f"Сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]} поставлено в очередь отложенных."
+                )
+                return
             try:
-                send_message(self.names[message[DESTINATION]], message)
+                send_message(destination, message)
                 logger.info(
                     f"Отправлено сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]}."
                 )
             except OSError:
-                self.remove_client(message[DESTINATION])
-        elif (
-            message[DESTINATION] in self.names
-            and self.names[message[DESTINATION]] not in self.listen_sockets
-        ):
-            logger.error(
-                f"Связь с клиентом {message[DESTINATION]} была потеряна. Соединение закрыто, доставка невозможна."
+                logger.error(
+                    f"Связь с клиентом {message[DESTINATION]} была потеряна. Соединение закрыто, доставка невозможна."
+                )
+                self.remove_client(destination)
+        # Получатель подключён к другому рабочему процессу.
+        elif self.router and self.router.forward(message):
+            logger.info(
+                f"Сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]} передано другому процессу."
             )
-            self.remove_client(self.names[message[DESTINATION]])
         else:
             logger.error(
                 f"Пользователь {message[DESTINATION]} не зарегистрирован на сервере, отправка сообщения невозможна."
             )
 
+    def reply(self, message, client, response):
+        """
+        Метод отправки ответа на сообщение клиента.
+        Идентификатор запроса из сообщения повторяется в ответе, по нему
+        клиент находит ожидающий ответа запрос. Если отправить ответ не
+        удалось, клиент отключается.
+        """
+        if REQUEST_ID in message:
+            response = dict(response)
+            response[REQUEST_ID] = message[REQUEST_ID]
+        try:
+            send_message(client, response)
+        except OSError:
+            self.remove_client(client)
+
     @login_required
     def process_client_message(self, message, client):
-        """Метод отбработчик поступающих сообщений."""
+        """
+        Метод отбработчик поступающих сообщений.
+        Находит обработчик по действию сообщения в реестре HANDLERS,
+        если действие неизвестно или сообщение некорректно, отвечает 400.
+        """
         logger.debug(f"Разбор сообщения от клиента : {message}")
-        # Если это сообщение о присутствии, принимаем и отвечаем
-        if (
-            ACTION in message
-            and message[ACTION] == PRESENCE
-            and TIME in message
-            and USER in message
-        ):
-            # Если сообщение о присутствии то вызываем функцию авторизации.
-            self.autorize_user(message, client)
+        handler = find_handler(message, client, self)
+        if handler is not None:
+            handler(self, message, client)
+        # Иначе отдаём Bad request
+        else:
+            response = RESPONSE_400
+            response[ERROR] = "Запрос некорректен."
+            self.reply(message, client, response)
 
-        # Если это сообщение, то отправляем его получателю.
-        elif (
-            ACTION in message
-            and message[ACTION] == MESSAGE
-            and DESTINATION in message
-            and TIME in message
-            and SENDER in message
-            and MESSAGE_TEXT in message
-            and self.names[message[SENDER]] == client
-        ):
-            if message[DESTINATION] in self.names:
+    @message_handler(PRESENCE, keys=(TIME,), nested={USER: (ACCOUNT_NAME, PUBLIC_KEY)})
+    def on_presence(self, message, client):
+        """Обработчик сообщения о присутствии: вызывает авторизацию."""
+        self.autorize_user(message, client)
+
+    @message_handler(
+        MESSAGE, keys=(DESTINATION, TIME, SENDER, MESSAGE_TEXT), owner=SENDER
+    )
+    def on_message(self, message, client):
+        """
+        Обработчик сообщения пользователю: отправляет его получателю.
+        Если получатель зарегистрирован, но не подключён, сообщение
+        сохраняется в базе до его входа.
+        """
+        if self.is_online(message[DESTINATION]):
+            self.database.process_message(message[SENDER], message[DESTINATION])
+            self.process_message(message)
+            self.reply(message, client, RESPONSE_200)
+        elif self.database.check_user(message[DESTINATION]):
+            if self.database.store_offline_message(
+                message[SENDER],
+                message[DESTINATION],
+                message,
+                message.get(MESSAGE_ID),
+            ):
                 self.database.process_message(message[SENDER], message[DESTINATION])
-                self.process_message(message)
-                try:
-                    send_message(client, RESPONSE_200)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = "Пользователь не зарегистрирован на сервере."
-                try:
-                    send_message(client, response)
-                except OSError:
-                    pass
+                logger.info(
+                    f"Сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]} сохранено до его входа."
+                )
+            self.reply(message, client, RESPONSE_200)
+        else:
+            response = RESPONSE_400
+            response[ERROR] = "Пользователь не зарегистрирован на сервере."
+            self.reply(message, client, response)
+
+    @message_handler(EXIT, keys=(ACCOUNT_NAME,), owner=ACCOUNT_NAME)
+    def on_exit(self, message, client):
+        """Обработчик выхода клиента."""
+        self.remove_client(client)
+
+    @message_handler(GET_CONTACTS, keys=(USER,), owner=USER)
+    def on_get_contacts(self, message, client):
+        """Обработчик запроса контакт-листа."""
+        response = RESPONSE_202
+        response[LIST_INFO] = self.database.get_contacts(message[USER])
+        self.reply(message, client, response)
+
+    @message_handler(ADD_CONTACT, keys=(ACCOUNT_NAME, USER), owner=USER)
+    def on_add_contact(self, message, client):
+        """Обработчик добавления контакта."""
+        self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+        self.reply(message, client, RESPONSE_200)
+
+    @message_handler(REMOVE_CONTACT, keys=(ACCOUNT_NAME, USER), owner=USER)
+    def on_remove_contact(self, message, client):
+        """Обработчик удаления контакта."""
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        self.reply(message, client, RESPONSE_200)
+
+    @message_handler(USERS_REQUEST, keys=(ACCOUNT_NAME,), owner=ACCOUNT_NAME)
+    def on_users_request(self, message, client):
+        """
+        Обработчик запроса известных пользователей.
+        Вместе со списком передаётся версия справочника, от которой
+        клиент может запрашивать изменения.
+        """
+        # Версию читаем до списка: изменения, внесённые между запросами,
+        # клиент получит повторно, но не потеряет.
+        response = dict(RESPONSE_202)
+        response[USERS_VERSION] = self.database.users_version()
+        response[LIST_INFO] = [user[0] for user in self.database.users_list()]
+        self.reply(message, client, response)
+
+    @message_handler(
+        USERS_CHANGES_REQUEST, keys=(ACCOUNT_NAME, USERS_VERSION), owner=ACCOUNT_NAME
+    )
+    def on_users_changes_request(self, message, client):
+        """
+        Обработчик запроса изменений справочника пользователей после
+        указанной версии. Если такой версии не было, клиент получает
+        полный список, как в ответ на запрос известных пользователей.
+        """
+        changes = self.database.users_changes(message[USERS_VERSION])
+        if changes is None:
+            self.on_users_request(message, client)
             return
+        response = dict(RESPONSE_206)
+        response[USERS_VERSION], response[ADDED], response[REMOVED] = changes
+        self.reply(message, client, response)
+
+    @message_handler(PUBLIC_KEY_REQUEST, keys=(ACCOUNT_NAME,))
+    def on_public_key_request(self, message, client):
+        """Обработчик запроса публичного ключа пользователя."""
+        response = RESPONSE_511
+        response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
+        # может быть, что ключа ещё нет (пользователь никогда не логинился,
+        # тогда шлём 400)
+        if response[DATA]:
+            self.reply(message, client, response)
+        else:
+            response = RESPONSE_400
+            response[ERROR] = "Нет публичного ключа для данного пользователя"
+            self.reply(message, client, response)
 
-        # Если клиент выходит
-        elif (
-            ACTION in message
-            and message[ACTION] == EXIT
-            and ACCOUNT_NAME in message
-            and self.names[message[ACCOUNT_NAME]] == client
-        ):
-            self.remove_client(client)
+    def autorize_user(self, message, sock):
+        """
+        Метод реализующий авторизцию пользователей.
+        Отправляет запрос 511 и не дожидается ответа: ответ клиента
+        обрабатывается при его поступлении в handle_message, а если
+        клиент не ответит вовремя, его отключит check_handshakes.
+        """
+        if RESUME_TOKEN in message and self.resume_session(message, sock):
+            return
+        if not self.check_presence(message, sock):
+            return
+        message_auth, digest = self.auth_request(
+            message[USER][ACCOUNT_NAME], message.get(FRAMING, False)
+        )
+        sock.auth_pending = (message, digest)
+        try:
+            send_message(sock, message_auth)
+        except OSError:
+            self.remove_client(sock)
+            return
+        self.switch_framing(message, sock)
 
-        # Если это запрос контакт-листа
-        elif (
-            ACTION in message
-            and message[ACTION] == GET_CONTACTS
-            and USER in message
-            and self.names[message[USER]] == client
+    def resume_session(self, message, sock):
+        """
+        Метод восстановления сессии по токену, выданному при прошлом входе.
+        Клиент с токеном уже работал с сервером в режиме с заголовком
+        длины, поэтому все ответы на такой presence передаются с
+        заголовком. Если токен верен, пользователь входит без запроса
+        511 с сохранённым на сервере открытым ключом, а его прежнее
+        соединение с этим процессом, если сервер ещё не заметил разрыва,
+        закрывается. Возвращает False, если токен не подошёл и нужна
+        обычная авторизация.
+        """
+        self.switch_framing(message, sock)
+        username = message[USER][ACCOUNT_NAME]
+        if not self.check_resume_token(username, message[RESUME_TOKEN]):
+            logger.info(f"Токен пользователя {username} не принят.")
+            return False
+        previous = self.names.get(username)
+        if previous is not None:
+            self.remove_client(previous)
+        if self.check_presence(message, sock):
+            logger.info(f"Пользователь {username} восстановил сессию.")
+            # Ключ из сообщения не подтверждён паролем, поэтому не
+            # заменяет ключ, сохранённый при прошлом входе.
+            self.login_user(message, sock, self.database.get_pubkey(username))
+        return True
+
+    def resume_token(self, username):
+        """
+        Метод выдачи токена восстановления сессии.
+        Токен - срок действия, случайная метка и подпись имени, срока и
+        метки ключом - хэшем пароля пользователя. Хранилище помнит метку
+        последнего выданного токена, поэтому токен принимается один раз
+        любым рабочим процессом и сервером после перезапуска. Новый вход,
+        смена пароля или удаление пользователя делает токены
+        недействительными.
+        """
+        expires = str(int(time.time()) + RESUME_TOKEN_LIFETIME)
+        nonce = binascii.hexlify(os.urandom(16)).decode("ascii")
+        self.database.set_resume_nonce(username, nonce)
+        return f"{expires}:{nonce}:{self.resume_signature(username, expires, nonce)}"
+
+    def resume_signature(self, username, expires, nonce):
+        """Метод вычисления подписи токена восстановления сессии."""
+        return hmac.new(
+            self.database.get_hash(username),
+            f"{username}:{expires}:{nonce}".encode(ENCODING),
+            hashlib.sha256,
+        ).hexdigest()
+
+    def check_resume_token(self, username, token):
+        """
+        Метод проверки токена восстановления сессии.
+        Принятый токен использован: при входе выдаётся новый.
+        """
+        try:
+            expires, nonce, signature = str(token).split(":")
+            if int(expires) < time.time():
+                return False
+        except ValueError:
+            return False
+        if not self.database.check_user(username):
+            return False
+        if not hmac.compare_digest(
+            signature, self.resume_signature(username, expires, nonce)
         ):
-            response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+            return False
+        return self.database.take_resume_nonce(username, nonce)
 
-        # Если это добавление контакта
-        elif (
-            ACTION in message
-            and message[ACTION] == ADD_CONTACT
-            and ACCOUNT_NAME in message
-            and USER in message
-            and self.names[message[USER]] == client
-        ):
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
+    def check_presence(self, message, sock):
+        """
+        Метод проверки сообщения о присутствии перед авторизацией.
+        Если имя занято или пользователь не зарегистрирован, отвечает 400,
+        закрывает соединение и возвращает False.
+        """
+        # Если имя пользователя уже занято то возвращаем 400
+        if self.is_online(message[USER][ACCOUNT_NAME]):
+            self.reject_client(sock, "Имя пользователя уже занято.")
+        # Проверяем что пользователь зарегистрирован на сервере.
+        elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
+            self.reject_client(sock, "Пользователь не зарегистрирован.")
+        else:
+            return True
+        return False
+
+    def reject_client(self, sock, error):
+        """Метод отказа в авторизации: отвечает 400 и закрывает соединение."""
+        response = dict(RESPONSE_400)
+        response[ERROR] = error
+        try:
+            send_message(sock, response)
+        except OSError:
+            pass
+        self.sessions.remove(sock)
+        sock.close()
+
+    def switch_framing(self, message, sock):
+        """
+        Метод включения режима передачи с заголовком длины.
+        Вызывается после отправки запроса 511, если клиент запросил
+        этот режим в сообщении presence: все следующие сообщения
+        в обе стороны передаются с заголовком.
+        """
+        if message.get(FRAMING):
+            sock.decoder.framed = True
 
-        # Если это удаление контакта
+    def auth_request(self, username, framing=False):
+        """
+        Метод формирования запроса 511 для авторизации.
+        Возвращает словарь - запрос и серверную версию хэша,
+        с которой сравнивается ответ клиента.
+        """
+        # Словарь - заготовка
+        message_auth = RESPONSE_511.copy()
+        # Подтверждаем клиенту переход на сообщения с заголовком длины.
+        if framing:
+            message_auth[FRAMING] = True
+        # Набор байтов в hex представлении
+        random_str = binascii.hexlify(os.urandom(64))
+        # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
+        message_auth[DATA] = random_str.decode("ascii")
+        # Создаём хэш пароля и связки с рандомной строкой, сохраняем
+        # серверную версию ключа
+        hash = hmac.new(self.database.get_hash(username), random_str, AUTH_DIGEST)
+        return message_auth, hash.digest()
+
+    def auth_response(self, message, sock, digest, ans):
+        """Метод проверки ответа клиента на запрос 511."""
+        try:
+            client_digest = binascii.a2b_base64(ans[DATA])
+        except (KeyError, TypeError, ValueError):
+            client_digest = b""
+        # Пока клиент вычислял ответ, под этим именем мог войти другой,
+        # а пользователя могли удалить.
+        if self.is_online(message[USER][ACCOUNT_NAME]):
+            self.reject_client(sock, "Имя пользователя уже занято.")
+        elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
+            self.reject_client(sock, "Пользователь не зарегистрирован.")
+        # Если ответ клиента корректный, то сохраняем его в список
+        # пользователей.
         elif (
-            ACTION in message
-            and message[ACTION] == REMOVE_CONTACT
-            and ACCOUNT_NAME in message
-            and USER in message
-            and self.names[message[USER]] == client
+            RESPONSE in ans
+            and ans[RESPONSE] == 511
+            and hmac.compare_digest(digest, client_digest)
         ):
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
+            self.login_user(message, sock)
+        else:
+            self.reject_client(sock, "Неверный пароль.")
 
-        # Если это запрос известных пользователей
-        elif (
-            ACTION in message
-            and message[ACTION] == USERS_REQUEST
-            and ACCOUNT_NAME in message
-            and self.names[message[ACCOUNT_NAME]] == client
-        ):
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0] for user in self.database.users_list()]
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+    def login_user(self, message, sock, pubkey=None):
+        """
+        Метод входа авторизованного пользователя.
+        Ответ 200 содержит токен, по которому клиент может восстановить
+        сессию после разрыва соединения без повторной авторизации.
+        pubkey - сохраняемый открытый ключ, по умолчанию ключ из сообщения.
+        """
+        username = message[USER][ACCOUNT_NAME]
+        if pubkey is None:
+            pubkey = message[USER][PUBLIC_KEY]
+        client_ip, client_port = sock.getpeername()
+        # добавляем пользователя в список активных и если у него изменился открытый ключ
+        # сохраняем новый. Если пользователя удалил другой процесс
+        # сервера, его запись в кэше устарела, и вход не выполняется.
+        try:
+            self.database.user_login(username, client_ip, client_port, pubkey)
+        except ValueError:
+            self.reject_client(sock, "Пользователь не зарегистрирован.")
+            return
+        self.sessions.authenticate(sock, username)
+        if self.router:
+            self.router.announce_login(username, client_ip, client_port)
+        response = dict(RESPONSE_200)
+        response[RESUME_TOKEN] = self.resume_token(username)
+        try:
+            send_message(sock, response)
+        except OSError:
+            self.remove_client(sock)
+            return
+        # Клиент готов принять сообщения, поступившие пока он был
+        # отключён. Без заголовка длины клиент не сможет разделить
+        # отправленные подряд сообщения, поэтому им не отправляем.
+        if message.get(OFFLINE) and sock.framed:
+            self.start_offline_delivery(sock)
+
+    def start_offline_delivery(self, client):
+        """Метод постановки клиента в очередь доставки отложенных сообщений."""
+        self.offline_delivery[client] = OfflineDelivery()
+        self.schedule_offline_delivery()
+
+    def schedule_offline_delivery(self):
+        """
+        Метод планирования доставки отложенных сообщений. Движок select
+        проверяет готовность доставки в каждом проходе цикла.
+        """
 
-        # Если это запрос публичного ключа пользователя
-        elif (
-            ACTION in message
-            and message[ACTION] == PUBLIC_KEY_REQUEST
-            and ACCOUNT_NAME in message
-        ):
-            response = RESPONSE_511
-            response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
-            # может быть, что ключа ещё нет (пользователь никогда не логинился,
-            # тогда шлём 400)
-            if response[DATA]:
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = "Нет публичного ключа для данного пользователя"
+    def offline_ready(self):
+        """Метод проверки, есть ли клиент, готовый принять отложенные сообщения."""
+        for client, delivery in self.offline_delivery.items():
+            if delivery.rows:
+                if client.flushed >= delivery.mark:
+                    return True
+                continue
+            if delivery.capped:
+                continue
+            if not client.paused and client.queue_size < self.high_watermark:
+                return True
+        return False
+
+    def deliver_offline(self):
+        """
+        Метод отправки очередной порции отложенных сообщений.
+        За один вызов каждому клиенту отправляется не больше
+        OFFLINE_BATCH_SIZE сообщений одной записью в очередь, и только
+        если его очередь отправки не переполнена, поэтому большой
+        объём отложенных сообщений не задерживает остальных клиентов.
+        За один вход отправляется не больше OFFLINE_LOGIN_LIMIT
+        сообщений, остальные - при следующем входе. Пока клиент в
+        очереди доставки, новые сообщения ему тоже ставятся в очередь и
+        снимают предел, чтобы сообщения приходили по порядку. Клиент
+        остаётся в очереди доставки, пока в ней есть его сообщения.
+        Сообщения удаляются из базы, только когда
+        порция целиком передана из очереди в сокет, до этого следующая
+        порция не отправляется. Если клиент отключился раньше или
+        порция отброшена политикой drop, сообщения остаются в базе.
+        """
+        for client, delivery in list(self.offline_delivery.items()):
+            name = self.sessions.name_of(client)
+            if delivery.rows:
+                if client.flushed < delivery.mark:
+                    continue
+                self.database.remove_offline_messages(delivery.rows)
+                logger.info(
+                    f"Пользователю {name} отправлено {len(delivery.rows)} отложенных сообщений."
+                )
+                delivery.rows = []
+            if delivery.done:
+                del self.offline_delivery[client]
+                continue
+            if delivery.capped:
+                continue
+            if client.paused or client.queue_size >= self.high_watermark:
+                continue
+            limit = OFFLINE_BATCH_SIZE
+            if delivery.limit is not None:
+                limit = min(limit, delivery.limit - delivery.delivered)
+            rows = self.database.get_offline_messages(name, limit)
+            if rows:
+                data = b"".join(encode_message(message, True) for _, message in rows)
                 try:
-                    send_message(client, response)
+                    accepted = client.send(data)
                 except OSError:
                     self.remove_client(client)
+                    continue
+                if accepted < len(data):
+                    continue
+                delivery.rows = [row_id for row_id, _ in rows]
+                delivery.mark = client.written
+                delivery.delivered += len(rows)
+            delivery.done = len(rows) < limit
+            if delivery.done and not delivery.rows:
+                del self.offline_delivery[client]
 
-        # Иначе отдаём Bad request
-        else:
-            response = RESPONSE_400
-            response[ERROR] = "Запрос некорректен."
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+    def service_update_lists(self):
+        """
+        Метод рассылки клиентам сообщения 205 об изменении справочника
+        пользователей. Сообщение содержит добавленных и удалённых
+        пользователей с момента прошлой рассылки, клиенту с той же
+        версией справочника не нужно запрашивать списки заново.
+        Безопасен для вызова из любого потока.
+        """
 
-    def autorize_user(self, message, sock):
-        """Метод реализующий авторизцию пользователей."""
-        # Если имя пользователя уже занято то возвращаем 400
-        if message[USER][ACCOUNT_NAME] in self.names.keys():
-            response = RESPONSE_400
-            response[ERROR] = "Имя пользователя уже занято."
-            try:
-                send_message(sock, response)
-            except OSError:
-                pass
-            self.clients.remove(sock)
-            sock.close()
-        # Проверяем что пользователь зарегистрирован на сервере.
-        elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
-            response = RESPONSE_400
-            response[ERROR] = "Пользователь не зарегистрирован."
-            try:
-                send_message(sock, response)
-            except OSError:
-                pass
-            self.clients.remove(sock)
-            sock.close()
-        else:
-            # Иначе отвечаем 511 и проводим процедуру авторизации
-            # Словарь - заготовка
-            message_auth = RESPONSE_511
-            # Набор байтов в hex представлении
-            random_str = binascii.hexlify(os.urandom(64))
-            # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
-            message_auth[DATA] = random_str.decode("ascii")
-            # Создаём хэш пароля и связки с рандомной строкой, сохраняем
-            # серверную версию ключа
-            hash = hmac.new(
-                self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str
-            )
-            digest = hash.digest()
-            try:
-                # Обмен с клиентом
-                send_message(sock, message_auth)
-                ans = get_message(sock)
-            except OSError:
-                sock.close()
+        def update():
+            version, added, removed = self.database.users_changes(self.users_version)
+            if version == self.users_version:
                 return
-            client_digest = binascii.a2b_base64(ans[DATA])
-            # Если ответ клиента корректный, то сохраняем его в список
-            # пользователей.
-            if (
-                RESPONSE in ans
-                and ans[RESPONSE] == 511
-                and hmac.compare_digest(digest, client_digest)
-            ):
-                self.names[message[USER][ACCOUNT_NAME]] = sock
-                client_ip, client_port = sock.getpeername()
+            # Пользователи могли быть изменены другим процессом.
+            for name in added + removed:
+                self.database.forget_user(name)
+            message = dict(RESPONSE_205)
+            message[SINCE_VERSION] = self.users_version
+            message[USERS_VERSION] = version
+            message[ADDED] = added
+            message[REMOVED] = removed
+            self.users_version = version
+            for client in list(self.names.values()):
                 try:
-                    send_message(sock, RESPONSE_200)
+                    send_message(client, message)
                 except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-                # добавляем пользователя в список активных и если у него изменился открытый ключ
-                # сохраняем новый
-                self.database.user_login(
-                    message[USER][ACCOUNT_NAME],
-                    client_ip,
-                    client_port,
-                    message[USER][PUBLIC_KEY],
-                )
-            else:
-                response = RESPONSE_400
-                response[ERROR] = "Неверный пароль."
-                try:
-                    send_message(sock, response)
-                except OSError:
-                    pass
-                self.clients.remove(sock)
-                sock.close()
+                    self.remove_client(client)
 
-    def service_update_lists(self):
-        """Метод реализующий отправки сервисного сообщения 205 клиентам."""
-        for client in self.names:
-            try:
-                send_message(self.names[client], RESPONSE_205)
-            except OSError:
-                self.remove_client(self.names[client])
+        self.threadsafe(update)
+
+    def queue_sizes(self):
+        """
+        Метод возвращающий размеры очередей отправки авторизованных
+        клиентов в байтах: словарь имя - размер.
+        """
+        return {name: client.queue_size for name, client in list(self.names.items())}
@@ -1,25 +1,91 @@
+import contextlib
 import datetime
+import json
+import pathlib
+import threading
 
 from sqlalchemy import (
+    Boolean,
     Column,
+    Date,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     MetaData,
     String,
     Table,
     Text,
+    bindparam,
     create_engine,
+    event,
+    select,
+    text,
 )
-from sqlalchemy.orm import mapper, sessionmaker
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import mapper, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import func
 from sqlalchemy.sql import default_comparator
 
+from server.migrations import migrate
+from server.storage import (
+    HISTORY_PAGE_SIZE,
+    RETENTION_BATCH_SIZE,
+    STATS_HOUR,
+    TOP_SENDERS_LIMIT,
+    Storage,
+    UserRecord,
+)
+
+# Параметры всех соединений SQLite: ожидание снятия блокировки вместо
+# ошибки, кэш страниц 16 МБ, временные данные в памяти.
+SQLITE_PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# Количество соединений только для чтения в пуле
+READER_POOL_SIZE = 4
+
+# Запись статистики за интервал: строка интервала создаётся или
+# увеличивается одной командой. Такую команду понимают SQLite и
+# PostgreSQL, для остальных баз строки обновляются по одной.
+STATS_UPSERT = text(
+    'INSERT INTO "Message_stats" ("user", period, start, sent, accepted) '
+    "VALUES (:user, :period, :start, :sent, :accepted) "
+    'ON CONFLICT (period, start, "user") DO UPDATE SET '
+    'sent = "Message_stats".sent + excluded.sent, '
+    'accepted = "Message_stats".accepted + excluded.accepted'
+).bindparams(bindparam("start", type_=DateTime))
+UPSERT_DIALECTS = ("sqlite", "postgresql")
+
+
+def hash_text(passwd_hash):
+    """
+    Функция приведения хэша пароля к тексту для столбца String:
+    hexlify возвращает байты, которые не все базы принимают в текстовый
+    столбец.
+    """
+    if isinstance(passwd_hash, bytes):
+        return passwd_hash.decode("ascii")
+    return passwd_hash
+
 
-class ServerStorage:
+class ServerStorage(Storage):
     """
     Класс - оболочка для работы с базой данных сервера.
-    Использует SQLite базу данных, реализован с помощью
-    SQLAlchemy ORM и используется классический подход.
+    Использует SQLite базу данных или другую базу, заданную адресом
+    SQLAlchemy, реализован с помощью SQLAlchemy ORM и используется
+    классический подход.
+
+    Запись выполняется через одну сессию, которой владеет поток
+    сервера. Чтение списков для графического интерфейса и чтение
+    записей пользователей при промахе кэша выполняются через сессии
+    только для чтения, у каждого потока своя. В режиме WAL чтение
+    не блокирует запись.
     """
 
     class AllUsers:
@@ -52,6 +118,28 @@ class ServerStorage:
             self.ip = ip
             self.port = port
 
+    class LoginDaily:
+        """Класс - отображение таблицы итогов входов по дням."""
+
+        def __init__(self, user, day):
+            self.id = None
+            self.user = user
+            self.day = day
+            self.logins = 0
+            self.first_login = None
+            self.last_login = None
+
+    class MessageStats:
+        """Класс - отображение таблицы статистики сообщений по интервалам."""
+
+        def __init__(self, user, period, start):
+            self.id = None
+            self.user = user
+            self.period = period
+            self.start = start
+            self.sent = 0
+            self.accepted = 0
+
     class UsersContacts:
         """Класс - отображение таблицы контактов пользователей."""
 
@@ -69,14 +157,52 @@ class ServerStorage:
             self.sent = 0
             self.accepted = 0
 
-    def __init__(self, path):
-        # Создаём движок базы данных
+    class OfflineMessages:
+        """Класс - отображение таблицы сообщений для отключённых пользователей."""
+
+        def __init__(self, recipient, sender, message_id, message):
+            self.id = None
+            self.recipient = recipient
+            self.sender = sender
+            self.message_id = message_id
+            self.message = message
+            self.created = datetime.datetime.now()
+
+    class UsersChanges:
+        """Класс - отображение таблицы изменений справочника пользователей."""
+
+        def __init__(self, name, added):
+            self.id = None
+            self.name = name
+            self.added = added
+            self.date_time = datetime.datetime.now()
+
+    class ResumeTokens:
+        """Класс - отображение таблицы меток токенов восстановления сессии."""
+
+        def __init__(self, user, nonce):
+            self.user = user
+            self.nonce = nonce
+
+    def __init__(
+        self, path=None, clear_active=True, wal=True, active_mirror=True, url=None
+    ):
+        super().__init__()
+        # Создаём движок базы данных: файл SQLite по пути path или
+        # база по адресу SQLAlchemy url.
+        if url is None:
+            url = f"sqlite:///{path}"
+        self.sqlite = make_url(url).get_backend_name() == "sqlite"
+        engine_options = dict()
+        if self.sqlite:
+            engine_options["connect_args"] = {"check_same_thread": False}
         self.database_engine = create_engine(
-            f"sqlite:///{path}",
-            echo=False,
-            pool_recycle=7200,
-            connect_args={"check_same_thread": False},
+            url, echo=False, pool_recycle=7200, **engine_options
         )
+        # Режим журнала SQLite задаётся при подключении.
+        self.wal = wal
+        if self.sqlite:
+            event.listen(self.database_engine, "connect", self.writer_connected)
 
         # Создаём объект MetaData
         self.metadata = MetaData()
@@ -112,6 +238,21 @@ class ServerStorage:
             Column("date_time", DateTime),
             Column("ip", String),
             Column("port", String),
+            Index("ix_login_history_name_date", "name", "date_time"),
+        )
+
+        # Создаём таблицу итогов входов по дням, в неё сворачивается
+        # устаревшая история входов.
+        login_daily_table = Table(
+            "Login_daily",
+            self.metadata,
+            Column("id", Integer, primary_key=True),
+            Column("user", ForeignKey("Users.id")),
+            Column("day", Date),
+            Column("logins", Integer),
+            Column("first_login", DateTime),
+            Column("last_login", DateTime),
+            Index("ix_login_daily_user_day", "user", "day", unique=True),
         )
 
         # Создаём таблицу контактов пользователей
@@ -121,6 +262,8 @@ class ServerStorage:
             Column("id", Integer, primary_key=True),
             Column("user", ForeignKey("Users.id")),
             Column("contact", ForeignKey("Users.id")),
+            Index("ix_contacts_user_contact", "user", "contact", unique=True),
+            Index("ix_contacts_contact", "contact"),
         )
 
         # Создаём таблицу статистики пользователей
@@ -131,159 +274,525 @@ class ServerStorage:
             Column("user", ForeignKey("Users.id")),
             Column("sent", Integer),
             Column("accepted", Integer),
+            Index("ix_history_user", "user"),
         )
 
-        # Создаём таблицы
+        # Создаём таблицу статистики сообщений по часам и дням. period -
+        # длительность интервала в секундах, start - его начало.
+        message_stats_table = Table(
+            "Message_stats",
+            self.metadata,
+            Column("id", Integer, primary_key=True),
+            Column("user", ForeignKey("Users.id")),
+            Column("period", Integer),
+            Column("start", DateTime),
+            Column("sent", Integer),
+            Column("accepted", Integer),
+            Index(
+                "ix_message_stats_period_start", "period", "start", "user", unique=True
+            ),
+        )
+
+        # Создаём таблицу сообщений для отключённых пользователей.
+        # Порядок доставки - по возрастанию id.
+        offline_messages_table = Table(
+            "Offline_messages",
+            self.metadata,
+            Column("id", Integer, primary_key=True),
+            Column("recipient", ForeignKey("Users.id"), index=True),
+            Column("sender", String),
+            Column("message_id", String),
+            Column("message", Text),
+            Column("created", DateTime),
+        )
+
+        # Создаём таблицу изменений справочника пользователей.
+        # id записи - версия справочника после изменения.
+        users_changes_table = Table(
+            "Users_changes",
+            self.metadata,
+            Column("id", Integer, primary_key=True),
+            Column("name", String),
+            Column("added", Boolean),
+            Column("date_time", DateTime),
+        )
+
+        # Создаём таблицу меток токенов восстановления сессии: у
+        # пользователя принимается только последний выданный токен.
+        resume_tokens_table = Table(
+            "Resume_tokens",
+            self.metadata,
+            Column("user", ForeignKey("Users.id"), primary_key=True),
+            Column("nonce", String),
+        )
+
+        # Создаём таблицы и обновляем схему базы, созданной предыдущими
+        # версиями сервера. Индексы существующих таблиц create_all не создаёт.
+        # Миграции ведутся только для SQLite, в другой базе схема
+        # создаётся сразу последней версии.
         self.metadata.create_all(self.database_engine)
+        if self.sqlite:
+            migrate(self.database_engine)
 
         # Создаём отображения
         mapper(self.AllUsers, users_table)
         mapper(self.ActiveUsers, active_users_table)
         mapper(self.LoginHistory, user_login_history)
+        mapper(self.LoginDaily, login_daily_table)
         mapper(self.UsersContacts, contacts)
         mapper(self.UsersHistory, users_history_table)
+        mapper(self.MessageStats, message_stats_table)
+        mapper(self.OfflineMessages, offline_messages_table)
+        mapper(self.UsersChanges, users_changes_table)
+        mapper(self.ResumeTokens, resume_tokens_table)
+
+        # Частые запросы выполняются готовыми командами SQLAlchemy Core
+        # без построения запроса ORM и карты объектов сессии. Команды
+        # компилируются один раз и хранятся в statement_cache.
+        self.statement_cache = dict()
+        self.select_user = select(
+            [
+                users_table.c.id,
+                users_table.c.passwd_hash,
+                users_table.c.pubkey,
+                users_table.c.last_login,
+            ]
+        ).where(users_table.c.name == bindparam("name"))
+        self.update_login = (
+            users_table.update()
+            .where(users_table.c.id == bindparam("user_id"))
+            .values(last_login=bindparam("login_time"), pubkey=bindparam("key"))
+        )
+        self.insert_login = user_login_history.insert()
+        self.select_contacts = (
+            select([users_table.c.name])
+            .select_from(
+                contacts.join(users_table, contacts.c.contact == users_table.c.id)
+            )
+            .where(contacts.c.user == bindparam("user_id"))
+        )
+        self.update_resume = (
+            resume_tokens_table.update()
+            .where(resume_tokens_table.c.user == bindparam("user_id"))
+            .values(nonce=bindparam("new_nonce"))
+        )
+        self.insert_resume = resume_tokens_table.insert()
+        # Метка сбрасывается, только если совпала: из двух процессов,
+        # предъявивших один токен, строку изменит только один.
+        self.take_resume = (
+            resume_tokens_table.update()
+            .where(resume_tokens_table.c.user == bindparam("user_id"))
+            .where(resume_tokens_table.c.nonce == bindparam("old_nonce"))
+            .values(nonce=None)
+        )
 
         # Создаём сессию
         Session = sessionmaker(bind=self.database_engine)
         self.session = Session()
+        # Фабрика сессий для обслуживания базы в фоновом потоке
+        self.maintenance_session = Session
+
+        # Создаём движок только для чтения с пулом соединений и сессии
+        # для чтения, отдельные для каждого потока. Для файла SQLite
+        # соединения открываются только для чтения, другие базы читаются
+        # через пул основного движка.
+        if path is not None and self.sqlite:
+            self.reader_engine = create_engine(
+                f"sqlite:///{pathlib.Path(path).resolve().as_uri()}?mode=ro&uri=true",
+                echo=False,
+                poolclass=QueuePool,
+                pool_size=READER_POOL_SIZE,
+                pool_recycle=7200,
+                connect_args={"check_same_thread": False},
+            )
+            event.listen(self.reader_engine, "connect", self.reader_connected)
+        else:
+            self.reader_engine = self.database_engine
+        self.reader = scoped_session(sessionmaker(bind=self.reader_engine))
+
+        # Кэш записей пользователей: имя - UserRecord, и счётчики
+        # обращений к нему. Отсутствующие пользователи не кэшируются.
+        self.users_cache = dict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Поколение кэша растёт при каждом изменении записи. Запись,
+        # прочитанная из базы, попадает в кэш, только если поколение за
+        # время чтения не изменилось, иначе чтение в другом потоке
+        # вернуло бы в кэш устаревший хэш или ключ.
+        self.cache_generation = 0
+        self.cache_lock = threading.Lock()
+
+        # Активные пользователи хранятся в памяти, таблица Active_users -
+        # лишь копия для внешних программ, которая записывается методом
+        # flush, если active_mirror включён.
+        self.active_mirror = active_mirror
 
         # Если в таблице активных пользователей есть записи, то их необходимо
-        # удалить
-        self.session.query(self.ActiveUsers).delete()
-        self.session.commit()
+        # удалить. Рабочие процессы сервера подключаются к уже очищенной базе.
+        if clear_active:
+            self.session.query(self.ActiveUsers).delete()
+            self.session.commit()
+
+    def writer_connected(self, dbapi_connection, connection_record):
+        """Метод настройки соединения для записи."""
+        cursor = dbapi_connection.cursor()
+        if self.wal:
+            # В режиме WAL синхронизации NORMAL достаточно для целостности
+            # базы, а запись на диск выполняется реже.
+            cursor.execute("PRAGMA journal_mode = WAL")
+            cursor.execute("PRAGMA synchronous = NORMAL")
+        else:
+            cursor.execute("PRAGMA journal_mode = DELETE")
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    def reader_connected(self, dbapi_connection, connection_record):
+        """Метод настройки соединения только для чтения."""
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @contextlib.contextmanager
+    def read_session(self):
+        """
+        Контекстный менеджер сессии только для чтения текущего потока.
+        После чтения соединение возвращается в пул, поэтому каждое
+        чтение видит последние записанные данные.
+        """
+        try:
+            yield self.reader()
+        finally:
+            self.reader.remove()
+
+    def execute(self, session, statement, params):
+        """
+        Метод выполнения готовой команды в сессии с кэшем
+        скомпилированных команд. Возвращает результат SQLAlchemy Core.
+        """
+        connection = session.connection().execution_options(
+            compiled_cache=self.statement_cache
+        )
+        return connection.execute(statement, params)
 
     def user_login(self, username, ip_address, port, key):
         """
         Метод выполняющийся при входе пользователя, записывает в базу факт входа
         Обновляет открытый ключ пользователя при его изменении.
         """
-        # Запрос в таблицу пользователей на наличие там пользователя с таким
-        # именем
-        rez = self.session.query(self.AllUsers).filter_by(name=username)
-
-        # Если имя пользователя уже присутствует в таблице, обновляем время последнего входа
-        # и проверяем корректность ключа. Если клиент прислал новый ключ,
-        # сохраняем его.
-        if rez.count():
-            user = rez.first()
-            user.last_login = datetime.datetime.now()
-            if user.pubkey != key:
-                user.pubkey = key
-        # Если нету, то генерируем исключение
-        else:
+        # Запись пользователя берём из кэша, если пользователя нет,
+        # то генерируем исключение
+        user = self.user_record(username)
+        if user is None:
             raise ValueError("Пользователь не зарегистрирован.")
 
-        # Теперь можно создать запись в таблицу активных пользователей о факте
-        # входа.
-        new_active_user = self.ActiveUsers(
-            user.id, ip_address, port, datetime.datetime.now()
+        # Обновляем время последнего входа и ключ. Если пользователя
+        # удалил другой процесс сервера, запись кэша устарела.
+        login_time = datetime.datetime.now()
+        updated = self.execute(
+            self.session,
+            self.update_login,
+            {"user_id": user.id, "login_time": login_time, "key": key},
         )
-        self.session.add(new_active_user)
+        if not updated.rowcount:
+            self.session.rollback()
+            self.forget_user(username)
+            raise ValueError("Пользователь не зарегистрирован.")
 
-        # и сохранить в историю входов
-        history = self.LoginHistory(user.id, datetime.datetime.now(), ip_address, port)
-        self.session.add(history)
+        # Сохраняем факт входа в историю входов
+        self.execute(
+            self.session,
+            self.insert_login,
+            {"name": user.id, "date_time": login_time, "ip": ip_address, "port": port},
+        )
 
         # Сохрраняем изменения
         self.session.commit()
 
+        # Добавляем пользователя в список активных.
+        self.add_active_user(username, ip_address, port, login_time)
+
+        # Обновляем запись кэша: ключ и время входа могли измениться.
+        with self.cache_lock:
+            self.cache_generation += 1
+            self.users_cache[username] = user._replace(
+                pubkey=key, last_login=login_time
+            )
+
     def add_user(self, name, passwd_hash):
         """
         Метод регистрации пользователя.
         Принимает имя и хэш пароля, создаёт запись в таблице статистики.
         """
-        user_row = self.AllUsers(name, passwd_hash)
+        user_row = self.AllUsers(name, hash_text(passwd_hash))
         self.session.add(user_row)
         self.session.commit()
         history_row = self.UsersHistory(user_row.id)
         self.session.add(history_row)
+        self.session.add(self.UsersChanges(name, True))
         self.session.commit()
+        self.forget_user(name)
+
+    def add_users(self, accounts):
+        """
+        Метод пакетной регистрации пользователей.
+        Принимает список пар имя - хэш пароля и записывает пользователей,
+        их статистику и изменения справочника в одной транзакции.
+        Если кто-то из пользователей уже зарегистрирован, то пакет
+        записывается по одному пользователю без повторов.
+        Возвращает количество зарегистрированных пользователей.
+        """
+        if not accounts:
+            return 0
+        tables = self.metadata.tables
+        now = datetime.datetime.now()
+        # Команды пакета каждый раз разные, поэтому выполняются без
+        # statement_cache.
+        try:
+            self.session.execute(
+                tables["Users"].insert(),
+                [
+                    {
+                        "name": name,
+                        "passwd_hash": hash_text(passwd_hash),
+                        "last_login": now,
+                    }
+                    for name, passwd_hash in accounts
+                ],
+            )
+        except IntegrityError:
+            self.session.rollback()
+            added = 0
+            for name, passwd_hash in accounts:
+                if self.user_record(name) is None:
+                    self.add_user(name, passwd_hash)
+                    added += 1
+            return added
+        names = [name for name, _ in accounts]
+        users = tables["Users"]
+        ids = self.session.execute(select([users.c.id]).where(users.c.name.in_(names)))
+        self.session.execute(
+            tables["History"].insert(),
+            [{"user": row[0], "sent": 0, "accepted": 0} for row in ids],
+        )
+        self.session.execute(
+            tables["Users_changes"].insert(),
+            [{"name": name, "added": True, "date_time": now} for name in names],
+        )
+        self.session.commit()
+        for name in names:
+            self.forget_user(name)
+        return len(accounts)
 
     def remove_user(self, name):
         """Метод удаляющий пользователя из базы."""
+        self.user_logout(name)
         user = self.session.query(self.AllUsers).filter_by(name=name).first()
         self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
         self.session.query(self.LoginHistory).filter_by(name=user.id).delete()
+        self.session.query(self.LoginDaily).filter_by(user=user.id).delete()
         self.session.query(self.UsersContacts).filter_by(user=user.id).delete()
         self.session.query(self.UsersContacts).filter_by(contact=user.id).delete()
         self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
+        self.session.query(self.MessageStats).filter_by(user=user.id).delete()
+        self.session.query(self.OfflineMessages).filter_by(recipient=user.id).delete()
+        self.session.query(self.ResumeTokens).filter_by(user=user.id).delete()
         self.session.query(self.AllUsers).filter_by(name=name).delete()
+        self.session.add(self.UsersChanges(name, False))
         self.session.commit()
+        self.forget_user(name)
 
-    def get_hash(self, name):
-        """Метод получения хэша пароля пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.passwd_hash
+    def user_record(self, name):
+        """
+        Метод возвращающий запись пользователя из кэша или None, если
+        пользователя нет. База запрашивается только при промахе кэша.
+        """
+        record = self.users_cache.get(name)
+        if record is not None:
+            self.cache_hits += 1
+            return record
+        self.cache_misses += 1
+        generation = self.cache_generation
+        with self.read_session() as session:
+            row = self.execute(session, self.select_user, {"name": name}).first()
+        if row is None:
+            return None
+        user_id, passwd_hash, pubkey, last_login = row
+        # Хэш, записанный текстом, возвращается байтами, как его
+        # использует hmac.
+        if isinstance(passwd_hash, str):
+            passwd_hash = passwd_hash.encode("ascii")
+        record = UserRecord(user_id, passwd_hash, pubkey, last_login)
+        with self.cache_lock:
+            if self.cache_generation == generation:
+                self.users_cache[name] = record
+        return record
 
-    def get_pubkey(self, name):
-        """Метод получения публичного ключа пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.pubkey
+    def forget_user(self, name):
+        """
+        Метод удаления записи пользователя из кэша.
+        Вызывается при изменении пользователя, в том числе другим
+        процессом сервера.
+        """
+        with self.cache_lock:
+            self.cache_generation += 1
+            self.users_cache.pop(name, None)
 
-    def check_user(self, name):
-        """Метод проверяющий существование пользователя."""
-        if self.session.query(self.AllUsers).filter_by(name=name).count():
-            return True
-        else:
-            return False
+    def flush_active_users(self):
+        """
+        Метод записи копии списка активных пользователей в таблицу
+        Active_users. Таблица перезаписывается целиком, только если
+        список изменился с прошлой записи.
+        """
+        version, users = self.active_users_snapshot()
+        if not self.active_mirror or version == self.active_flushed:
+            return
+        self.session.query(self.ActiveUsers).delete()
+        for name, ip_address, port, login_time in users:
+            user = self.user_record(name)
+            if user is not None:
+                self.session.add(
+                    self.ActiveUsers(user.id, ip_address, port, login_time)
+                )
+        self.session.commit()
+        self.active_flushed = version
 
-    def user_logout(self, username):
-        """Метод фиксирующий отключения пользователя."""
-        # Запрашиваем пользователя, что покидает нас
-        user = self.session.query(self.AllUsers).filter_by(name=username).first()
+    def flush_statistics(self):
+        """
+        Метод записи накопленной статистики сообщений в базу.
+        Все счётчики записываются в одной транзакции, статистика по
+        часам и дням - пакетом команд INSERT ... ON CONFLICT, поэтому
+        рабочие процессы могут записывать одни и те же интервалы.
+        """
+        if not self.pending_sent and not self.pending_accepted:
+            return
+        sent, accepted, buckets = self.take_statistics()
+        for name in set(sent) | set(accepted):
+            # Удалённых за это время пользователей в базе уже нет, их
+            # статистика не сохраняется.
+            user = self.user_record(name)
+            if user is None:
+                continue
+            self.session.query(self.UsersHistory).filter_by(user=user.id).update(
+                {
+                    self.UsersHistory.sent: self.UsersHistory.sent + sent[name],
+                    self.UsersHistory.accepted: self.UsersHistory.accepted
+                    + accepted[name],
+                },
+                synchronize_session=False,
+            )
 
-        # Удаляем его из таблицы активных пользователей.
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
+        rows = []
+        for (name, period, start), (bucket_sent, bucket_accepted) in buckets.items():
+            user = self.user_record(name)
+            if user is not None:
+                rows.append(
+                    {
+                        "user": user.id,
+                        "period": period,
+                        "start": start,
+                        "sent": bucket_sent,
+                        "accepted": bucket_accepted,
+                    }
+                )
+        if rows:
+            self.upsert_statistics(rows)
+        self.session.commit()
 
-        # Применяем изменения
+    def upsert_statistics(self, rows):
+        """Метод записи строк статистики по интервалам в текущей транзакции."""
+        if self.database_engine.dialect.name in UPSERT_DIALECTS:
+            self.session.execute(STATS_UPSERT, rows)
+            return
+        for row in rows:
+            updated = (
+                self.session.query(self.MessageStats)
+                .filter_by(user=row["user"], period=row["period"], start=row["start"])
+                .update(
+                    {
+                        self.MessageStats.sent: self.MessageStats.sent + row["sent"],
+                        self.MessageStats.accepted: self.MessageStats.accepted
+                        + row["accepted"],
+                    },
+                    synchronize_session=False,
+                )
+            )
+            if not updated:
+                stats = self.MessageStats(row["user"], row["period"], row["start"])
+                stats.sent = row["sent"]
+                stats.accepted = row["accepted"]
+                self.session.add(stats)
+
+    def store_offline_message(self, sender, recipient, message, message_id=None):
+        """
+        Метод сохранения сообщения для отключённого пользователя.
+        Сообщение хранится в том виде, в котором прислано (текст
+        зашифрован клиентом). Если сообщение с таким идентификатором
+        от того же отправителя уже ожидает доставки, оно не сохраняется
+        повторно и метод возвращает False.
+        """
+        user = self.user_record(recipient)
+        if message_id is not None:
+            message_id = str(message_id)
+            if (
+                self.session.query(self.OfflineMessages)
+                .filter_by(recipient=user.id, sender=sender, message_id=message_id)
+                .count()
+            ):
+                return False
+        row = self.OfflineMessages(user.id, sender, message_id, json.dumps(message))
+        self.session.add(row)
         self.session.commit()
+        return True
 
-    def process_message(self, sender, recipient):
-        """Метод записывающий в таблицу статистики факт передачи сообщения."""
-        # Получаем ID отправителя и получателя
-        sender = self.session.query(self.AllUsers).filter_by(name=sender).first().id
-        recipient = (
-            self.session.query(self.AllUsers).filter_by(name=recipient).first().id
-        )
-        # Запрашиваем строки из истории и увеличиваем счётчики
-        sender_row = (
-            self.session.query(self.UsersHistory).filter_by(user=sender).first()
-        )
-        sender_row.sent += 1
-        recipient_row = (
-            self.session.query(self.UsersHistory).filter_by(user=recipient).first()
+    def get_offline_messages(self, username, limit):
+        """
+        Метод возвращающий не более limit сообщений, ожидающих доставки
+        пользователю, в порядке поступления: список кортежей (id, сообщение).
+        """
+        user = self.user_record(username)
+        query = (
+            self.session.query(self.OfflineMessages.id, self.OfflineMessages.message)
+            .filter_by(recipient=user.id)
+            .order_by(self.OfflineMessages.id)
+            .limit(limit)
         )
-        recipient_row.accepted += 1
+        return [(row_id, json.loads(message)) for row_id, message in query.all()]
 
+    def remove_offline_messages(self, ids):
+        """Метод удаления доставленных сообщений."""
+        self.session.query(self.OfflineMessages).filter(
+            self.OfflineMessages.id.in_(ids)
+        ).delete(synchronize_session=False)
         self.session.commit()
 
     def add_contact(self, user, contact):
         """Метод добавления контакта для пользователя."""
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(self.AllUsers).filter_by(name=contact).first()
-
-        # Проверяем что не дубль и что контакт может существовать (полю
-        # пользователь мы доверяем)
-        if (
-            not contact
-            or self.session.query(self.UsersContacts)
-            .filter_by(user=user.id, contact=contact.id)
-            .count()
-        ):
+        user = self.user_record(user)
+        contact = self.user_record(contact)
+
+        # Проверяем что контакт может существовать (полю пользователь мы
+        # доверяем)
+        if not contact:
             return
 
-        # Создаём объект и заносим его в базу
+        # Создаём объект и заносим его в базу. Дубль отклоняет уникальный
+        # индекс, отдельный запрос для проверки не нужен.
         contact_row = self.UsersContacts(user.id, contact.id)
         self.session.add(contact_row)
-        self.session.commit()
+        try:
+            self.session.commit()
+        except IntegrityError:
+            self.session.rollback()
 
     # Функция удаляет контакт из базы данных
     def remove_contact(self, user, contact):
         """Метод удаления контакта пользователя."""
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(self.AllUsers).filter_by(name=contact).first()
+        user = self.user_record(user)
+        contact = self.user_record(contact)
 
         # Проверяем что контакт может существовать (полю пользователь мы
         # доверяем)
@@ -298,64 +807,290 @@ class ServerStorage:
 
     def users_list(self):
         """Метод возвращающий список известных пользователей со временем последнего входа."""
-        # Запрос строк таблицы пользователей.
-        query = self.session.query(self.AllUsers.name, self.AllUsers.last_login)
-        # Возвращаем список кортежей
-        return query.all()
-
-    def active_users_list(self):
-        """Метод возвращающий список активных пользователей."""
-        # Запрашиваем соединение таблиц и собираем кортежи имя, адрес, порт,
-        # время.
-        query = self.session.query(
-            self.AllUsers.name,
-            self.ActiveUsers.ip_address,
-            self.ActiveUsers.port,
-            self.ActiveUsers.login_time,
-        ).join(self.AllUsers)
-        # Возвращаем список кортежей
-        return query.all()
-
-    def login_history(self, username=None):
-        """Метод возвращающий историю входов."""
-        # Запрашиваем историю входа
-        query = self.session.query(
-            self.AllUsers.name,
-            self.LoginHistory.date_time,
-            self.LoginHistory.ip,
-            self.LoginHistory.port,
-        ).join(self.AllUsers)
+        with self.read_session() as session:
+            # Запрос строк таблицы пользователей.
+            query = session.query(self.AllUsers.name, self.AllUsers.last_login)
+            # Возвращаем список кортежей
+            return query.all()
+
+    def users_version(self):
+        """Метод возвращающий текущую версию справочника пользователей."""
+        return self.session.query(func.max(self.UsersChanges.id)).scalar() or 0
+
+    def users_changes(self, version):
+        """
+        Метод возвращающий изменения справочника пользователей после
+        версии version: кортеж (текущая версия, добавленные, удалённые).
+        Для каждого имени учитывается только последнее изменение.
+        Возвращает None, если такой версии справочник ещё не имел.
+        """
+        current = self.users_version()
+        if version > current:
+            return None
+        query = (
+            self.session.query(self.UsersChanges.name, self.UsersChanges.added)
+            .filter(self.UsersChanges.id > version)
+            .order_by(self.UsersChanges.id)
+        )
+        changes = dict(query.all())
+        added = [name for name, is_added in changes.items() if is_added]
+        removed = [name for name, is_added in changes.items() if not is_added]
+        return current, added, removed
+
+    def set_resume_nonce(self, name, nonce):
+        """Метод сохранения метки токена восстановления сессии."""
+        user = self.user_record(name)
+        if user is None:
+            return
+        params = {"user_id": user.id, "new_nonce": nonce}
+        if not self.execute(self.session, self.update_resume, params).rowcount:
+            self.execute(
+                self.session, self.insert_resume, {"user": user.id, "nonce": nonce}
+            )
+        self.session.commit()
+
+    def take_resume_nonce(self, name, nonce):
+        """Метод однократного использования токена восстановления сессии."""
+        user = self.user_record(name)
+        if user is None or nonce is None:
+            return False
+        taken = self.execute(
+            self.session, self.take_resume, {"user_id": user.id, "old_nonce": nonce}
+        ).rowcount
+        self.session.commit()
+        return bool(taken)
+
+    def login_history_page(
+        self,
+        cursor=None,
+        limit=HISTORY_PAGE_SIZE,
+        username=None,
+        since=None,
+        until=None,
+    ):
+        """
+        Метод возвращающий страницу истории входов в порядке входа:
+        кортеж (строки, курсор). Строки - кортежи имя, время, адрес, порт.
+        Следующая страница запрашивается с полученным курсором и
+        выбирается по индексу, а не пропуском строк, поэтому время запроса
+        не зависит от номера страницы. Курсор None - страниц больше нет.
+        Историю можно ограничить пользователем и временем входа
+        since <= время < until.
+        """
         # Если было указано имя пользователя, то фильтруем по нему
+        user = None
+        if username:
+            user = self.user_record(username)
+            if user is None:
+                return [], None
+        with self.read_session() as session:
+            query = session.query(
+                self.LoginHistory.id,
+                self.AllUsers.name,
+                self.LoginHistory.date_time,
+                self.LoginHistory.ip,
+                self.LoginHistory.port,
+            ).join(self.AllUsers)
+            if cursor is not None:
+                query = query.filter(self.LoginHistory.id > cursor)
+            if user is not None:
+                query = query.filter(self.LoginHistory.name == user.id)
+            if since is not None:
+                query = query.filter(self.LoginHistory.date_time >= since)
+            if until is not None:
+                query = query.filter(self.LoginHistory.date_time < until)
+            rows = query.order_by(self.LoginHistory.id).limit(limit).all()
+        cursor = rows[-1][0] if len(rows) == limit else None
+        return [row[1:] for row in rows], cursor
+
+    def compact_login_history(
+        self, before, archive_dir=None, limit=RETENTION_BATCH_SIZE
+    ):
+        """
+        Метод сворачивания истории входов старше before в итоги по дням.
+        За вызов обрабатывает не больше limit самых старых строк в
+        отдельной сессии и короткой транзакции, поэтому может вызываться
+        из фонового потока, пока сервер записывает новые входы.
+        Если указан archive_dir, то строки до удаления дописываются в
+        сжатые файлы JSON lines по месяцам. При сбое до завершения
+        транзакции строки попадут в архив повторно, но не потеряются.
+        Возвращает количество обработанных строк.
+        """
+        session = self.maintenance_session()
+        try:
+            rows = (
+                session.query(
+                    self.LoginHistory.id,
+                    self.LoginHistory.name,
+                    self.AllUsers.name,
+                    self.LoginHistory.date_time,
+                    self.LoginHistory.ip,
+                    self.LoginHistory.port,
+                )
+                .outerjoin(self.AllUsers)
+                .filter(self.LoginHistory.date_time < before)
+                .order_by(self.LoginHistory.id)
+                .limit(limit)
+                .all()
+            )
+            if not rows:
+                return 0
+            if archive_dir:
+                self.archive_login_history(archive_dir, rows)
+
+            # Итоги по пользователю и дню
+            totals = dict()
+            for row_id, user, name, date_time, ip, port in rows:
+                key = (user, date_time.date())
+                logins, first, last = totals.get(key, (0, date_time, date_time))
+                totals[key] = (logins + 1, min(first, date_time), max(last, date_time))
+            users = {user for user, day in totals}
+            days = {day for user, day in totals}
+            existing = {
+                (daily.user, daily.day): daily
+                for daily in session.query(self.LoginDaily).filter(
+                    self.LoginDaily.user.in_(users), self.LoginDaily.day.in_(days)
+                )
+            }
+            for key, (logins, first, last) in totals.items():
+                daily = existing.get(key)
+                if daily is None:
+                    daily = self.LoginDaily(*key)
+                    daily.first_login = first
+                    daily.last_login = last
+                    session.add(daily)
+                else:
+                    daily.first_login = min(daily.first_login, first)
+                    daily.last_login = max(daily.last_login, last)
+                daily.logins += logins
+
+            session.query(self.LoginHistory).filter(
+                self.LoginHistory.id.in_([row[0] for row in rows])
+            ).delete(synchronize_session=False)
+            session.commit()
+            return len(rows)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def login_daily_history(self, username=None):
+        """
+        Метод возвращающий итоги входов по дням для свёрнутой истории:
+        имя, день, количество входов, время первого и последнего входа.
+        """
+        user = None
         if username:
-            query = query.filter(self.AllUsers.name == username)
-        # Возвращаем список кортежей
-        return query.all()
+            user = self.user_record(username)
+            if user is None:
+                return []
+        with self.read_session() as session:
+            query = session.query(
+                self.AllUsers.name,
+                self.LoginDaily.day,
+                self.LoginDaily.logins,
+                self.LoginDaily.first_login,
+                self.LoginDaily.last_login,
+            ).join(self.AllUsers)
+            if user is not None:
+                query = query.filter(self.LoginDaily.user == user.id)
+            return query.order_by(self.LoginDaily.day, self.AllUsers.name).all()
 
     def get_contacts(self, username):
         """Метод возвращающий список контактов пользователя."""
         # Запрашивааем указанного пользователя
-        user = self.session.query(self.AllUsers).filter_by(name=username).one()
+        user = self.user_record(username)
 
-        # Запрашиваем его список контактов
-        query = (
-            self.session.query(self.UsersContacts, self.AllUsers.name)
-            .filter_by(user=user.id)
-            .join(self.AllUsers, self.UsersContacts.contact == self.AllUsers.id)
-        )
+        # Запрашиваем имена его контактов
+        rows = self.execute(self.session, self.select_contacts, {"user_id": user.id})
+        return [row[0] for row in rows]
 
-        # выбираем только имена пользователей и возвращаем их.
-        return [contact[1] for contact in query.all()]
+    def message_history_page(
+        self,
+        cursor=None,
+        limit=HISTORY_PAGE_SIZE,
+        username=None,
+        since=None,
+        until=None,
+    ):
+        """
+        Метод возвращающий страницу статистики сообщений в порядке
+        регистрации пользователей: кортеж (строки, курсор). Строки -
+        кортежи имя, последний вход, отправлено, получено. Курсор
+        работает как в login_history_page. Статистику можно ограничить
+        пользователем и временем последнего входа since <= время < until.
+        Учитывает и счётчики, ещё не записанные в базу.
+        """
+        sent = self.pending_sent.copy()
+        accepted = self.pending_accepted.copy()
+        with self.read_session() as session:
+            query = session.query(
+                self.AllUsers.id,
+                self.AllUsers.name,
+                self.AllUsers.last_login,
+                self.UsersHistory.sent,
+                self.UsersHistory.accepted,
+            ).join(self.AllUsers)
+            if cursor is not None:
+                query = query.filter(self.AllUsers.id > cursor)
+            if username:
+                query = query.filter(self.AllUsers.name == username)
+            if since is not None:
+                query = query.filter(self.AllUsers.last_login >= since)
+            if until is not None:
+                query = query.filter(self.AllUsers.last_login < until)
+            rows = query.order_by(self.AllUsers.id).limit(limit).all()
+        cursor = rows[-1][0] if len(rows) == limit else None
+        return [
+            (name, last_login, user_sent + sent[name], user_accepted + accepted[name])
+            for _, name, last_login, user_sent, user_accepted in rows
+        ], cursor
 
-    def message_history(self):
-        """Метод возвращающий статистику сообщений."""
-        query = self.session.query(
-            self.AllUsers.name,
-            self.AllUsers.last_login,
-            self.UsersHistory.sent,
-            self.UsersHistory.accepted,
-        ).join(self.AllUsers)
-        # Возвращаем список кортежей
-        return query.all()
+    def top_senders(self, since, until, period=STATS_HOUR, limit=TOP_SENDERS_LIMIT):
+        """
+        Метод возвращающий самых активных отправителей за время
+        since <= время < until: кортежи имя, отправлено, получено.
+        Считается по интервалам длительностью period (STATS_HOUR или
+        STATS_DAY), границы округляются до начала интервала. Данные
+        отстают от сервера не больше чем на интервал записи статистики.
+        """
+        with self.read_session() as session:
+            sent = func.sum(self.MessageStats.sent)
+            return (
+                session.query(
+                    self.AllUsers.name, sent, func.sum(self.MessageStats.accepted)
+                )
+                .join(self.AllUsers)
+                .filter(
+                    self.MessageStats.period == period,
+                    self.MessageStats.start >= self.stats_start(since, period),
+                    self.MessageStats.start < until,
+                )
+                .group_by(self.MessageStats.user)
+                .order_by(sent.desc(), self.AllUsers.name)
+                .limit(limit)
+                .all()
+            )
+
+    def message_throughput(self, since, until, period=STATS_HOUR):
+        """
+        Метод возвращающий количество сообщений по интервалам
+        длительностью period за время since <= время < until: кортежи
+        начало интервала, количество. Интервалы без сообщений пропускаются.
+        """
+        with self.read_session() as session:
+            return (
+                session.query(self.MessageStats.start, func.sum(self.MessageStats.sent))
+                .filter(
+                    self.MessageStats.period == period,
+                    self.MessageStats.start >= self.stats_start(since, period),
+                    self.MessageStats.start < until,
+                )
+                .group_by(self.MessageStats.start)
+                .order_by(self.MessageStats.start)
+                .all()
+            )
 
 
 # Отладка
@@ -372,4 +1107,5 @@ if __name__ == "__main__":
     # test_db.add_contact('test1', 'test6')
     # test_db.remove_contact('test1', 'test3')
     test_db.process_message("test1", "test2")
+    test_db.flush_statistics()
     print(test_db.message_history())
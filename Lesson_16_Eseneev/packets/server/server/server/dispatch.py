@@ -0,0 +1,75 @@
+from common.variables import *
+
+# Реестр обработчиков сообщений: действие - обработчик.
+HANDLERS = dict()
+
+
+class MessageSchema:
+    """
+    Класс - схема проверки сообщения одного действия.
+    Набор обязательных ключей собирается один раз при регистрации
+    обработчика, поэтому проверка сообщения - одно сравнение множеств.
+    Вложенные ключи nested - словарь ключ - обязательные ключи словаря,
+    который должен быть значением этого ключа. Если задан ключ
+    владельца, имя пользователя в нём должно совпадать с именем
+    клиента, приславшего сообщение.
+    """
+
+    __slots__ = ("keys", "nested", "owner")
+
+    def __init__(self, keys=(), owner=None, nested=None):
+        nested = nested or dict()
+        self.keys = frozenset((ACTION,) + tuple(keys) + tuple(nested))
+        self.nested = tuple((key, frozenset(keys)) for key, keys in nested.items())
+        self.owner = owner
+
+    def check(self, message, client, server):
+        """Метод проверки сообщения, возвращает True если оно корректно."""
+        if not message.keys() >= self.keys:
+            return False
+        for key, keys in self.nested:
+            value = message[key]
+            if not isinstance(value, dict) or not value.keys() >= keys:
+                return False
+        if self.owner is not None:
+            return server.names.get(message[self.owner]) is client
+        return True
+
+
+class Handler:
+    """Класс - зарегистрированный обработчик: схема и функция."""
+
+    __slots__ = ("schema", "func")
+
+    def __init__(self, schema, func):
+        self.schema = schema
+        self.func = func
+
+
+def message_handler(action, keys=(), owner=None, nested=None):
+    """
+    Декоратор регистрации обработчика сообщений с действием action.
+    Обработчик вызывается как func(server, message, client), когда
+    сообщение содержит все ключи keys, словари во вложенных ключах
+    nested содержат их обязательные ключи, а ключ owner (если задан)
+    содержит имя клиента. Позволяет добавлять обработчики новых
+    действий без изменения MessageProcessor.
+    """
+
+    def decorator(func):
+        HANDLERS[action] = Handler(MessageSchema(keys, owner, nested), func)
+        return func
+
+    return decorator
+
+
+def find_handler(message, client, server):
+    """
+    Функция поиска обработчика сообщения.
+    Возвращает функцию обработчик или None, если действие неизвестно
+    или сообщение не прошло проверку.
+    """
+    handler = HANDLERS.get(message.get(ACTION))
+    if handler is not None and handler.schema.check(message, client, server):
+        return handler.func
+    return None
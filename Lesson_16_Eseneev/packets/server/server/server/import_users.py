@@ -0,0 +1,135 @@
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtWidgets import (
+    QDialog,
+    QFileDialog,
+    QLabel,
+    QLineEdit,
+    QMessageBox,
+    QProgressBar,
+    QPushButton,
+)
+
+from server.bulk_import import import_users
+
+
+class ImportThread(QThread):
+    """
+    Класс - поток импорта пользователей из файла.
+    Хэширует пароли в пуле процессов, а запись пакетов в базу передаёт
+    потоку сервера и дожидается её, так что прогресс отражает уже
+    записанных пользователей, а ошибка записи прерывает импорт.
+    """
+
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(int, int)
+    failed = pyqtSignal(str)
+
+    def __init__(self, database, server, path):
+        super().__init__()
+        self.database = database
+        self.server = server
+        self.path = path
+
+    def run(self):
+        try:
+            result = import_users(
+                self.database,
+                self.path,
+                write=lambda batch: self.server.threadsafe(
+                    self.database.add_users, batch
+                ).result(),
+                progress=self.progress.emit,
+            )
+        # Любая ошибка чтения файла, хэширования или записи сообщается
+        # окну, иначе поток завершится молча.
+        except Exception as error:
+            self.failed.emit(str(error))
+        else:
+            self.done.emit(*result)
+
+
+class ImportUsers(QDialog):
+    """Класс диалог импорта пользователей из файла CSV или JSON lines."""
+
+    def __init__(self, database, server):
+        super().__init__()
+
+        self.database = database
+        self.server = server
+        self.thread = None
+
+        self.setWindowTitle("Импорт пользователей")
+        self.setFixedSize(400, 140)
+        self.setModal(True)
+        self.setAttribute(Qt.WA_DeleteOnClose)
+
+        self.label_path = QLabel("Файл с именами и паролями (CSV, JSONL):", self)
+        self.label_path.move(10, 10)
+        self.label_path.setFixedSize(380, 15)
+
+        self.path = QLineEdit(self)
+        self.path.setFixedSize(290, 20)
+        self.path.move(10, 30)
+
+        self.btn_path = QPushButton("Обзор...", self)
+        self.btn_path.move(310, 27)
+        self.btn_path.clicked.connect(self.open_file_dialog)
+
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setFixedSize(380, 20)
+        self.progress_bar.move(10, 65)
+
+        self.btn_ok = QPushButton("Импорт", self)
+        self.btn_ok.move(10, 100)
+        self.btn_ok.clicked.connect(self.start_import)
+
+        self.btn_cancel = QPushButton("Закрыть", self)
+        self.btn_cancel.move(310, 100)
+        self.btn_cancel.clicked.connect(self.close)
+
+        self.messages = QMessageBox()
+
+        self.show()
+
+    def open_file_dialog(self):
+        """Метод обработчик открытия окна выбора файла."""
+        path, _ = QFileDialog.getOpenFileName(
+            self, "Файл пользователей", "", "CSV, JSON lines (*.csv *.jsonl *.json)"
+        )
+        if path:
+            self.path.setText(path)
+
+    def start_import(self):
+        """Метод запуска импорта в отдельном потоке."""
+        if not self.path.text():
+            self.messages.critical(self, "Ошибка", "Не указан файл.")
+            return
+        self.btn_ok.setEnabled(False)
+        self.btn_cancel.setEnabled(False)
+        self.thread = ImportThread(self.database, self.server, self.path.text())
+        self.thread.progress.connect(self.update_progress)
+        self.thread.done.connect(self.import_done)
+        self.thread.failed.connect(self.import_failed)
+        self.thread.start()
+
+    def update_progress(self, done, total):
+        """Метод обновления индикатора выполнения."""
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(done)
+
+    def import_done(self, added, skipped):
+        """Метод завершения импорта."""
+        # Рассылаем клиентам сообщение о необходимости обновить справичники
+        self.server.service_update_lists()
+        self.messages.information(
+            self,
+            "Успех",
+            f"Импортировано пользователей: {added}, пропущено: {skipped}.",
+        )
+        self.close()
+
+    def import_failed(self, error):
+        """Метод обработки ошибки чтения файла."""
+        self.messages.critical(self, "Ошибка", f"Ошибка импорта: {error}")
+        self.btn_ok.setEnabled(True)
+        self.btn_cancel.setEnabled(True)
@@ -4,6 +4,7 @@ from PyQt5.QtWidgets import QAction, QApplication, QLabel, QMainWindow, QTableVi
 
 from server.add_user import RegisterUser
 from server.config_window import ConfigWindow
+from server.import_users import ImportUsers
 from server.remove_user import DelUserDialog
 from server.stat_window import StatWindow
 
@@ -38,6 +39,9 @@ class MainWindow(QMainWindow):
         # Кнопка удаления пользователя
         self.remove_btn = QAction("Удаление пользователя", self)
 
+        # Кнопка импорта пользователей из файла
+        self.import_btn = QAction("Импорт пользователей", self)
+
         # Кнопка вывести историю сообщений
         self.show_history_button = QAction("История клиентов", self)
 
@@ -53,6 +57,7 @@ class MainWindow(QMainWindow):
         self.toolbar.addAction(self.config_btn)
         self.toolbar.addAction(self.register_btn)
         self.toolbar.addAction(self.remove_btn)
+        self.toolbar.addAction(self.import_btn)
 
         # Настройки геометрии основного окна
         # Поскольку работать с динамическими размерами мы не умеем, и мало
@@ -70,9 +75,14 @@ class MainWindow(QMainWindow):
         self.active_clients_table.move(10, 45)
         self.active_clients_table.setFixedSize(780, 400)
 
+        # Счётчик изменений списка клиентов на момент построения таблицы и
+        # ячейки размеров очередей отправки: имя - ячейка.
+        self.users_version = None
+        self.queue_items = dict()
+
         # Таймер, обновляющий список клиентов 1 раз в секунду
         self.timer = QTimer()
-        self.timer.timeout.connect(self.create_users_model)
+        self.timer.timeout.connect(self.update_users_model)
         self.timer.start(1000)
 
         # Связываем кнопки с процедурами
@@ -81,19 +91,31 @@ class MainWindow(QMainWindow):
         self.config_btn.triggered.connect(self.server_config)
         self.register_btn.triggered.connect(self.reg_user)
         self.remove_btn.triggered.connect(self.rem_user)
+        self.import_btn.triggered.connect(self.import_users)
 
         # Последним параметром отображаем окно.
         self.show()
 
     def create_users_model(self):
         """Метод заполняющий таблицу активных пользователей."""
-        list_users = self.database.active_users_list()
+        self.users_version, list_users = self.database.active_users_snapshot()
+        queue_sizes = self.server_thread.queue_sizes()
+        self.queue_items = dict()
         list = QStandardItemModel()
         list.setHorizontalHeaderLabels(
-            ["Имя Клиента", "IP Адрес", "Порт", "Время подключения"]
+            [
+                "Имя Клиента",
+                "IP Адрес",
+                "Порт",
+                "Время подключения",
+                "Очередь отправки, байт",
+            ]
         )
         for row in list_users:
             user, ip, port, time = row
+            queue = QStandardItem(str(queue_sizes.get(user, 0)))
+            queue.setEditable(False)
+            self.queue_items[user] = queue
             user = QStandardItem(user)
             user.setEditable(False)
             ip = QStandardItem(ip)
@@ -104,11 +126,24 @@ class MainWindow(QMainWindow):
             # требуется.
             time = QStandardItem(str(time.replace(microsecond=0)))
             time.setEditable(False)
-            list.appendRow([user, ip, port, time])
+            list.appendRow([user, ip, port, time, queue])
         self.active_clients_table.setModel(list)
         self.active_clients_table.resizeColumnsToContents()
         self.active_clients_table.resizeRowsToContents()
 
+    def update_users_model(self):
+        """
+        Метод обновления таблицы активных пользователей по таймеру.
+        Таблица перестраивается, только если список изменился, иначе
+        обновляются лишь размеры очередей отправки.
+        """
+        if self.database.active_version != self.users_version:
+            self.create_users_model()
+            return
+        queue_sizes = self.server_thread.queue_sizes()
+        for user, queue in self.queue_items.items():
+            queue.setText(str(queue_sizes.get(user, 0)))
+
     def show_statistics(self):
         """Метод создающий окно со статистикой клиентов."""
         global stat_window
@@ -132,3 +167,8 @@ class MainWindow(QMainWindow):
         global rem_window
         rem_window = DelUserDialog(self.database, self.server_thread)
         rem_window.show()
+
+    def import_users(self):
+        """Метод создающий окно импорта пользователей."""
+        global import_window
+        import_window = ImportUsers(self.database, self.server_thread)
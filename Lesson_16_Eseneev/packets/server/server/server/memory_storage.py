@@ -0,0 +1,328 @@
+import bisect
+import collections
+import datetime
+import itertools
+
+from server.storage import (
+    HISTORY_PAGE_SIZE,
+    RETENTION_BATCH_SIZE,
+    STATS_HOUR,
+    TOP_SENDERS_LIMIT,
+    Storage,
+    UserRecord,
+)
+
+
+class MemoryStorage(Storage):
+    """
+    Класс - хранилище данных сервера в памяти процесса.
+    Реализует тот же интерфейс, что и ServerStorage, на словарях и
+    списках Python без базы данных. Данные теряются при остановке
+    сервера, поэтому хранилище предназначено для бенчмарков, тестов и
+    профилирования: с ним время обработки запросов не включает работу
+    с базой. Не разделяется между рабочими процессами сервера.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Пользователи: имя - UserRecord, в порядке регистрации
+        self.users = dict()
+        self.user_ids = itertools.count(1)
+        # Статистика: имя - [отправлено, принято]
+        self.statistics = dict()
+        # Статистика по интервалам: (длительность, начало, имя) -
+        # [отправлено, принято]
+        self.message_stats = dict()
+        # Контакты: имя - словарь имён контактов (упорядоченное множество)
+        self.contacts = dict()
+        # Сообщения для отключённых пользователей: имя - словарь id -
+        # (отправитель, идентификатор сообщения, сообщение)
+        self.offline = dict()
+        self.offline_ids = itertools.count(1)
+        # Изменения справочника пользователей: (имя, добавлен), версия -
+        # номер изменения.
+        self.changes = []
+        # Метки токенов восстановления сессии: имя - метка
+        self.resume_nonces = dict()
+        # История входов: строки (id, имя, время, адрес, порт) и их id
+        # по возрастанию для поиска страницы.
+        self.logins = []
+        self.login_ids = []
+        self.login_counter = itertools.count(1)
+        # Итоги входов по дням: (имя, день) - [входов, первый, последний]
+        self.login_daily = dict()
+
+    # Пользователи
+
+    def user_record(self, name):
+        """Метод возвращающий запись пользователя или None."""
+        return self.users.get(name)
+
+    def user_login(self, username, ip_address, port, key):
+        """Метод выполняющийся при входе пользователя."""
+        user = self.users.get(username)
+        if user is None:
+            raise ValueError("Пользователь не зарегистрирован.")
+        login_time = datetime.datetime.now()
+        self.users[username] = user._replace(pubkey=key, last_login=login_time)
+        row_id = next(self.login_counter)
+        self.logins.append((row_id, username, login_time, ip_address, str(port)))
+        self.login_ids.append(row_id)
+        self.add_active_user(username, ip_address, port, login_time)
+
+    def add_user(self, name, passwd_hash):
+        """Метод регистрации пользователя."""
+        if name in self.users:
+            raise ValueError("Пользователь уже существует.")
+        self.users[name] = UserRecord(
+            next(self.user_ids), passwd_hash, None, datetime.datetime.now()
+        )
+        self.statistics[name] = [0, 0]
+        self.changes.append((name, True))
+
+    def add_users(self, accounts):
+        """Метод пакетной регистрации пользователей."""
+        added = 0
+        for name, passwd_hash in accounts:
+            if name not in self.users:
+                self.add_user(name, passwd_hash)
+                added += 1
+        return added
+
+    def remove_user(self, name):
+        """Метод удаляющий пользователя."""
+        self.user_logout(name)
+        del self.users[name]
+        self.statistics.pop(name, None)
+        self.contacts.pop(name, None)
+        for contacts in self.contacts.values():
+            contacts.pop(name, None)
+        self.offline.pop(name, None)
+        self.resume_nonces.pop(name, None)
+        self.message_stats = {
+            key: value for key, value in self.message_stats.items() if key[2] != name
+        }
+        self.login_daily = {
+            key: value for key, value in self.login_daily.items() if key[0] != name
+        }
+        self.logins = [row for row in self.logins if row[1] != name]
+        self.login_ids = [row[0] for row in self.logins]
+        self.changes.append((name, False))
+
+    def users_list(self):
+        """Метод возвращающий список пользователей со временем последнего входа."""
+        return [(name, user.last_login) for name, user in list(self.users.items())]
+
+    def users_version(self):
+        """Метод возвращающий текущую версию справочника пользователей."""
+        return len(self.changes)
+
+    def users_changes(self, version):
+        """Метод возвращающий изменения справочника после версии version."""
+        current = len(self.changes)
+        if version > current:
+            return None
+        changes = dict(self.changes[version:current])
+        added = [name for name, is_added in changes.items() if is_added]
+        removed = [name for name, is_added in changes.items() if not is_added]
+        return current, added, removed
+
+    def set_resume_nonce(self, name, nonce):
+        """Метод сохранения метки токена восстановления сессии."""
+        if name in self.users:
+            self.resume_nonces[name] = nonce
+
+    def take_resume_nonce(self, name, nonce):
+        """Метод однократного использования токена восстановления сессии."""
+        if nonce is None or self.resume_nonces.get(name) != nonce:
+            return False
+        del self.resume_nonces[name]
+        return True
+
+    # Контакты и сообщения
+
+    def get_contacts(self, username):
+        """Метод возвращающий список контактов пользователя."""
+        return list(self.contacts.get(username, ()))
+
+    def add_contact(self, user, contact):
+        """Метод добавления контакта для пользователя."""
+        if contact in self.users:
+            self.contacts.setdefault(user, dict())[contact] = None
+
+    def remove_contact(self, user, contact):
+        """Метод удаления контакта пользователя."""
+        self.contacts.get(user, dict()).pop(contact, None)
+
+    def store_offline_message(self, sender, recipient, message, message_id=None):
+        """Метод сохранения сообщения для отключённого пользователя."""
+        queue = self.offline.setdefault(recipient, dict())
+        if message_id is not None:
+            message_id = str(message_id)
+            for stored_sender, stored_id, _ in queue.values():
+                if stored_sender == sender and stored_id == message_id:
+                    return False
+        queue[next(self.offline_ids)] = (sender, message_id, dict(message))
+        return True
+
+    def get_offline_messages(self, username, limit):
+        """Метод возвращающий не более limit сообщений, ожидающих доставки."""
+        queue = self.offline.get(username, dict())
+        return [
+            (row_id, dict(message))
+            for row_id, (_, _, message) in itertools.islice(queue.items(), limit)
+        ]
+
+    def remove_offline_messages(self, ids):
+        """Метод удаления доставленных сообщений."""
+        ids = set(ids)
+        for queue in self.offline.values():
+            for row_id in ids & queue.keys():
+                del queue[row_id]
+
+    # Статистика сообщений
+
+    def flush_statistics(self):
+        """Метод переноса накопленной статистики сообщений в хранилище."""
+        if not self.pending_sent and not self.pending_accepted:
+            return
+        sent, accepted, buckets = self.take_statistics()
+        for name in set(sent) | set(accepted):
+            if name in self.statistics:
+                self.statistics[name][0] += sent[name]
+                self.statistics[name][1] += accepted[name]
+        for (name, period, start), (bucket_sent, bucket_accepted) in buckets.items():
+            if name in self.users:
+                stats = self.message_stats.setdefault((period, start, name), [0, 0])
+                stats[0] += bucket_sent
+                stats[1] += bucket_accepted
+
+    def message_history_page(
+        self,
+        cursor=None,
+        limit=HISTORY_PAGE_SIZE,
+        username=None,
+        since=None,
+        until=None,
+    ):
+        """
+        Метод возвращающий страницу статистики сообщений, курсор - id
+        последнего пользователя страницы.
+        """
+        rows = []
+        for name, user in list(self.users.items()):
+            if cursor is not None and user.id <= cursor:
+                continue
+            if username and name != username:
+                continue
+            if since is not None and user.last_login < since:
+                continue
+            if until is not None and user.last_login >= until:
+                continue
+            sent, accepted = self.statistics.get(name, (0, 0))
+            rows.append(
+                (
+                    user.id,
+                    (
+                        name,
+                        user.last_login,
+                        sent + self.pending_sent[name],
+                        accepted + self.pending_accepted[name],
+                    ),
+                )
+            )
+            if len(rows) == limit:
+                break
+        cursor = rows[-1][0] if len(rows) == limit else None
+        return [row for _, row in rows], cursor
+
+    def select_stats(self, since, until, period):
+        """Генератор строк статистики по интервалам за время since - until."""
+        since = self.stats_start(since, period)
+        for (stats_period, start, name), stats in list(self.message_stats.items()):
+            if stats_period == period and since <= start < until:
+                yield start, name, stats
+
+    def top_senders(self, since, until, period=STATS_HOUR, limit=TOP_SENDERS_LIMIT):
+        """Метод возвращающий самых активных отправителей за время since - until."""
+        totals = collections.defaultdict(lambda: [0, 0])
+        for start, name, (sent, accepted) in self.select_stats(since, until, period):
+            totals[name][0] += sent
+            totals[name][1] += accepted
+        top = sorted(totals.items(), key=lambda item: (-item[1][0], item[0]))
+        return [(name, sent, accepted) for name, (sent, accepted) in top[:limit]]
+
+    def message_throughput(self, since, until, period=STATS_HOUR):
+        """Метод возвращающий количество сообщений по интервалам."""
+        totals = collections.Counter()
+        for start, name, (sent, accepted) in self.select_stats(since, until, period):
+            totals[start] += sent
+        return sorted(totals.items())
+
+    # История входов
+
+    def login_history_page(
+        self,
+        cursor=None,
+        limit=HISTORY_PAGE_SIZE,
+        username=None,
+        since=None,
+        until=None,
+    ):
+        """Метод возвращающий страницу истории входов, курсор - id строки."""
+        logins = self.logins
+        position = 0 if cursor is None else bisect.bisect_right(self.login_ids, cursor)
+        rows = []
+        for row in itertools.islice(logins, position, None):
+            row_id, name, date_time, ip, port = row
+            if username and name != username:
+                continue
+            if since is not None and date_time < since:
+                continue
+            if until is not None and date_time >= until:
+                continue
+            rows.append(row)
+            if len(rows) == limit:
+                break
+        cursor = rows[-1][0] if len(rows) == limit else None
+        return [row[1:] for row in rows], cursor
+
+    def compact_login_history(
+        self, before, archive_dir=None, limit=RETENTION_BATCH_SIZE
+    ):
+        """Метод сворачивания истории входов старше before в итоги по дням."""
+        rows = [row for row in self.logins if row[2] < before][:limit]
+        if not rows:
+            return 0
+        if archive_dir:
+            self.archive_login_history(
+                archive_dir,
+                [
+                    (row_id, self.users[name].id if name in self.users else None)
+                    + (name, date_time, ip, port)
+                    for row_id, name, date_time, ip, port in rows
+                ],
+            )
+        for row_id, name, date_time, ip, port in rows:
+            daily = self.login_daily.get((name, date_time.date()))
+            if daily is None:
+                self.login_daily[name, date_time.date()] = [1, date_time, date_time]
+            else:
+                daily[0] += 1
+                daily[1] = min(daily[1], date_time)
+                daily[2] = max(daily[2], date_time)
+        removed = {row[0] for row in rows}
+        self.logins = [row for row in self.logins if row[0] not in removed]
+        self.login_ids = [row[0] for row in self.logins]
+        return len(rows)
+
+    def login_daily_history(self, username=None):
+        """Метод возвращающий итоги входов по дням."""
+        return sorted(
+            (
+                (name, day, logins, first, last)
+                for (name, day), (logins, first, last) in list(self.login_daily.items())
+                if not username or name == username
+            ),
+            key=lambda row: (row[1], row[0]),
+        )
@@ -0,0 +1,67 @@
+import datetime
+import logging
+import threading
+
+from sqlalchemy.exc import OperationalError
+
+from common.variables import *
+
+# Загрузка логера
+logger = logging.getLogger("server")
+
+# Пауза между порциями сворачивания истории в секундах, чтобы сервер
+# успевал записывать новые входы.
+RETENTION_PAUSE = 0.05
+
+
+class HistoryRetention(threading.Thread):
+    """
+    Класс - фоновое обслуживание истории входов.
+    Раз в interval секунд сворачивает записи старше days дней в итоги
+    по дням небольшими порциями, при необходимости архивируя их в
+    каталог archive_dir. Работает в отдельном потоке со своей сессией
+    базы и не задерживает вход пользователей дольше одной порции.
+    """
+
+    def __init__(self, database, days, archive_dir=None, interval=RETENTION_INTERVAL):
+        self.database = database
+        self.days = days
+        self.archive_dir = archive_dir
+        self.interval = interval
+        # Флаг продолжения работы и событие для досрочного пробуждения
+        self.running = True
+        self.wakeup = threading.Event()
+        super().__init__(daemon=True)
+
+    def run(self):
+        """Метод основной цикл потока."""
+        logger.info(f"Запущено сворачивание истории входов старше {self.days} дней.")
+        while self.running:
+            try:
+                self.compact()
+            except OperationalError as error:
+                # База занята или недоступна, повторим при следующей проверке.
+                logger.error(f"Ошибка сворачивания истории входов: {error}")
+            self.wakeup.wait(self.interval)
+
+    def compact(self):
+        """
+        Метод сворачивания всей устаревшей истории входов.
+        Возвращает количество обработанных записей.
+        """
+        before = datetime.datetime.now() - datetime.timedelta(days=self.days)
+        total = 0
+        while self.running:
+            count = self.database.compact_login_history(before, self.archive_dir)
+            total += count
+            if count == 0:
+                break
+            self.wakeup.wait(RETENTION_PAUSE)
+        if total:
+            logger.info(f"Свёрнуто записей истории входов: {total}.")
+        return total
+
+    def stop(self):
+        """Метод остановки потока."""
+        self.running = False
+        self.wakeup.set()
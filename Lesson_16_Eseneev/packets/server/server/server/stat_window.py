@@ -1,6 +1,26 @@
+import datetime
+
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QStandardItem, QStandardItemModel
-from PyQt5.QtWidgets import QDialog, QPushButton, QTableView
+from PyQt5.QtWidgets import (
+    QComboBox,
+    QDialog,
+    QLabel,
+    QPushButton,
+    QTableView,
+    QTabWidget,
+    QWidget,
+)
+
+from server.storage import STATS_DAY, STATS_HOUR
+
+# Периоды вкладки активности: название, длительность периода,
+# длительность интервала статистики.
+ACTIVITY_RANGES = (
+    ("Последние 24 часа", datetime.timedelta(days=1), STATS_HOUR),
+    ("Последние 7 дней", datetime.timedelta(days=7), STATS_DAY),
+    ("Последние 30 дней", datetime.timedelta(days=30), STATS_DAY),
+)
 
 
 class StatWindow(QDialog):
@@ -25,21 +45,50 @@ class StatWindow(QDialog):
         self.close_button.move(250, 650)
         self.close_button.clicked.connect(self.close)
 
+        # Вкладки: статистика пользователей и активность за период
+        self.tabs = QTabWidget(self)
+        self.tabs.move(10, 10)
+        self.tabs.setFixedSize(580, 630)
+
         # Лист с собственно статистикой
-        self.stat_table = QTableView(self)
-        self.stat_table.move(10, 10)
-        self.stat_table.setFixedSize(580, 620)
+        self.stat_table = QTableView()
+        self.tabs.addTab(self.stat_table, "Пользователи")
+        # Следующая страница загружается при прокрутке до конца таблицы.
+        self.stat_table.verticalScrollBar().valueChanged.connect(self.table_scrolled)
+
+        # Вкладка активности: выбор периода, самые активные отправители
+        # и количество сообщений по интервалам.
+        self.activity_tab = QWidget()
+        self.tabs.addTab(self.activity_tab, "Активность")
+
+        self.range_label = QLabel("Период:", self.activity_tab)
+        self.range_label.move(10, 12)
+        self.range_box = QComboBox(self.activity_tab)
+        self.range_box.move(85, 8)
+        self.range_box.setFixedSize(200, 25)
+        self.range_box.addItems([title for title, _, _ in ACTIVITY_RANGES])
+        self.range_box.currentIndexChanged.connect(self.create_activity_model)
+
+        self.top_label = QLabel("Самые активные отправители:", self.activity_tab)
+        self.top_label.move(10, 45)
+        self.top_table = QTableView(self.activity_tab)
+        self.top_table.move(10, 65)
+        self.top_table.setFixedSize(270, 520)
+
+        self.throughput_label = QLabel("Сообщений за интервал:", self.activity_tab)
+        self.throughput_label.move(290, 45)
+        self.throughput_table = QTableView(self.activity_tab)
+        self.throughput_table.move(290, 65)
+        self.throughput_table.setFixedSize(270, 520)
 
         self.create_stat_model()
+        self.create_activity_model()
 
     def create_stat_model(self):
         """Метод реализующий заполнение таблицы статистикой сообщений."""
-        # Список записей из базы
-        stat_list = self.database.message_history()
-
         # Объект модели данных:
-        list = QStandardItemModel()
-        list.setHorizontalHeaderLabels(
+        self.stat_model = QStandardItemModel()
+        self.stat_model.setHorizontalHeaderLabels(
             [
                 "Имя Клиента",
                 "Последний раз входил",
@@ -47,6 +96,14 @@ class StatWindow(QDialog):
                 "Сообщений получено",
             ]
         )
+        self.stat_table.setModel(self.stat_model)
+        # Курсор следующей страницы, None - загружены все записи.
+        self.cursor = None
+        self.load_page()
+
+    def load_page(self):
+        """Метод загрузки в таблицу следующей страницы статистики."""
+        stat_list, self.cursor = self.database.message_history_page(self.cursor)
         for row in stat_list:
             user, last_seen, sent, recvd = row
             user = QStandardItem(user)
@@ -57,7 +114,54 @@ class StatWindow(QDialog):
             sent.setEditable(False)
             recvd = QStandardItem(str(recvd))
             recvd.setEditable(False)
-            list.appendRow([user, last_seen, sent, recvd])
-        self.stat_table.setModel(list)
+            self.stat_model.appendRow([user, last_seen, sent, recvd])
         self.stat_table.resizeColumnsToContents()
         self.stat_table.resizeRowsToContents()
+
+    def create_activity_model(self):
+        """
+        Метод заполнения вкладки активности за выбранный период.
+        Данные берутся из статистики по часам или дням, а не из
+        истории всех сообщений.
+        """
+        _, length, period = ACTIVITY_RANGES[self.range_box.currentIndex()]
+        until = datetime.datetime.now()
+        since = until - length
+
+        self.top_model = QStandardItemModel()
+        self.top_model.setHorizontalHeaderLabels(
+            ["Имя Клиента", "Отправлено", "Получено"]
+        )
+        for name, sent, accepted in self.database.top_senders(since, until, period):
+            row = [
+                QStandardItem(name),
+                QStandardItem(str(sent)),
+                QStandardItem(str(accepted)),
+            ]
+            for item in row:
+                item.setEditable(False)
+            self.top_model.appendRow(row)
+        self.top_table.setModel(self.top_model)
+        self.top_table.resizeColumnsToContents()
+
+        self.throughput_model = QStandardItemModel()
+        self.throughput_model.setHorizontalHeaderLabels(["Начало", "Сообщений"])
+        time_format = "%Y-%m-%d %H:%M" if period == STATS_HOUR else "%Y-%m-%d"
+        for start, count in self.database.message_throughput(since, until, period):
+            row = [
+                QStandardItem(start.strftime(time_format)),
+                QStandardItem(str(count)),
+            ]
+            for item in row:
+                item.setEditable(False)
+            self.throughput_model.appendRow(row)
+        self.throughput_table.setModel(self.throughput_model)
+        self.throughput_table.resizeColumnsToContents()
+
+    def table_scrolled(self, value):
+        """Метод загрузки следующей страницы при прокрутке до конца таблицы."""
+        if (
+            self.cursor is not None
+            and value == self.stat_table.verticalScrollBar().maximum()
+        ):
+            self.load_page()
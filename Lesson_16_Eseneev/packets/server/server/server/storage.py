@@ -0,0 +1,408 @@
+import abc
+import collections
+import datetime
+import gzip
+import json
+import os
+import time
+
+# Запись пользователя
+UserRecord = collections.namedtuple(
+    "UserRecord", ("id", "passwd_hash", "pubkey", "last_login")
+)
+
+# Количество строк на странице истории
+HISTORY_PAGE_SIZE = 500
+
+# Количество строк истории входов, сворачиваемых за один вызов
+RETENTION_BATCH_SIZE = 1000
+
+# Длительность интервалов статистики сообщений в секундах
+STATS_HOUR = 3600
+STATS_DAY = 86400
+# Количество пользователей в списке самых активных
+TOP_SENDERS_LIMIT = 10
+
+
+class Storage(abc.ABC):
+    """
+    Класс - интерфейс хранилища данных сервера.
+    MessageProcessor, рабочие процессы и графический интерфейс работают
+    с хранилищем только через методы этого класса. Здесь реализована
+    общая для всех хранилищ часть: список активных пользователей и
+    накопление статистики сообщений в памяти. Остальные методы
+    абстрактные, их реализует хранилище: ServerStorage (база
+    SQLAlchemy) или MemoryStorage (в памяти процесса).
+    """
+
+    def __init__(self):
+        # Статистика сообщений, ещё не записанная в хранилище: имя -
+        # количество отправленных и принятых сообщений.
+        self.pending_sent = collections.Counter()
+        self.pending_accepted = collections.Counter()
+        # Те же счётчики по часам: (начало часа, имя) - количество.
+        self.pending_hourly_sent = collections.Counter()
+        self.pending_hourly_accepted = collections.Counter()
+        # Начало текущего часа и время его окончания по time.time()
+        self.stats_hour = None
+        self.stats_hour_end = 0
+
+        # Активные пользователи: имя - (адрес, порт, время входа).
+        self.active_users = dict()
+        # Счётчик изменений активных пользователей и его значение при
+        # последней записи копии.
+        self.active_version = 0
+        self.active_flushed = 0
+
+    # Пользователи
+
+    @abc.abstractmethod
+    def user_record(self, name):
+        """Метод возвращающий UserRecord пользователя или None."""
+
+    def forget_user(self, name):
+        """
+        Метод сброса сохранённой в памяти записи пользователя.
+        Вызывается при изменении пользователя, в том числе другим
+        процессом сервера.
+        """
+
+    def get_hash(self, name):
+        """Метод получения хэша пароля пользователя."""
+        return self.user_record(name).passwd_hash
+
+    def get_pubkey(self, name):
+        """Метод получения публичного ключа пользователя."""
+        return self.user_record(name).pubkey
+
+    def check_user(self, name):
+        """Метод проверяющий существование пользователя."""
+        return self.user_record(name) is not None
+
+    @abc.abstractmethod
+    def user_login(self, username, ip_address, port, key):
+        """
+        Метод выполняющийся при входе пользователя: записывает факт входа,
+        обновляет открытый ключ и добавляет пользователя в список
+        активных. Если пользователя нет, генерирует ValueError.
+        """
+
+    @abc.abstractmethod
+    def add_user(self, name, passwd_hash):
+        """Метод регистрации пользователя."""
+
+    @abc.abstractmethod
+    def add_users(self, accounts):
+        """
+        Метод пакетной регистрации пользователей по списку пар имя - хэш
+        пароля. Возвращает количество зарегистрированных пользователей.
+        """
+
+    @abc.abstractmethod
+    def remove_user(self, name):
+        """Метод удаляющий пользователя."""
+
+    @abc.abstractmethod
+    def users_list(self):
+        """
+        Метод возвращающий список известных пользователей со временем
+        последнего входа.
+        """
+
+    @abc.abstractmethod
+    def users_version(self):
+        """Метод возвращающий текущую версию справочника пользователей."""
+
+    @abc.abstractmethod
+    def users_changes(self, version):
+        """
+        Метод возвращающий изменения справочника пользователей после
+        версии version: кортеж (текущая версия, добавленные, удалённые).
+        Возвращает None, если такой версии справочник ещё не имел.
+        """
+
+    @abc.abstractmethod
+    def set_resume_nonce(self, name, nonce):
+        """
+        Метод сохранения метки последнего выданного пользователю токена
+        восстановления сессии. Токены с другой меткой не принимаются.
+        """
+
+    @abc.abstractmethod
+    def take_resume_nonce(self, name, nonce):
+        """
+        Метод однократного использования токена восстановления сессии:
+        если сохранённая метка равна nonce, сбрасывает её и возвращает
+        True, иначе возвращает False. Проверка и сброс атомарны.
+        """
+
+    # Активные пользователи
+
+    def add_active_user(self, username, ip_address, port, login_time):
+        """Метод добавления пользователя в список активных."""
+        self.active_users[username] = (ip_address, port, login_time)
+        self.active_version += 1
+
+    def user_logout(self, username):
+        """Метод фиксирующий отключения пользователя."""
+        # Удаляем его из списка активных пользователей.
+        if self.active_users.pop(username, None) is not None:
+            self.active_version += 1
+
+    def active_users_list(self):
+        """
+        Метод возвращающий список активных пользователей: кортежи имя,
+        адрес, порт, время входа в порядке входа.
+        """
+        return self.active_users_snapshot()[1]
+
+    def active_users_snapshot(self):
+        """
+        Метод возвращающий счётчик изменений и список активных
+        пользователей. Пока счётчик не изменился, список тот же.
+        Безопасен для вызова из любого потока.
+        """
+        version = self.active_version
+        users = [(name,) + info for name, info in list(self.active_users.items())]
+        return version, users
+
+    def flush_active_users(self):
+        """
+        Метод записи копии списка активных пользователей для внешних
+        программ. Хранилищу без такой копии делать ничего не нужно.
+        """
+
+    def flush(self):
+        """
+        Метод записи в хранилище накопленных в памяти данных: статистики
+        сообщений и копии списка активных пользователей.
+        """
+        self.flush_statistics()
+        self.flush_active_users()
+
+    # Контакты и сообщения
+
+    @abc.abstractmethod
+    def get_contacts(self, username):
+        """Метод возвращающий список контактов пользователя."""
+
+    @abc.abstractmethod
+    def add_contact(self, user, contact):
+        """Метод добавления контакта для пользователя."""
+
+    @abc.abstractmethod
+    def remove_contact(self, user, contact):
+        """Метод удаления контакта пользователя."""
+
+    @abc.abstractmethod
+    def store_offline_message(self, sender, recipient, message, message_id=None):
+        """
+        Метод сохранения сообщения для отключённого пользователя.
+        Если сообщение с таким идентификатором от того же отправителя
+        уже ожидает доставки, оно не сохраняется и метод возвращает False.
+        """
+
+    @abc.abstractmethod
+    def get_offline_messages(self, username, limit):
+        """
+        Метод возвращающий не более limit сообщений, ожидающих доставки
+        пользователю, в порядке поступления: список кортежей (id, сообщение).
+        """
+
+    @abc.abstractmethod
+    def remove_offline_messages(self, ids):
+        """Метод удаления доставленных сообщений."""
+
+    # Статистика сообщений
+
+    def process_message(self, sender, recipient):
+        """
+        Метод учитывающий факт передачи сообщения в статистике.
+        Счётчики накапливаются в памяти и записываются в хранилище методом
+        flush_statistics, чтобы передача сообщения не ждала записи на диск.
+        """
+        self.pending_sent[sender] += 1
+        self.pending_accepted[recipient] += 1
+        if time.time() >= self.stats_hour_end:
+            self.stats_hour = datetime.datetime.now().replace(
+                minute=0, second=0, microsecond=0
+            )
+            self.stats_hour_end = (
+                self.stats_hour + datetime.timedelta(hours=1)
+            ).timestamp()
+        self.pending_hourly_sent[self.stats_hour, sender] += 1
+        self.pending_hourly_accepted[self.stats_hour, recipient] += 1
+
+    def take_statistics(self):
+        """
+        Метод изъятия накопленной статистики сообщений для записи:
+        кортеж (отправлено, принято, интервалы). Интервалы - словарь
+        (имя, длительность, начало) - [отправлено, принято] по часам и дням.
+        """
+        sent, self.pending_sent = self.pending_sent, collections.Counter()
+        accepted, self.pending_accepted = self.pending_accepted, collections.Counter()
+        hourly_sent = self.pending_hourly_sent
+        hourly_accepted = self.pending_hourly_accepted
+        self.pending_hourly_sent = collections.Counter()
+        self.pending_hourly_accepted = collections.Counter()
+
+        # Складываем часовые счётчики в интервалы часа и дня.
+        buckets = collections.defaultdict(lambda: [0, 0])
+        for counters, index in ((hourly_sent, 0), (hourly_accepted, 1)):
+            for (hour, name), count in counters.items():
+                buckets[name, STATS_HOUR, hour][index] += count
+                buckets[name, STATS_DAY, hour.replace(hour=0)][index] += count
+        return sent, accepted, buckets
+
+    @abc.abstractmethod
+    def flush_statistics(self):
+        """Метод записи накопленной статистики сообщений в хранилище."""
+
+    def message_history(self):
+        """
+        Метод возвращающий статистику сообщений.
+        Учитывает и счётчики, ещё не записанные в хранилище.
+        """
+        return list(self.iter_message_history())
+
+    @abc.abstractmethod
+    def message_history_page(
+        self,
+        cursor=None,
+        limit=HISTORY_PAGE_SIZE,
+        username=None,
+        since=None,
+        until=None,
+    ):
+        """
+        Метод возвращающий страницу статистики сообщений в порядке
+        регистрации пользователей: кортеж (строки, курсор). Строки -
+        кортежи имя, последний вход, отправлено, получено. Курсор None -
+        страниц больше нет. Статистику можно ограничить пользователем и
+        временем последнего входа since <= время < until.
+        """
+
+    def iter_message_history(
+        self, username=None, since=None, until=None, page_size=HISTORY_PAGE_SIZE
+    ):
+        """
+        Генератор строк статистики сообщений. Читает хранилище страницами,
+        поэтому занимает память только под одну страницу.
+        """
+        cursor = None
+        while True:
+            rows, cursor = self.message_history_page(
+                cursor, page_size, username, since, until
+            )
+            yield from rows
+            if cursor is None:
+                return
+
+    @abc.abstractmethod
+    def top_senders(self, since, until, period=STATS_HOUR, limit=TOP_SENDERS_LIMIT):
+        """
+        Метод возвращающий самых активных отправителей за время
+        since <= время < until: кортежи имя, отправлено, получено.
+        Считается по интервалам длительностью period (STATS_HOUR или
+        STATS_DAY), границы округляются до начала интервала.
+        """
+
+    @abc.abstractmethod
+    def message_throughput(self, since, until, period=STATS_HOUR):
+        """
+        Метод возвращающий количество сообщений по интервалам
+        длительностью period за время since <= время < until: кортежи
+        начало интервала, количество. Интервалы без сообщений пропускаются.
+        """
+
+    @staticmethod
+    def stats_start(moment, period):
+        """Метод возвращающий начало интервала статистики, содержащего moment."""
+        moment = moment.replace(minute=0, second=0, microsecond=0)
+        if period == STATS_DAY:
+            moment = moment.replace(hour=0)
+        return moment
+
+    # История входов
+
+    def login_history(self, username=None):
+        """Метод возвращающий историю входов."""
+        return list(self.iter_login_history(username))
+
+    @abc.abstractmethod
+    def login_history_page(
+        self,
+        cursor=None,
+        limit=HISTORY_PAGE_SIZE,
+        username=None,
+        since=None,
+        until=None,
+    ):
+        """
+        Метод возвращающий страницу истории входов в порядке входа:
+        кортеж (строки, курсор). Строки - кортежи имя, время, адрес, порт.
+        Следующая страница запрашивается с полученным курсором, курсор
+        None - страниц больше нет. Историю можно ограничить
+        пользователем и временем входа since <= время < until.
+        """
+
+    def iter_login_history(
+        self, username=None, since=None, until=None, page_size=HISTORY_PAGE_SIZE
+    ):
+        """
+        Генератор строк истории входов. Читает хранилище страницами, поэтому
+        занимает память только под одну страницу.
+        """
+        cursor = None
+        while True:
+            rows, cursor = self.login_history_page(
+                cursor, page_size, username, since, until
+            )
+            yield from rows
+            if cursor is None:
+                return
+
+    @abc.abstractmethod
+    def compact_login_history(
+        self, before, archive_dir=None, limit=RETENTION_BATCH_SIZE
+    ):
+        """
+        Метод сворачивания не более limit строк истории входов старше
+        before в итоги по дням. Если указан archive_dir, то строки
+        сохраняются в архиве. Возвращает количество обработанных строк.
+        """
+
+    @abc.abstractmethod
+    def login_daily_history(self, username=None):
+        """
+        Метод возвращающий итоги входов по дням для свёрнутой истории:
+        имя, день, количество входов, время первого и последнего входа.
+        """
+
+    @staticmethod
+    def archive_login_history(archive_dir, rows):
+        """
+        Метод записи строк истории входов в архив: кортежей id, id
+        пользователя, имя, время, адрес, порт. Каждый месяц хранится
+        в своём файле login_history-ГГГГ-ММ.jsonl.gz, новые строки
+        дописываются в него отдельным сжатым блоком.
+        """
+        os.makedirs(archive_dir, exist_ok=True)
+        months = collections.defaultdict(list)
+        for row_id, user, name, date_time, ip, port in rows:
+            months[date_time.strftime("%Y-%m")].append(
+                json.dumps(
+                    {
+                        "id": row_id,
+                        "user": name,
+                        "date_time": date_time.isoformat(),
+                        "ip": ip,
+                        "port": port,
+                    },
+                    ensure_ascii=False,
+                )
+            )
+        for month, lines in months.items():
+            path = os.path.join(archive_dir, f"login_history-{month}.jsonl.gz")
+            with gzip.open(path, "at", encoding="utf-8") as file:
+                file.write("\n".join(lines) + "\n")
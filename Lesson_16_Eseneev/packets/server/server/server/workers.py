@@ -0,0 +1,253 @@
+import concurrent.futures
+import datetime
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+from common.variables import *
+from server.core import run_call
+
+# Загрузка логера
+logger = logging.getLogger("server")
+
+# Типы событий, которыми обмениваются процессы сервера.
+LOGIN = "login"
+LOGOUT = "logout"
+FORWARD = "forward"
+UPDATE_LISTS = "update_lists"
+KICK = "kick"
+QUEUES = "queues"
+STOP = "stop"
+
+
+class Router(threading.Thread):
+    """
+    Класс - связь рабочего процесса с остальными процессами сервера.
+    Хранит справочник сессий: какой процесс обслуживает пользователя,
+    рассылает события входа и выхода и передаёт сообщения процессу
+    получателя. Входящие события читает из своей очереди в отдельном
+    потоке и передаёт их в поток сервера.
+    """
+
+    def __init__(self, worker_id, inboxes, status):
+        # Номер процесса и очереди всех процессов
+        self.worker_id = worker_id
+        self.inboxes = inboxes
+        self.inbox = inboxes[worker_id]
+        # Очередь событий главного процесса
+        self.status = status
+        # Справочник сессий: имя пользователя - номер процесса
+        self.directory = dict()
+        # Сервер этого процесса
+        self.processor = None
+        super().__init__(daemon=True)
+
+    def owner(self, name):
+        """Метод возвращающий номер процесса пользователя или None."""
+        return self.directory.get(name)
+
+    def broadcast(self, event):
+        """Метод рассылки события остальным процессам и главному процессу."""
+        for number, inbox in enumerate(self.inboxes):
+            if number != self.worker_id:
+                inbox.put(event)
+        self.status.put(event)
+
+    def announce_login(self, name, ip_address, port):
+        """
+        Метод оповещения о входе пользователя в этом процессе.
+        Адрес и время входа нужны главному процессу для списка
+        активных пользователей.
+        """
+        self.directory[name] = self.worker_id
+        self.broadcast(
+            (LOGIN, name, self.worker_id, ip_address, port, datetime.datetime.now())
+        )
+
+    def announce_logout(self, name):
+        """Метод оповещения о выходе пользователя из этого процесса."""
+        if self.directory.get(name) == self.worker_id:
+            del self.directory[name]
+        self.broadcast((LOGOUT, name, self.worker_id))
+
+    def forward(self, message):
+        """
+        Метод передачи сообщения процессу получателя.
+        Возвращает False, если получатель не подключён.
+        """
+        owner = self.directory.get(message[DESTINATION])
+        if owner is None or owner == self.worker_id:
+            return False
+        self.inboxes[owner].put((FORWARD, message))
+        return True
+
+    def run(self):
+        """Метод обработки входящих событий."""
+        while True:
+            try:
+                event = self.inbox.get(timeout=1)
+            except queue.Empty:
+                # Раз в секунду сообщаем главному процессу размеры очередей.
+                self.status.put((QUEUES, self.worker_id, self.processor.queue_sizes()))
+                continue
+            if event[0] == LOGIN:
+                self.directory[event[1]] = event[2]
+                # При входе в другом процессе мог смениться ключ пользователя.
+                self.processor.threadsafe(self.processor.database.forget_user, event[1])
+            elif event[0] == LOGOUT:
+                if self.directory.get(event[1]) == event[2]:
+                    del self.directory[event[1]]
+            elif event[0] == FORWARD:
+                self.processor.threadsafe(self.processor.process_message, event[1])
+            elif event[0] == UPDATE_LISTS:
+                self.processor.service_update_lists()
+            elif event[0] == KICK:
+                self.processor.kick_user(event[1])
+            elif event[0] == STOP:
+                self.processor.running = False
+                break
+
+
+def worker_main(worker_id, inboxes, status, settings):
+    """
+    Функция - точка входа рабочего процесса.
+    Запускает сервер с общим портом и связь с другими процессами.
+    """
+    # Импортируем здесь: процесс запускается методом spawn.
+    from server.async_core import AsyncMessageProcessor
+    from server.core import MessageProcessor
+    from server.backends import open_storage
+
+    # База уже очищена главным процессом.
+    # Список активных пользователей ведёт главный процесс.
+    database = open_storage(
+        settings["backend"],
+        settings["database"],
+        settings["url"],
+        clear_active=False,
+        wal=settings["wal"],
+        active_mirror=False,
+    )
+    router = Router(worker_id, inboxes, status)
+    if settings["engine"] == "asyncio":
+        server_class = AsyncMessageProcessor
+    else:
+        server_class = MessageProcessor
+    server = server_class(
+        settings["address"],
+        settings["port"],
+        database,
+        high_watermark=settings["high_watermark"],
+        low_watermark=settings["low_watermark"],
+        slow_policy=settings["slow_policy"],
+        handshake_timeout=settings["handshake_timeout"],
+        stats_interval=settings["stats_interval"],
+        router=router,
+    )
+    router.processor = server
+    server.start()
+    router.start()
+    logger.info(f"Запущен рабочий процесс сервера № {worker_id}.")
+    server.join()
+
+
+class WorkerPool(threading.Thread):
+    """
+    Класс - пул рабочих процессов сервера.
+    Запускает процессы, которые принимают соединения на одном порту,
+    и собирает их события: справочник сессий, список активных
+    пользователей и размеры очередей.
+    Для графического интерфейса заменяет MessageProcessor.
+    Работает в качестве отдельного потока.
+    """
+
+    def __init__(self, workers, settings, database):
+        # Процессы запускаем методом spawn: SQLAlchemy и PyQt не должны
+        # наследоваться от главного процесса.
+        context = multiprocessing.get_context("spawn")
+        self.inboxes = [context.Queue() for _ in range(workers)]
+        self.status = context.Queue()
+        self.processes = [
+            context.Process(
+                target=worker_main,
+                args=(number, self.inboxes, self.status, settings),
+                daemon=True,
+            )
+            for number in range(workers)
+        ]
+
+        # Флаг продолжения работы
+        self.running = True
+
+        # Справочник сессий: имя пользователя - номер процесса.
+        self.names = dict()
+
+        # Размеры очередей отправки по процессам
+        self.sizes = dict()
+
+        # База данных главного процесса, её используют этот поток и
+        # графический интерфейс, поэтому запись выполняется под блокировкой.
+        self.database = database
+        self.database_lock = threading.Lock()
+        self.stats_interval = settings["stats_interval"]
+
+        super().__init__()
+
+    def run(self):
+        """Метод основной цикл потока."""
+        for process in self.processes:
+            process.start()
+        flush_at = time.monotonic() + self.stats_interval
+        while self.running:
+            # Копию списка активных пользователей записываем в базу здесь.
+            if time.monotonic() >= flush_at:
+                flush_at = time.monotonic() + self.stats_interval
+                self.threadsafe(self.database.flush_active_users)
+            try:
+                event = self.status.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if event[0] == LOGIN:
+                self.names[event[1]] = event[2]
+                self.threadsafe(self.database.add_active_user, event[1], *event[3:])
+            elif event[0] == LOGOUT:
+                if self.names.get(event[1]) == event[2]:
+                    del self.names[event[1]]
+                    self.threadsafe(self.database.user_logout, event[1])
+            elif event[0] == QUEUES:
+                self.sizes[event[1]] = event[2]
+        for inbox in self.inboxes:
+            inbox.put((STOP,))
+        for process in self.processes:
+            process.join(3)
+        self.threadsafe(self.database.flush_active_users)
+
+    def threadsafe(self, func, *args):
+        """
+        Метод вызова функции записи в базу главного процесса.
+        Функция вызывается сразу под блокировкой базы. Возвращает
+        выполненный concurrent.futures.Future с результатом вызова.
+        """
+        future = concurrent.futures.Future()
+        with self.database_lock:
+            run_call(future, func, args)
+        return future
+
+    def queue_sizes(self):
+        """Метод возвращающий размеры очередей отправки всех процессов."""
+        sizes = dict()
+        for worker_sizes in list(self.sizes.values()):
+            sizes.update(worker_sizes)
+        return sizes
+
+    def service_update_lists(self):
+        """Метод рассылки сообщения 205 клиентам всех процессов."""
+        for inbox in self.inboxes:
+            inbox.put((UPDATE_LISTS,))
+
+    def kick_user(self, name):
+        """Метод отключения пользователя, удалённого из базы."""
+        if name in self.names:
+            self.inboxes[self.names[name]].put((KICK, name))
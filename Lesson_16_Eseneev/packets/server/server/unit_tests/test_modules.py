@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), ".."))
+from common.utils import FRAME_HEADER, MessageDecoder, encode_message
+from common.variables import ACTION, MAX_FRAME_LENGTH, PRESENCE, RESPONSE, TIME
+
+
+class TestMessageDecoder(unittest.TestCase):
+    """Тесты сборки входящих сообщений из порций данных."""
+
+    first = {ACTION: PRESENCE, TIME: 1.1}
+    second = {RESPONSE: 200}
+
+    def test_encode_framed(self):
+        """Сообщение с заголовком длины начинается с длины JSON."""
+        data = encode_message(self.first, True)
+        (length,) = FRAME_HEADER.unpack_from(data)
+        self.assertEqual(length, len(data) - FRAME_HEADER.size)
+        self.assertEqual(data[FRAME_HEADER.size :], encode_message(self.first))
+
+    def test_split_frame(self):
+        """Сообщение, поступившее по одному байту, собирается целиком."""
+        decoder = MessageDecoder(True)
+        data = encode_message(self.first, True)
+        messages = []
+        for position in range(len(data)):
+            messages += decoder.feed(data[position : position + 1])
+            if position < len(data) - 1:
+                self.assertEqual(messages, [])
+        self.assertEqual(messages, [self.first])
+
+    def test_glued_frames(self):
+        """Склеенные сообщения разделяются, неполное ждёт продолжения."""
+        decoder = MessageDecoder(True)
+        data = encode_message(self.first, True) + encode_message(self.second, True)
+        tail = encode_message(self.first, True)
+        self.assertEqual(decoder.feed(data + tail[:3]), [self.first, self.second])
+        self.assertEqual(decoder.feed(tail[3:]), [self.first])
+
+    def test_glued_unframed(self):
+        """Без заголовка длины склеенные JSON объекты разбираются по очереди."""
+        decoder = MessageDecoder()
+        data = encode_message(self.first) + b" " + encode_message(self.second)
+        self.assertEqual(decoder.feed(data), [self.first, self.second])
+
+    def test_not_dict(self):
+        """Не словарь вызывает TypeError."""
+        with self.assertRaises(TypeError):
+            MessageDecoder().feed(b"[1, 2]")
+        with self.assertRaises(TypeError):
+            MessageDecoder(True).feed(FRAME_HEADER.pack(2) + b"[]")
+
+    def test_frame_too_long(self):
+        """Слишком длинное сообщение вызывает TypeError до его приёма."""
+        with self.assertRaises(TypeError):
+            MessageDecoder(True).feed(FRAME_HEADER.pack(MAX_FRAME_LENGTH + 1))
+
+    def test_invalid_utf8(self):
+        """Данные не в UTF-8 вызывают UnicodeDecodeError в обоих режимах."""
+        with self.assertRaises(UnicodeDecodeError):
+            MessageDecoder().feed(b"\xff\xfe{}")
+        with self.assertRaises(UnicodeDecodeError):
+            MessageDecoder(True).feed(FRAME_HEADER.pack(4) + b"\xff\xfe{}")
+
+
+if __name__ == "__main__":
+    unittest.main()